@@ -10,23 +10,42 @@
 
 import json
 import os
+import sys
+import math
+import struct
+import mmap
+import socket
+import tempfile
+import codecs
+import bisect
+import heapq
+import random
+import operator
+import inspect
+import threading
 import uuid
 import re
-from datetime import datetime, timezone, timedelta
+from datetime import date, datetime, timezone, timedelta
 import atexit
 import decimal
 import sqlite3
 import hashlib
 import secrets
-from functools import wraps
+from functools import wraps, partial
 import time
 
 import requests
 from bs4 import BeautifulSoup
-from flask import Flask, render_template, jsonify, request, session, redirect, url_for, g, make_response
+from flask import Flask, render_template, jsonify, request, session, redirect, url_for, g, make_response, has_app_context
 from dotenv import load_dotenv
 from apscheduler.schedulers.background import BackgroundScheduler
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
+from array import array
+
+try:
+    import fcntl
+except ImportError:  # ویندوز: حالت جدول قیمت مشترک در دسترس نیست
+    fcntl = None
 
 # لود متغیرهای محیطی از فایل .env
 load_dotenv()
@@ -47,6 +66,13 @@ BRSAPI_KEY = os.getenv('BRSAPI_KEY')
 API_GOLD_CURRENCY = f"https://Api.BrsApi.ir/Market/Gold_Currency.php?key={BRSAPI_KEY}"
 API_TSETMC = f"https://Api.BrsApi.ir/Tsetmc/AllSymbols.php?key={BRSAPI_KEY}&type=1"
 
+# ---------- منبع قیمت‌ها ----------
+# brsapi (پیش‌فرض) یا replay (بازپخش پاسخ‌های ضبط شده از PRICE_REPLAY_DIR)
+PRICE_SOURCE = os.getenv('PRICE_SOURCE', 'brsapi')
+PRICE_REPLAY_DIR = os.getenv('PRICE_REPLAY_DIR', 'recordings')
+PRICE_REPLAY_SPEED = float(os.getenv('PRICE_REPLAY_SPEED', '1'))
+PRICE_RECORD_DIR = os.getenv('PRICE_RECORD_DIR', '')  # خالی = بدون ضبط
+
 # ---------- هدرهای درخواست‌های HTTP ----------
 API_HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
@@ -55,6 +81,64 @@ API_HEADERS = {
 
 # ---------- تنظیمات کش ----------
 PRICE_CACHE_MINUTES = 10  # فاصله زمانی بروزرسانی قیمت‌ها (دقیقه)
+TSETMC_CACHE_MINUTES = 17  # فاصله زمانی بروزرسانی بورس (دقیقه)
+PRICE_RETRY_SECONDS = 60  # حداقل فاصله تلاش مجدد پس از خطای API (ثانیه)
+PRICE_COLD_WAIT_SECONDS = 5  # حداکثر انتظار درخواست‌ها برای اولین دریافت قیمت (ثانیه)
+
+# دسته‌های هر منبع قیمت و مدت اعتبار هر دسته (ثانیه)
+GOLD_CURRENCY_CATEGORIES = ('gold_coin', 'currency', 'crypto')
+PRICE_TTL_SECONDS = {
+    'gold_coin': PRICE_CACHE_MINUTES * 60,
+    'currency': PRICE_CACHE_MINUTES * 60,
+    'crypto': PRICE_CACHE_MINUTES * 60,
+    'stock': TSETMC_CACHE_MINUTES * 60
+}
+
+# ---------- خروجی JSON قیمت‌ها ----------
+# کش اصلی قیمت‌ها باینری است؛ prices.json فقط برای مصرف‌کننده‌های خارجی نوشته می‌شود
+PRICES_JSON_EXPORT = os.getenv('PRICES_JSON_EXPORT', '1') == '1'
+
+# ---------- تنظیمات تاریخچه (صفحه‌بندی و کاهش نقاط نمودار) ----------
+HISTORY_MAX_LIMIT = 5000      # حداکثر تعداد ردیف در هر صفحه
+HISTORY_MAX_POINTS = 2000     # سقف پارامتر max_points
+
+# ---------- فیلتر و صفحه‌بندی قیمت‌ها (/api/prices و /api/tsetmc) ----------
+PRICE_QUERY_MAX_LIMIT = 1000  # حداکثر تعداد نماد در هر صفحه
+
+# ---------- هدف سرمایه‌گذاری ----------
+# نماد قیمت واحد هر نوع هدف (هدف تومانی واحد ندارد)
+GOAL_UNIT_SYMBOLS = {'toman': None, 'dollar': 'USD', 'gold': 'IR_GOLD_18K', 'bitcoin': 'BTC'}
+GOAL_PROJECTION_DAYS = 90  # بازه داده‌های chart_data برای برازش روند
+
+# ---------- نوشتن تراکنش‌ها ----------
+DB_WRITE_RETRIES = 5               # تعداد تلاش در صورت SQLITE_BUSY
+DB_WRITE_BACKOFF_SECONDS = 0.05    # تأخیر پایه تلاش مجدد (نمایی)
+IDEMPOTENCY_KEY_HOURS = 24         # مدت نگهداری کلیدهای Idempotency-Key
+TRANSACTION_BATCH_MAX = 1000       # حداکثر تعداد تراکنش در هر درخواست دسته‌ای
+
+# حداکثر اختلاف مجاز موجودی نگهداری شده با مرور کامل تراکنش‌ها
+BALANCE_TOLERANCE = decimal.Decimal('1e-8')
+# اختلاف نسبی مجاز (موجودی REAL است و جمع float در مقادیر بزرگ خطای گردکردن دارد)
+BALANCE_RELATIVE_TOLERANCE = decimal.Decimal('1e-12')
+
+# ---------- ارزش‌گذاری با اعداد صحیح (Fixed-Point) ----------
+QUANTITY_DECIMALS = 10  # رقم اعشار مقدار (همان دقت ذخیره موجودی در asset_balances)
+PRICE_DECIMALS = 8      # رقم اعشار قیمت هر واحد (نمادهای ارزان رمزارز)
+MONEY_DECIMALS = 18     # مقیاس مشترک مبالغ (باید >= رقم مقدار + رقم قیمت باشد)
+
+# ---------- روش محاسبه بهای تمام‌شده (قابل انتخاب برای هر کاربر) ----------
+# average: میانگین موزون، fifo: اولین خرید اولین فروش، lifo: آخرین خرید اولین فروش
+COST_BASIS_METHODS = ('average', 'fifo', 'lifo')
+DEFAULT_COST_BASIS_METHOD = 'average'
+
+# ---------- تحلیل عملکرد ----------
+XIRR_MAX_ITERATIONS = 50        # حداکثر تکرار نیوتن-رافسون
+XIRR_TOLERANCE = 1e-9           # دقت همگرایی نرخ
+PERFORMANCE_FLOW_EPSILON = 1e-6  # جریان خالص کمتر از این (تومان) صفر حساب می‌شود
+ANALYTICS_CACHE_MAX_USERS = 1000  # حداکثر کاربر در کش عملکرد/توزیع هر پروسس (LRU)
+
+# فیلدهای هر نماد در پاسخ /api/watchlist/quotes
+WATCHLIST_QUOTE_FIELDS = {'title', 'name', 'toman_price', 'usd_price', 'change_value', 'change_percent', 'last_update'}
 
 # ---------- دسته‌بندی دارایی‌ها و نمادهای هر دسته ----------
 ASSET_TYPES = {
@@ -84,11 +168,34 @@ ALL_SYMBOLS = {
     for symbol in symbols
 }
 
+# اندازه قطعه‌های دریافت تدریجی پاسخ بورس (بایت)
+TSETMC_STREAM_CHUNK = 64 * 1024
+
+# تعداد نمادهای هر فهرست خلاصه بازار (بیشترین رشد/افت/تغییر)
+MARKET_SUMMARY_TOP = 10
+
 # ---------- مسیر فایل‌های کش ----------
 PRICES_FILE = 'prices.json'
+PRICES_SNAPSHOT_FILE = 'prices.bin'  # کش باینری اصلی (فرمت PriceTable)
 TSETMC_FILE = 'tsetmc_data.json'
 STATUS_FILE = 'status_config.json'
 
+# ---------- جدول قیمت مشترک بین workerها ----------
+# با تنظیم مسیر (مثلاً /dev/shm/assetly_prices.bin) فقط یک پروسس قیمت‌ها را دریافت
+# و بقیه از حافظه مشترک می‌خوانند. خالی = حالت تک‌پروسسی
+SHARED_PRICES_FILE = os.getenv('SHARED_PRICES_FILE', '')
+SHARED_PRICES_SLOT_MB = int(os.getenv('SHARED_PRICES_SLOT_MB', '8'))
+
+# ---------- راه‌اندازی سریع ----------
+# با FAST_START=1 سرور فوراً از کش دیسک سرویس می‌دهد و دریافت قیمت‌ها
+# و محاسبات اولیه کاربران در پس‌زمینه انجام می‌شود
+FAST_START = os.getenv('FAST_START', '0') == '1'
+
+# ---------- هماهنگی زمان‌بند بین پروسس‌ها ----------
+# local | leader | off (توضیحات در بخش ۲۳)
+SCHEDULER_MODE = os.getenv('SCHEDULER_MODE', 'local')
+SCHEDULER_LEASE_SECONDS = int(os.getenv('SCHEDULER_LEASE_SECONDS', '60'))
+
 # ---------- ثابت‌های سیستم ----------
 RIAL_WALLET_SYMBOL = 'RIAL_WALLET'
 
@@ -101,7 +208,9 @@ app.secret_key = secrets.token_hex(32)
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=30)
 
 # ---------- وضعیت گلوبال قیمت‌ها ----------
-current_prices = {'categorized': {}}
+# مرجع snapshot تغییرناپذیر قیمت‌ها (PriceSnapshot)؛ بعد از تعریف کلاس در بخش ۸
+# مقداردهی و فقط با publish_prices جایگزین می‌شود
+current_prices = None
 
 # ---------- لاگ درخواست‌های API (برای Rate Limiting) ----------
 # ساختار: {api_key: [timestamps]}
@@ -184,10 +293,97 @@ def init_db():
             comment TEXT,
             date TIMESTAMP NOT NULL,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            seq INTEGER,
             FOREIGN KEY (asset_id) REFERENCES assets(id),
             FOREIGN KEY (user_id) REFERENCES users(id)
         )
     ''')
+    create_transaction_order(db)
+
+    # ---------- جدول موجودی جاری دارایی‌ها ----------
+    # با تریگرهای جدول تراکنش‌ها در همان تراکنش SQL بروز می‌شود (create_balance_triggers)
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS asset_balances (
+            asset_id TEXT PRIMARY KEY,
+            balance REAL NOT NULL DEFAULT 0,
+            FOREIGN KEY (asset_id) REFERENCES assets(id)
+        )
+    ''')
+    create_balance_triggers(db)
+    if not db.execute('SELECT 1 FROM asset_balances LIMIT 1').fetchone():
+        # پایگاه داده قدیمی: ساخت موجودی‌ها از روی تراکنش‌های موجود
+        rebuild_asset_balances(db)
+
+    # ---------- جدول تنظیمات کاربر ----------
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS user_settings (
+            user_id INTEGER PRIMARY KEY,
+            cost_basis_method TEXT NOT NULL DEFAULT 'average',
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    ''')
+
+    # ساختار قدیمی صف لات‌ها (مقدار و قیمت REAL، مکان‌نما روی rowid): هر دو جدول
+    # از روی تراکنش‌ها قابل ساخت هستند، پس حذف و دوباره ساخته می‌شوند
+    lot_columns = {row['name']: row['type'] for row in db.execute('PRAGMA table_info(asset_lots)')}
+    state_columns = {row['name'] for row in db.execute('PRAGMA table_info(asset_lot_state)')}
+    if lot_columns.get('quantity') == 'REAL' or (state_columns and 'ledger_quantity' not in state_columns):
+        db.execute('DROP TABLE IF EXISTS asset_lots')
+        db.execute('DROP TABLE IF EXISTS asset_lot_state')
+
+    # ---------- جدول لات‌های باز هر دارایی ----------
+    # مقدار باقیمانده و قیمت خرید هر لات به‌صورت رشته دهدهی دقیق (بدون گرد شدن REAL)؛
+    # average فقط یک لات با قیمت میانگین دارد
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS asset_lots (
+            asset_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            quantity TEXT NOT NULL,
+            price TEXT NOT NULL,
+            PRIMARY KEY (asset_id, seq),
+            FOREIGN KEY (asset_id) REFERENCES assets(id)
+        )
+    ''')
+
+    # ---------- جدول وضعیت صف لات‌ها ----------
+    # آخرین تراکنش اعمال شده (date, seq)، سود محقق شده (رشته دهدهی دقیق)،
+    # تعداد تراکنش‌های ثبت شده پس از آن (pending) که هنوز اعمال نشده‌اند
+    # و فیلدهای DecimalLedger به‌صورت رشته str(Decimal) (خروجی /api/assets)
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS asset_lot_state (
+            asset_id TEXT PRIMARY KEY,
+            method TEXT NOT NULL,
+            realized TEXT NOT NULL DEFAULT '0',
+            last_date TEXT,
+            last_seq INTEGER NOT NULL DEFAULT 0,
+            next_seq INTEGER NOT NULL DEFAULT 0,
+            pending INTEGER NOT NULL DEFAULT 0,
+            ledger_quantity TEXT NOT NULL DEFAULT '0',
+            ledger_buy_quantity TEXT NOT NULL DEFAULT '0',
+            ledger_buy_cost TEXT NOT NULL DEFAULT '0',
+            ledger_realized TEXT NOT NULL DEFAULT '0',
+            ledger_oversold TEXT NOT NULL DEFAULT '0',
+            FOREIGN KEY (asset_id) REFERENCES assets(id)
+        )
+    ''')
+    create_lot_triggers(db)
+    if not db.execute('SELECT 1 FROM asset_lot_state LIMIT 1').fetchone():
+        # پایگاه داده قدیمی: ساخت صف لات‌ها از روی تراکنش‌های موجود
+        for user in db.execute('SELECT DISTINCT user_id FROM assets').fetchall():
+            sync_user_lots(db, user['user_id'])
+
+    # ---------- جدول کلیدهای Idempotency درخواست‌های ثبت تراکنش ----------
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            user_id INTEGER NOT NULL,
+            idempotency_key TEXT NOT NULL,
+            request_hash TEXT NOT NULL,
+            response TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (user_id, idempotency_key)
+        )
+    ''')
 
     # ---------- جدول داده‌های نمودار ----------
     db.execute('''
@@ -201,6 +397,18 @@ def init_db():
         )
     ''')
 
+    # ---------- جدول نسخه داده‌های کاربر ----------
+    # با هر تغییر دارایی، تراکنش، تنظیمات یا نمودار کاربر (تریگر) یک واحد زیاد می‌شود؛
+    # کلید مشترک کش‌های تحلیلی بین پروسس‌ها
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS user_data_versions (
+            user_id INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    ''')
+    create_user_version_triggers(db)
+
     # ---------- جدول تحلیل ارزش ----------
     db.execute('''
         CREATE TABLE IF NOT EXISTS value_analysis (
@@ -263,6 +471,20 @@ def init_db():
         )
     ''')
 
+    # ---------- جدول پیشرفت هدف سرمایه‌گذاری ----------
+    # با هر محاسبه سود روزانه بروز می‌شود (بدون محاسبه مجدد کل پورتفوی)
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS investment_goal_progress (
+            user_id INTEGER PRIMARY KEY,
+            current_value REAL NOT NULL,
+            progress_percent REAL NOT NULL,
+            total_value_toman REAL NOT NULL,
+            achieved_at TIMESTAMP,
+            updated_at TIMESTAMP NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    ''')
+
     # ---------- جدول نشست‌های کاربری ----------
     db.execute('''
         CREATE TABLE IF NOT EXISTS user_sessions (
@@ -286,6 +508,50 @@ def init_db():
         )
     ''')
 
+    # ---------- جدول هشدارهای قیمت ----------
+    # alert_type: above / below (قیمت)، change (درصد تغییر)، break_even (قیمت سر به سر)
+    # updated_at با هر تغییر بروز می‌شود تا ایندکس حافظه بتواند تغییرات را تشخیص دهد
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS price_alerts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            symbol TEXT NOT NULL,
+            alert_type TEXT NOT NULL,
+            target REAL NOT NULL,
+            active INTEGER NOT NULL DEFAULT 1,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            triggered_at TIMESTAMP,
+            updated_at REAL NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    ''')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_price_alerts_updated ON price_alerts(updated_at)')
+
+    # ---------- صندوق خروجی هشدارها (Outbox) ----------
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS alert_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            alert_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            symbol TEXT NOT NULL,
+            message TEXT NOT NULL,
+            value REAL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            delivered_at TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    ''')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_alert_outbox_user ON alert_outbox(user_id, delivered_at)')
+
+    # ---------- جدول lease زمان‌بند (انتخاب رهبر بین پروسس‌ها) ----------
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS scheduler_lease (
+            name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    ''')
+
     # ---------- جدول لاگ درخواست‌های API ----------
     db.execute('''
         CREATE TABLE IF NOT EXISTS api_requests (
@@ -303,6 +569,179 @@ def init_db():
     print("✅ Database initialized successfully")
 
 
+def balance_delta_sql(row):
+    """
+    عبارت SQL تغییر موجودی یک ردیف تراکنش (row: NEW یا OLD)
+    همان قواعد aggregate_assets: buy مثبت، sell/save_profit منفی و
+    deposit/withdrawal فقط برای کیف پول ریالی
+    """
+    return f'''
+        CASE {row}.type
+            WHEN 'buy' THEN {row}.quantity
+            WHEN 'sell' THEN -{row}.quantity
+            WHEN 'save_profit' THEN -{row}.quantity
+            WHEN 'deposit' THEN CASE WHEN (SELECT symbol FROM assets WHERE id = {row}.asset_id) = '{RIAL_WALLET_SYMBOL}'
+                                     THEN {row}.quantity ELSE 0 END
+            WHEN 'withdrawal' THEN CASE WHEN (SELECT symbol FROM assets WHERE id = {row}.asset_id) = '{RIAL_WALLET_SYMBOL}'
+                                        THEN -{row}.quantity ELSE 0 END
+            ELSE 0
+        END'''
+
+
+def create_balance_triggers(db):
+    """
+    تریگرهای نگهداری موجودی جاری (asset_balances) با هر درج/ویرایش/حذف تراکنش
+    موجودی تا ۱۰ رقم اعشار گرد می‌شود تا خطای جمع اعشاری انباشته نشود
+    """
+    db.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS transactions_balance_insert AFTER INSERT ON transactions
+        BEGIN
+            INSERT INTO asset_balances (asset_id, balance) VALUES (NEW.asset_id, 0)
+                ON CONFLICT(asset_id) DO NOTHING;
+            UPDATE asset_balances SET balance = ROUND(balance + {balance_delta_sql('NEW')}, 10)
+                WHERE asset_id = NEW.asset_id;
+        END
+    ''')
+    db.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS transactions_balance_update
+        AFTER UPDATE OF asset_id, type, quantity ON transactions
+        BEGIN
+            UPDATE asset_balances SET balance = ROUND(balance - {balance_delta_sql('OLD')}, 10)
+                WHERE asset_id = OLD.asset_id;
+            INSERT INTO asset_balances (asset_id, balance) VALUES (NEW.asset_id, 0)
+                ON CONFLICT(asset_id) DO NOTHING;
+            UPDATE asset_balances SET balance = ROUND(balance + {balance_delta_sql('NEW')}, 10)
+                WHERE asset_id = NEW.asset_id;
+        END
+    ''')
+    db.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS transactions_balance_delete AFTER DELETE ON transactions
+        BEGIN
+            UPDATE asset_balances SET balance = ROUND(balance - {balance_delta_sql('OLD')}, 10)
+                WHERE asset_id = OLD.asset_id;
+        END
+    ''')
+    db.execute('''
+        CREATE TRIGGER IF NOT EXISTS assets_balance_delete AFTER DELETE ON assets
+        BEGIN
+            DELETE FROM asset_balances WHERE asset_id = OLD.id;
+        END
+    ''')
+
+
+def create_transaction_order(db):
+    """
+    ستون seq تراکنش‌ها: شماره ترتیب ثبت (پایدار، برخلاف rowid که VACUUM ممکن است
+    آن را تغییر دهد). تراکنش‌های هم‌تاریخ به ترتیب seq پردازش می‌شوند
+
+    تراکنش‌های موجود در پایگاه داده قدیمی به ترتیب rowid شماره می‌گیرند و
+    تراکنش‌های جدید با تریگر شماره بعدی را می‌گیرند
+    """
+    columns = {row['name'] for row in db.execute('PRAGMA table_info(transactions)')}
+    if 'seq' not in columns:
+        db.execute('ALTER TABLE transactions ADD COLUMN seq INTEGER')
+        db.execute('UPDATE transactions SET seq = rowid')
+    db.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_transactions_seq ON transactions(seq)')
+    # مرور تراکنش‌های هر دارایی به ترتیب زمان و ثبت (ارزش‌گذاری پورتفوی)
+    db.execute('DROP INDEX IF EXISTS idx_transactions_asset_date')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_transactions_asset_order ON transactions(asset_id, date, seq)')
+    db.execute('''
+        CREATE TRIGGER IF NOT EXISTS transactions_seq_insert AFTER INSERT ON transactions
+        WHEN NEW.seq IS NULL
+        BEGIN
+            UPDATE transactions SET seq = (SELECT IFNULL(MAX(seq), 0) + 1 FROM transactions)
+            WHERE rowid = NEW.rowid;
+        END
+    ''')
+
+
+def create_lot_triggers(db):
+    """
+    تریگرهای باطل‌سازی صف لات‌ها
+
+    تراکنش جدید بعد از آخرین تراکنش اعمال شده فقط pending را زیاد می‌کند
+    (sync_asset_lots آن را به‌صورت افزایشی اعمال می‌کند). ویرایش، حذف یا
+    تراکنش با تاریخ قبلی صف را حذف می‌کند تا در sync بعدی از ابتدا ساخته شود
+    """
+    db.execute('''
+        CREATE TRIGGER IF NOT EXISTS transactions_lots_insert AFTER INSERT ON transactions
+        BEGIN
+            DELETE FROM asset_lots WHERE asset_id = NEW.asset_id AND EXISTS (
+                SELECT 1 FROM asset_lot_state WHERE asset_id = NEW.asset_id AND NEW.date < last_date
+            );
+            DELETE FROM asset_lot_state WHERE asset_id = NEW.asset_id AND NEW.date < last_date;
+            UPDATE asset_lot_state SET pending = pending + 1 WHERE asset_id = NEW.asset_id;
+        END
+    ''')
+    db.execute('''
+        CREATE TRIGGER IF NOT EXISTS transactions_lots_update
+        AFTER UPDATE OF asset_id, type, quantity, price_per_unit, date ON transactions
+        BEGIN
+            DELETE FROM asset_lots WHERE asset_id IN (OLD.asset_id, NEW.asset_id);
+            DELETE FROM asset_lot_state WHERE asset_id IN (OLD.asset_id, NEW.asset_id);
+        END
+    ''')
+    db.execute('''
+        CREATE TRIGGER IF NOT EXISTS transactions_lots_delete AFTER DELETE ON transactions
+        BEGIN
+            DELETE FROM asset_lots WHERE asset_id = OLD.asset_id;
+            DELETE FROM asset_lot_state WHERE asset_id = OLD.asset_id;
+        END
+    ''')
+    db.execute('''
+        CREATE TRIGGER IF NOT EXISTS assets_lots_delete AFTER DELETE ON assets
+        BEGIN
+            DELETE FROM asset_lots WHERE asset_id = OLD.id;
+            DELETE FROM asset_lot_state WHERE asset_id = OLD.id;
+        END
+    ''')
+
+
+def create_user_version_triggers(db):
+    """
+    تریگرهای افزایش نسخه داده‌های کاربر (user_data_versions)
+    INSERT OR REPLACE روی chart_data با تریگر درج پوشش داده می‌شود
+    """
+    events = (
+        ('transactions', 'INSERT', 'NEW'), ('transactions', 'UPDATE', 'NEW'), ('transactions', 'DELETE', 'OLD'),
+        ('assets', 'INSERT', 'NEW'), ('assets', 'DELETE', 'OLD'),
+        ('chart_data', 'INSERT', 'NEW'), ('chart_data', 'UPDATE', 'NEW'), ('chart_data', 'DELETE', 'OLD'),
+        ('user_settings', 'INSERT', 'NEW'), ('user_settings', 'UPDATE', 'NEW'),
+    )
+    for table, event, row in events:
+        db.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_user_version_{event.lower()} AFTER {event} ON {table}
+            BEGIN
+                INSERT INTO user_data_versions (user_id, version) VALUES ({row}.user_id, 1)
+                    ON CONFLICT(user_id) DO UPDATE SET version = version + 1;
+            END
+        ''')
+
+
+def user_data_version(db, user_id):
+    """
+    نسخه فعلی داده‌های کاربر (۰ اگر هنوز تغییری ثبت نشده)
+    """
+    row = db.execute('SELECT version FROM user_data_versions WHERE user_id = ?', (user_id,)).fetchone()
+    return row[0] if row else 0
+
+
+def rebuild_asset_balances(db, user_id=None):
+    """
+    بازسازی کامل موجودی‌ها از روی تمام تراکنش‌ها (یک کوئری مجموعه‌ای)
+    """
+    where = 'WHERE user_id = ?' if user_id is not None else ''
+    params = (user_id,) if user_id is not None else ()
+    db.execute(f'DELETE FROM asset_balances WHERE asset_id IN (SELECT id FROM assets {where})', params)
+    db.execute(f'''
+        INSERT INTO asset_balances (asset_id, balance)
+        SELECT id, ROUND(COALESCE((
+            SELECT SUM({balance_delta_sql('t')}) FROM transactions t WHERE t.asset_id = assets.id
+        ), 0), 10)
+        FROM assets {where}
+    ''', params)
+
+
 # ============================================================
 #  بخش ۵: توابع کمکی (Helpers)
 # ============================================================
@@ -323,10 +762,442 @@ def read_json_file(file_path):
 
 def write_json_file(file_path, data):
     """
-    نوشتن داده در فایل JSON
+    نوشتن داده در فایل JSON به‌صورت اتمیک
+
+    خواننده‌های همزمان (مثل API عمومی) هیچ‌وقت فایل نیمه‌کاره نمی‌بینند.
+    اگر هش محتوای جدید با آخرین نسخه نوشته شده یکی باشد، نوشتن انجام نمی‌شود
+
+    Returns:
+        True در صورت نوشتن، False اگر محتوا تغییری نکرده باشد
+    """
+    content = json.dumps(data, indent=4, ensure_ascii=False).encode('utf-8')
+    digest = hashlib.blake2b(content, digest_size=16).digest()
+
+    previous = _written_hashes.get(file_path)
+    if previous is None and os.path.exists(file_path):
+        try:
+            with open(file_path, 'rb') as f:
+                previous = hashlib.blake2b(f.read(), digest_size=16).digest()
+        except OSError:
+            previous = None
+
+    if previous == digest:
+        return False
+
+    write_file_atomic(file_path, content)
+    _written_hashes[file_path] = digest
+    return True
+
+
+# هش آخرین محتوای نوشته شده در هر فایل JSON (برای حذف نوشتن‌های تکراری)
+_written_hashes = {}
+
+
+# umask پروسس یک‌بار هنگام import خوانده می‌شود (os.umask فقط با تغییر دادن قابل خواندن است
+# و تغییر موقت آن در حین اجرای threadها امن نیست)
+PROCESS_UMASK = os.umask(0)
+os.umask(PROCESS_UMASK)
+
+
+def file_mode_for(file_path):
+    """
+    مجوز فایل جایگزین: همان مجوز فایل فعلی، یا 0644 منهای umask برای فایل جدید
+    (mkstemp فایل موقت را 0600 می‌سازد)
+    """
+    try:
+        return os.stat(file_path).st_mode & 0o7777
+    except FileNotFoundError:
+        return 0o644 & ~PROCESS_UMASK
+
+
+def write_file_atomic(file_path, data):
+    """
+    نوشتن اتمیک فایل
+    داده ابتدا در فایل موقت کنار مقصد نوشته و fsync می‌شود، سپس با rename جایگزین
+    و خود پوشه fsync می‌شود تا rename هم پس از قطع برق باقی بماند
+    """
+    directory = os.path.dirname(os.path.abspath(file_path))
+    fd, temp_path = tempfile.mkstemp(
+        dir=directory, prefix=f'.{os.path.basename(file_path)}.', suffix='.tmp'
+    )
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            if hasattr(os, 'fchmod'):
+                os.fchmod(f.fileno(), file_mode_for(file_path))
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, file_path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+
+    try:
+        dir_fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        # پلتفرم‌هایی (ویندوز) که باز کردن پوشه را پشتیبانی نمی‌کنند
+        return
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+class SingleFlight:
+    """
+    ادغام فراخوانی‌های همزمان یک کار (Single-Flight)
+
+    برای هر کلید فقط یک اجرا در جریان است؛ فراخوانی‌های همزمان دیگر
+    به‌جای اجرای دوباره منتظر نتیجه همان اجرا می‌مانند.
+    فراخوانی با آرگومان‌های غیرپیش‌فرض (variant، مثلاً force=True) فقط به اجرای
+    با همان آرگومان‌ها می‌پیوندد؛ در غیر این صورت پس از پایان اجرای در جریان
+    خودش اجرا می‌شود (هرگز موازی با آن)
+    """
+
+    class Flight:
+        __slots__ = ('done', 'result', 'error', 'owner', 'variant')
+
+        def __init__(self, variant=()):
+            self.owner = None
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+            self.variant = variant
+
+        def wait(self, timeout=None):
+            """
+            انتظار برای پایان اجرا؛ در صورت تمام شدن مهلت False برمی‌گرداند
+            """
+            return self.done.wait(timeout)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def _join(self, key, variant=()):
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = self._flights[key] = self.Flight(variant)
+            return flight, True
+
+    def _run(self, key, flight, func):
+        flight.owner = threading.get_ident()
+        try:
+            flight.result = func()
+        except Exception as e:
+            flight.error = e
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+
+    def in_flight(self, key):
+        return key in self._flights
+
+    def do(self, key, func, variant=()):
+        """
+        اجرای func یا پیوستن به اجرای در جریان همین کلید و برگرداندن نتیجه آن
+
+        variant آرگومان‌های غیرپیش‌فرض فراخوانی است؛ فراخوانی پیش‌فرض (variant خالی)
+        به هر اجرایی می‌پیوندد ولی variant دیگر منتظر پایان اجرای در جریان می‌ماند و بعد اجرا می‌شود
+        """
+        while True:
+            flight, leader = self._join(key, variant)
+            if leader:
+                self._run(key, flight, func)
+                break
+            if flight.owner == threading.get_ident():
+                # فراخوانی تو در تو از داخل همان اجرا (مثلاً start با تابع wrap شده)
+                return func()
+            flight.wait()
+            if not variant or flight.variant == variant:
+                break
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def start(self, key, func):
+        """
+        شروع اجرا در ترد پس‌زمینه (یا پیوستن به اجرای در جریان)
+        Returns:
+            Flight برای انتظار با مهلت دلخواه
+        """
+        flight, leader = self._join(key)
+        if leader:
+            threading.Thread(target=self._run, args=(key, flight, func),
+                             name=f'flight-{key}', daemon=True).start()
+        return flight
+
+    def wrap(self, key):
+        """
+        دکوراتور: تمام فراخوانی‌های تابع از مسیر single-flight همین کلید عبور می‌کنند
+
+        کلید فقط نام کار است تا با start و in_flight یکی باشد؛ آرگومان‌های غیرپیش‌فرض
+        variant اجرا هستند (fetch_prices(force=True) موازی با دریافت عادی در جریان
+        اجرا نمی‌شود و پس از آن اجرا می‌شود). آرگومان‌ها باید قابل مقایسه باشند
+        """
+        def decorator(func):
+            signature = inspect.signature(func)
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                variant = tuple(
+                    (name, value) for name, value in signature.bind(*args, **kwargs).arguments.items()
+                    if value != signature.parameters[name].default
+                )
+                return self.do(key, lambda: func(*args, **kwargs), variant)
+            return wrapper
+        return decorator
+
+
+def iter_json_array(chunks):
+    """
+    پارس تدریجی (streaming) یک آرایه JSON از قطعه‌های بایتی
+
+    هر عضو آرایه به محض کامل شدن در بافر yield می‌شود؛ بنابراین کل پاسخ
+    هیچ‌وقت همزمان در حافظه نیست و پردازش با دریافت از شبکه همپوشانی دارد
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    position = 0
+    started = False
+
+    for chunk in chunks:
+        buffer = buffer[position:] + utf8.decode(chunk)
+        position = 0
+
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if position >= len(buffer):
+                break
+
+            if not started:
+                if buffer[position] != '[':
+                    raise ValueError('Expected a JSON array')
+                started = True
+                position += 1
+                continue
+
+            if buffer[position] == ']':
+                return
+
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                break  # عضو ناقص: منتظر قطعه بعدی
+
+            # عدد انتهای بافر ممکن است هنوز کامل نشده باشد
+            if end >= len(buffer) and buffer[position] not in '{["':
+                break
+
+            yield item
+            position = end
+
+    raise ValueError('Truncated JSON array')
+
+
+def fit_trend(xs, ys):
+    """
+    برازش کمترین مربعات y = a + b·x با فرم بسته (فقط جمع‌های ستونی، بدون حلقه تکراری)
+
+    Returns:
+        (a, b) یا None اگر کمتر از دو نقطه متمایز وجود داشته باشد
+    """
+    n = len(xs)
+    if n < 2:
+        return None
+    sum_x, sum_y = math.fsum(xs), math.fsum(ys)
+    sum_xx = math.fsum(map(operator.mul, xs, xs))
+    sum_xy = math.fsum(map(operator.mul, xs, ys))
+    denominator = n * sum_xx - sum_x * sum_x
+    if not denominator:
+        return None
+    slope = (n * sum_xy - sum_x * sum_y) / denominator
+    return (sum_y - slope * sum_x) / n, slope
+
+
+# ---------- حساب اعداد صحیح مقیاس‌شده (Fixed-Point) ----------
+
+def to_fixed(number, decimals):
+    """
+    تبدیل عدد اعشاری به عدد صحیح با مقیاس 10^decimals (گرد نیمه به بالا)
+
+    از نمایش کوتاه repr عدد (همان رشته decimal_text) ساخته می‌شود، نه از ضرب float؛
+    قیمت‌های بزرگ مثل 1.15e10 تومان با ۸ رقم اعشار رقم‌های خود را از دست نمی‌دهند
+    """
+    if not number:
+        return 0
+    text = repr(number)
+    if 'e' in text:
+        return fixed_from_str(text, decimals)
+    whole, _, fraction = text.partition('.')
+    sign = -1 if whole.startswith('-') else 1
+    value = int(whole.lstrip('-') + fraction[:decimals].ljust(decimals, '0'))
+    if fraction[decimals:decimals + 1] >= '5':
+        value += 1
+    return sign * value
+
+
+def fixed_div(numerator, denominator):
+    """
+    تقسیم صحیح با گرد کردن به نزدیک‌ترین (نیمه‌ها به سمت بالا، برای مقسوم‌علیه مثبت)
+    """
+    return (2 * numerator + denominator) // (2 * denominator)
+
+
+def fixed_rescale(value, decimals, target):
+    """
+    تغییر مقیاس یک عدد صحیح از 10^decimals به 10^target
+    """
+    if target >= decimals:
+        return value * 10 ** (target - decimals)
+    return fixed_div(value, 10 ** (decimals - target))
+
+
+def fixed_to_str(value, decimals):
+    """
+    نمایش دهدهی دقیق یک عدد صحیح مقیاس‌شده (صفرهای انتهایی اعشار حذف می‌شوند)
+    """
+    sign = '-' if value < 0 else ''
+    whole, fraction = divmod(abs(value), 10 ** decimals)
+    fraction = str(fraction).rjust(decimals, '0').rstrip('0') if decimals else ''
+    return f"{sign}{whole}.{fraction}" if fraction else f"{sign}{whole}"
+
+
+def fixed_from_str(text, decimals):
+    """
+    عکس fixed_to_str: رشته دهدهی به عدد صحیح با مقیاس 10^decimals
+    """
+    return int(decimal.Decimal(text).scaleb(decimals).to_integral_value(decimal.ROUND_HALF_UP))
+
+
+def decimal_text(number):
+    """
+    همان رشته str(Decimal(str(number))) بدون ساخت Decimal برای اعداد معمولی
+    (فقط نمایش‌های نمایی مثل 1e-05 از مسیر Decimal می‌گذرند)
+    """
+    text = repr(number)
+    return text if 'e' not in text else str(decimal.Decimal(text))
+
+
+def downsample_lttb(rows, threshold, value_key):
+    """
+    کاهش تعداد نقاط یک سری زمانی با الگوریتم LTTB
+    (Largest-Triangle-Three-Buckets)
+
+    نقطه اول و آخر همیشه حفظ می‌شوند و از هر سطل، نقطه‌ای انتخاب می‌شود
+    که بزرگ‌ترین مثلث را با نقطه انتخابی قبلی و میانگین سطل بعدی بسازد.
+    محور x شماره ردیف است (داده‌ها روزانه و مرتب هستند)
+    """
+    n = len(rows)
+    if threshold >= n or threshold < 3:
+        return list(rows)
+
+    values = [float(row[value_key] or 0) for row in rows]
+    sampled = [rows[0]]
+    bucket_size = (n - 2) / (threshold - 2)
+    a = 0
+
+    for i in range(threshold - 2):
+        # میانگین سطل بعدی
+        next_start = int((i + 1) * bucket_size) + 1
+        next_end = min(int((i + 2) * bucket_size) + 1, n)
+        next_count = next_end - next_start
+        avg_x = (next_start + next_end - 1) / 2
+        avg_y = sum(values[next_start:next_end]) / next_count
+
+        # انتخاب نقطه با بیشترین مساحت مثلث در سطل فعلی
+        start = int(i * bucket_size) + 1
+        end = int((i + 1) * bucket_size) + 1
+        ax, ay = a, values[a]
+        max_area = -1
+        chosen = start
+        for j in range(start, end):
+            area = abs((ax - avg_x) * (values[j] - ay) - (ax - j) * (avg_y - ay))
+            if area > max_area:
+                max_area = area
+                chosen = j
+
+        sampled.append(rows[chosen])
+        a = chosen
+
+    sampled.append(rows[-1])
+    return sampled
+
+
+def query_history(db, table, columns, user_id, value_key, ordered=True):
+    """
+    خواندن تاریخچه یک کاربر با فیلتر بازه، صفحه‌بندی و کاهش نقاط
+
+    پارامترهای Query String:
+    - from / to: بازه تاریخ (شامل دو سر)
+    - order: asc (پیش‌فرض) یا desc؛ با ordered=False نادیده گرفته می‌شود (پاسخ‌هایی
+      که ترتیب ندارند، مثل دیکشنری تاریخ ← ارزش که JSON کلیدهای آن را مرتب می‌کند)
+    - limit: حداکثر تعداد ردیف
+    - cursor: تاریخ آخرین ردیف صفحه قبل (صفحه‌بندی Keyset)
+    - max_points: حداکثر تعداد نقاط خروجی (کاهش با LTTB)
+
+    از ایندکس UNIQUE(user_id, date) جدول‌ها برای جستجوی بازه استفاده می‌شود
+
+    Returns:
+        (rows, next_cursor) - next_cursor در صورت نبود صفحه بعد None است
+    """
+    args = request.args
+    descending = ordered and args.get('order', 'asc').lower() == 'desc'
+
+    conditions = ['user_id = ?']
+    params = [user_id]
+
+    if args.get('from'):
+        conditions.append('date >= ?')
+        params.append(args['from'])
+    if args.get('to'):
+        conditions.append('date <= ?')
+        params.append(args['to'])
+    if args.get('cursor'):
+        conditions.append('date < ?' if descending else 'date > ?')
+        params.append(args['cursor'])
+
+    sql = (f'SELECT {columns} FROM {table} WHERE {" AND ".join(conditions)} '
+           f'ORDER BY date {"DESC" if descending else "ASC"}')
+
+    limit = args.get('limit', type=int)
+    if limit is not None:
+        limit = max(1, min(limit, HISTORY_MAX_LIMIT))
+        # یک ردیف اضافه برای تشخیص وجود صفحه بعد
+        sql += ' LIMIT ?'
+        params.append(limit + 1)
+
+    rows = db.execute(sql, params).fetchall()
+
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1]['date']
+
+    max_points = args.get('max_points', type=int)
+    if max_points:
+        rows = downsample_lttb(rows, min(max_points, HISTORY_MAX_POINTS), value_key)
+
+    return rows, next_cursor
+
+
+def history_response(payload, next_cursor):
+    """
+    ساخت پاسخ JSON تاریخچه
+    شکل بدنه پاسخ تغییر نمی‌کند و cursor صفحه بعد در هدر X-Next-Cursor ارسال می‌شود
     """
-    with open(file_path, 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=4, ensure_ascii=False)
+    resp = jsonify(payload)
+    if next_cursor:
+        resp.headers['X-Next-Cursor'] = next_cursor
+    return resp
 
 
 def hash_password(password):
@@ -469,606 +1340,2957 @@ def get_rate_limit_status(api_key):
 #  بخش ۸: توابع دریافت قیمت‌ها
 # ============================================================
 
-def fetch_tsetmc_data():
-    """
-    دریافت داده‌های بورس تهران از API
+# ---------- جدول فشرده قیمت‌ها ----------
 
-    قیمت‌ها را اصلاح (حذف رقم آخر) و پردازش می‌کند
-    Returns:
-        لیست نمادهای بورس یا None در صورت خطا
+class PriceTable:
     """
-    try:
-        print("📈 Fetching TSE data...")
-        response = requests.get(API_TSETMC, headers=API_HEADERS, timeout=30)
+    نگهداری فشرده قیمت‌های تمام دسته‌ها
 
-        if response.status_code != 200:
-            print(f"❌ خطای API بورس: {response.status_code}")
-            return None
+    به‌جای یک dict برای هر نماد:
+    - فیلدهای عددی در آرایه‌های موازی array('d') ذخیره می‌شوند
+    - رشته‌ها (عنوان، نام، زمان بروزرسانی) intern می‌شوند تا تکراری‌ها یک نسخه داشته باشند
+    - ایندکس نماد ← شماره ردیف برای جستجوی O(1)
 
-        data = response.json()
-        processed_data = []
+    ساختار JSON قبلی (دیکشنری هر نماد) فقط در لبه خروجی با item/to_categorized ساخته می‌شود
+    """
 
-        for item in data:
-            if 'l18' not in item or 'pl' not in item:
+    TEXT_FIELDS = ('symbol', 'title', 'name', 'last_update')
+    NUMERIC_FIELDS = ('price', 'toman_price', 'usd_price', 'change_value', 'change_percent')
+
+    # چیدمان کلیدهای هر ردیف (ترتیب کلید و نوع مقدار) بین ردیف‌ها مشترک است
+    _layouts = {}
+
+    __slots__ = ('text', 'numeric', 'layouts', 'extras', 'index', 'category_rows')
+
+    def __init__(self):
+        self.text = {field: [] for field in self.TEXT_FIELDS}
+        self.numeric = {field: array('d') for field in self.NUMERIC_FIELDS}
+        self.layouts = []
+        self.extras = {}
+        self.index = {}
+        self.category_rows = {}
+
+    @classmethod
+    def from_categorized(cls, categorized):
+        """
+        ساخت جدول از ساختار دسته‌بندی شده {category: [items]}
+        """
+        table = cls()
+        for category, items in categorized.items():
+            if not isinstance(items, list):
                 continue
-
-            symbol_name = item.get('l18', '').strip()
-            company_name = item.get('l30', symbol_name).strip()
-            raw_price = item.get('pl', 0)
-            raw_change = item.get('plc', 0)
-
-            try:
-                change_percent = float(item.get('plp', 0)) if item.get('plp') else 0
-            except (ValueError, TypeError):
-                change_percent = 0
-
-            # اصلاح قیمت: حذف رقم آخر
-            if raw_price and str(raw_price).replace('-', '').replace('.', '').isdigit():
-                price_str = str(abs(int(float(raw_price))))
-                adjusted_price = int(price_str[:-1]) if len(price_str) > 1 else 0
-                if float(raw_price) < 0:
-                    adjusted_price = -adjusted_price
+            start = len(table.layouts)
+            for item in items:
+                table._append(item)
+            table.category_rows[sys.intern(category)] = range(start, len(table.layouts))
+        return table
+
+    def _append(self, item):
+        row = len(self.layouts)
+        layout = []
+
+        for field in self.TEXT_FIELDS:
+            value = item.get(field)
+            if field not in item:
+                self.text[field].append('')
+                continue
+            if isinstance(value, str):
+                self.text[field].append(sys.intern(value))
+                layout.append((field, 's'))
+            elif value is None:
+                self.text[field].append('')
+                layout.append((field, 'n'))
             else:
-                adjusted_price = 0
-
-            # اصلاح مقدار تغییر
-            if raw_change and str(raw_change).replace('-', '').replace('.', '').isdigit():
-                change_str = str(abs(int(float(raw_change))))
-                adjusted_change = int(change_str[:-1]) if len(change_str) > 1 else 0
-                if float(raw_change) < 0:
-                    adjusted_change = -adjusted_change
+                self.text[field].append('')
+                self.extras[(row, field)] = value
+                layout.append((field, 'r'))
+
+        for field in self.NUMERIC_FIELDS:
+            value = item.get(field)
+            if field not in item:
+                self.numeric[field].append(math.nan)
+                continue
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                self.numeric[field].append(math.nan)
+                if value is None:
+                    layout.append((field, 'n'))
+                else:
+                    self.extras[(row, field)] = value
+                    layout.append((field, 'r'))
             else:
-                adjusted_change = 0
-
-            processed_data.append({
-                'symbol': symbol_name,
-                'title': company_name,
-                'name': company_name,
-                'price': adjusted_price,
-                'toman_price': adjusted_price,
-                'change_value': adjusted_change,
-                'change_percent': change_percent,
-                'last_update': datetime.now().strftime('%Y-%m-%d %H:%M')
-            })
+                self.numeric[field].append(float(value))
+                layout.append((field, 'i' if isinstance(value, int) else 'f'))
 
-        processed_data.sort(key=lambda x: x['symbol'])
-        print(f"✅ TSE data processed: {len(processed_data)} symbols")
-        return processed_data
+        # کلیدهای ناشناخته به‌صورت خام نگهداری می‌شوند
+        for field, value in item.items():
+            if field not in self.TEXT_FIELDS and field not in self.NUMERIC_FIELDS:
+                self.extras[(row, field)] = value
+                layout.append((field, 'r'))
 
-    except Exception as e:
-        print(f"❌ خطا در پردازش داده‌های بورس: {e}")
-        return None
+        # حفظ ترتیب اصلی کلیدها
+        order = {field: position for position, field in enumerate(item)}
+        layout.sort(key=lambda entry: order[entry[0]])
+        layout = tuple(layout)
+        self.layouts.append(self._layouts.setdefault(layout, layout))
 
+        self.index[self.text['symbol'][row] or item.get('symbol')] = row
 
-def update_tsetmc_prices():
-    """
-    بروزرسانی قیمت‌های بورس در کش
-    در صورت خطا از داده‌های ذخیره شده قبلی استفاده می‌کند
-    """
-    global current_prices
+    def __len__(self):
+        return len(self.layouts)
 
-    try:
-        new_data = fetch_tsetmc_data()
+    def __contains__(self, symbol):
+        return symbol in self.index
 
-        if new_data:
-            if 'categorized' not in current_prices:
-                current_prices['categorized'] = {}
-            current_prices['categorized']['stock'] = new_data
+    def categories(self):
+        return list(self.category_rows)
 
-            # ثبت تک‌تک نمادهای بورس در current_prices
-            for item in new_data:
-                current_prices[item['symbol']] = item['toman_price']
+    def category_of(self, row):
+        for category, rows in self.category_rows.items():
+            if row in rows:
+                return category
+        return None
 
-            # ذخیره در فایل کش
-            write_json_file(TSETMC_FILE, new_data)
+    def row_of(self, symbol):
+        return self.index.get(symbol)
+
+    def value(self, row, field):
+        """
+        خواندن یک فیلد از یک ردیف (بدون ساخت dict)
+        """
+        if field in self.numeric:
+            number = self.numeric[field][row]
+            return None if math.isnan(number) else number
+        if field in self.text:
+            return self.text[field][row]
+        return self.extras.get((row, field))
+
+    def toman_price(self, symbol, default=0):
+        """
+        قیمت تومانی یک نماد (در نبود toman_price از price استفاده می‌شود)
+        """
+        row = self.index.get(symbol)
+        if row is None:
+            return default
+        for field in ('toman_price', 'price'):
+            number = self.numeric[field][row]
+            if not math.isnan(number):
+                return number
+        return default
+
+    def title(self, symbol):
+        row = self.index.get(symbol)
+        if row is None:
+            return None
+        return self.text['title'][row] or self.text['name'][row] or None
+
+    def item(self, row, fields=None):
+        """
+        ساخت دیکشنری یک ردیف با همان ساختار JSON قبلی
+        fields: فقط همین کلیدها (projection)؛ None = همه
+        """
+        result = {}
+        for field, kind in self.layouts[row]:
+            if fields is not None and field not in fields:
+                continue
+            if kind == 's':
+                result[field] = self.text[field][row]
+            elif kind == 'i':
+                result[field] = int(self.numeric[field][row])
+            elif kind == 'f':
+                result[field] = self.numeric[field][row]
+            elif kind == 'n':
+                result[field] = None
+            else:
+                result[field] = self.extras[(row, field)]
+        return result
+
+    def category(self, category):
+        """
+        لیست آیتم‌های یک دسته با ساختار JSON قبلی
+        """
+        return [self.item(row) for row in self.category_rows.get(category, ())]
+
+    def to_categorized(self):
+        return {category: self.category(category) for category in self.category_rows}
+
+    def market_summary(self, top=MARKET_SUMMARY_TOP):
+        """
+        خلاصه هر دسته بر اساس change_percent: گسترش بازار (تعداد مثبت/منفی/بدون
+        تغییر، میانگین تغییر) و فهرست‌های بیشترین رشد، افت و قدر مطلق تغییر
+
+        آیتم‌های فهرست‌ها فشرده‌اند (symbol, title, toman_price, change_percent)
+        """
+        changes = self.numeric['change_percent']
+        summary = {}
+
+        for category, rows in self.category_rows.items():
+            rows = [row for row in rows if not math.isnan(changes[row])]
+            advancing = sum(1 for row in rows if changes[row] > 0)
+            declining = sum(1 for row in rows if changes[row] < 0)
+
+            summary[category] = {
+                'count': len(self.category_rows[category]),
+                'advancing': advancing,
+                'declining': declining,
+                'unchanged': len(rows) - advancing - declining,
+                'average_change_percent': (
+                    round(math.fsum(changes[row] for row in rows) / len(rows), 2) if rows else None
+                ),
+                'top_gainers': [self._summary_item(row) for row in
+                                heapq.nlargest(top, (row for row in rows if changes[row] > 0),
+                                               key=changes.__getitem__)],
+                'top_losers': [self._summary_item(row) for row in
+                               heapq.nsmallest(top, (row for row in rows if changes[row] < 0),
+                                               key=changes.__getitem__)],
+                'most_changed': [self._summary_item(row) for row in
+                                 heapq.nlargest(top, rows, key=lambda row: abs(changes[row]))]
+            }
+        return summary
+
+    def _summary_item(self, row):
+        return {
+            'symbol': self.text['symbol'][row],
+            'title': self.text['title'][row] or self.text['name'][row] or self.text['symbol'][row],
+            'toman_price': self.value(row, 'toman_price') or self.value(row, 'price'),
+            'change_percent': self.numeric['change_percent'][row]
+        }
 
-            # بروزرسانی فایل اصلی قیمت‌ها
-            prices = read_json_file(PRICES_FILE)
-            if prices:
-                prices['stock'] = new_data
-                write_json_file(PRICES_FILE, prices)
+    def with_category(self, category, items):
+        """
+        ساخت جدول جدید با جایگزینی یک دسته (جدول فعلی تغییر نمی‌کند)
+        """
+        categorized = {name: self.category(name) for name in self.category_rows if name != category}
+        categorized[category] = items
+        return PriceTable.from_categorized(categorized)
+
+    # ---------- فرمت باینری (برای حافظه مشترک و کش دیسک) ----------
+    #
+    # [هدر] magic, version, rows, meta_len, strings_count, strings_len
+    # [ستون‌های عددی] float64 × rows برای هر فیلد عددی (هم‌تراز ۸ بایت)
+    # [ستون‌های متنی] uint32 × rows برای هر فیلد متنی (اندیس جدول رشته‌ها)
+    # [چیدمان ردیف‌ها] uint32 × rows
+    # [متا] JSON شامل چیدمان‌ها، بازه دسته‌ها، مقادیر خام و متای دلخواه
+    # [جدول رشته‌ها] آفست‌های uint32 و بلاک UTF-8
+    #
+    # ترتیب بایت‌ها little-endian است (تمام پلتفرم‌های هدف)
+
+    BINARY_MAGIC = b'APTB'
+    BINARY_VERSION = 1
+    _BINARY_HEADER = struct.Struct('<4sHHIIII')
+
+    def to_bytes(self, meta=None):
+        """
+        سریال‌سازی جدول به فرمت باینری با جدول رشته‌ها
+        """
+        rows = len(self)
+        strings = []
+        string_ids = {}
+
+        def string_id(value):
+            if value not in string_ids:
+                string_ids[value] = len(strings)
+                strings.append(value)
+            return string_ids[value]
+
+        text_columns = array('I')
+        for field in self.TEXT_FIELDS:
+            text_columns.extend(string_id(value) for value in self.text[field])
+
+        layout_ids = {}
+        layout_list = []
+        row_layouts = array('I')
+        for layout in self.layouts:
+            if layout not in layout_ids:
+                layout_ids[layout] = len(layout_list)
+                layout_list.append(layout)
+            row_layouts.append(layout_ids[layout])
+
+        meta_blob = json.dumps({
+            'layouts': layout_list,
+            'categories': [[name, rng.start, rng.stop] for name, rng in self.category_rows.items()],
+            'extras': [[row, field, value] for (row, field), value in self.extras.items()],
+            'meta': meta or {}
+        }, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        meta_blob += b' ' * (-len(meta_blob) % 4)
+
+        encoded = [value.encode('utf-8') for value in strings]
+        offsets = array('I', [0])
+        for chunk in encoded:
+            offsets.append(offsets[-1] + len(chunk))
+        strings_blob = b''.join(encoded)
+
+        numeric = b''.join(bytes(self.numeric[field]) for field in self.NUMERIC_FIELDS)
+
+        return b''.join((
+            self._BINARY_HEADER.pack(self.BINARY_MAGIC, self.BINARY_VERSION, 0, rows,
+                                     len(meta_blob), len(strings), len(strings_blob)),
+            numeric,
+            text_columns.tobytes(),
+            row_layouts.tobytes(),
+            meta_blob,
+            offsets.tobytes(),
+            strings_blob
+        ))
 
-            print(f"✅ Stock prices updated: {len(new_data)} symbol")
-            return True
-        else:
-            # استفاده از داده‌های کش شده
-            cached_data = read_json_file(TSETMC_FILE)
-            if cached_data:
-                if 'categorized' not in current_prices:
-                    current_prices['categorized'] = {}
-                current_prices['categorized']['stock'] = cached_data
+    @classmethod
+    def from_buffer(cls, buffer, copy=False):
+        """
+        بازسازی جدول از فرمت باینری
+
+        ستون‌های عددی بدون کپی به‌صورت memoryview روی بافر (مثلاً mmap) ساخته می‌شوند.
+        با copy=True ستون‌ها در array('d') کپی می‌شوند؛ برای بافرهایی که بعداً
+        بازنویسی می‌شوند (اسلات‌های حافظه مشترک) لازم است
+        Returns:
+            (table, meta)
+        """
+        view = memoryview(buffer)
+        magic, version, _, rows, meta_len, strings_count, strings_len = \
+            cls._BINARY_HEADER.unpack_from(view, 0)
+        if magic != cls.BINARY_MAGIC or version != cls.BINARY_VERSION:
+            raise ValueError('Unsupported price table format')
+
+        table = cls()
+        offset = cls._BINARY_HEADER.size
+
+        for field in cls.NUMERIC_FIELDS:
+            column = view[offset:offset + rows * 8].cast('d')
+            table.numeric[field] = array('d', column) if copy else column
+            offset += rows * 8
+
+        text_ids = view[offset:offset + len(cls.TEXT_FIELDS) * rows * 4].cast('I')
+        offset += len(cls.TEXT_FIELDS) * rows * 4
+        row_layouts = view[offset:offset + rows * 4].cast('I')
+        offset += rows * 4
+
+        payload = json.loads(bytes(view[offset:offset + meta_len]).decode('utf-8'))
+        offset += meta_len
+
+        offsets = view[offset:offset + (strings_count + 1) * 4].cast('I')
+        offset += (strings_count + 1) * 4
+        blob = bytes(view[offset:offset + strings_len])
+        strings = [sys.intern(blob[offsets[i]:offsets[i + 1]].decode('utf-8'))
+                   for i in range(strings_count)]
+
+        for position, field in enumerate(cls.TEXT_FIELDS):
+            base = position * rows
+            table.text[field] = [strings[text_ids[base + row]] for row in range(rows)]
+
+        layouts = []
+        for layout in payload['layouts']:
+            layout = tuple((field, kind) for field, kind in layout)
+            layouts.append(cls._layouts.setdefault(layout, layout))
+        table.layouts = [layouts[layout_id] for layout_id in row_layouts]
+
+        table.category_rows = {
+            sys.intern(name): range(start, stop) for name, start, stop in payload['categories']
+        }
+        table.extras = {(row, field): value for row, field, value in payload['extras']}
 
-                # برای کش هم نمادها رو ثبت کن
-                for item in cached_data:
-                    current_prices[item['symbol']] = item['toman_price']
+        symbols = table.text['symbol']
+        for row in range(rows):
+            table.index[symbols[row]] = row
 
-                print(f"⚠️ Using cached stock data: {len(cached_data)} symbol")
-            return False
+        return table, payload['meta']
 
-    except Exception as e:
-        print(f"❌ Error updating stock prices: {e}")
-        return False
-def fetch_prices():
-    """
-    دریافت قیمت‌های لحظه‌ای از API اصلی
 
-    قیمت‌های طلا، ارز و رمزارز را دریافت و پردازش می‌کند
-    در صورت وجود کش معتبر، از آن استفاده می‌کند
+class PriceSnapshot:
     """
-    global current_prices
+    نمای تغییرناپذیر وضعیت قیمت‌ها (جدول + متادیتا)
 
-    # بررسی اعتبار کش
-    last_updated = current_prices.get('last_updated')
-    if last_updated:
-        try:
-            last_time = datetime.fromisoformat(last_updated)
-            elapsed_minutes = (datetime.now(timezone.utc) - last_time).total_seconds() / 60
-            if elapsed_minutes < PRICE_CACHE_MINUTES:
-                print(f"🔄 Using price cache ({(PRICE_CACHE_MINUTES - elapsed_minutes):.1f} minutes until update)")
-                return
-        except Exception:
-            pass
+    نویسنده‌ها (زمان‌بند، SWR، همگام‌سازی) هر بار snapshot جدیدی می‌سازند و
+    با جایگزینی اتمی مرجع current_prices منتشر می‌کنند؛ خواننده‌ها بدون قفل
+    یک مرجع برمی‌دارند و هیچ‌وقت دسته‌های نیمه‌بروزشده نمی‌بینند
+    """
 
-    try:
-        print("📡 Fetching prices from API...")
-        response = requests.get(API_GOLD_CURRENCY, headers=API_HEADERS, timeout=15)
+    __slots__ = ('table', 'last_updated', 'api_error', 'freshness', 'version', 'summary',
+                 '_categorized', '_orders', '_etag')
+
+    FIELDS = ('table', 'last_updated', 'api_error', 'freshness', 'summary')
+
+    def __init__(self, table, last_updated=None, api_error=None, freshness=None, version=0, summary=None):
+        init = object.__setattr__
+        init(self, 'table', table)
+        # خلاصه بازار هنگام انتشار محاسبه می‌شود تا درخواست‌ها فقط آن را بخوانند
+        init(self, 'summary', summary if summary is not None else table.market_summary())
+        init(self, 'last_updated', last_updated)
+        init(self, 'api_error', api_error)
+        # {category: {'updated_at': ts, 'source': 'live'|'cache'}} - فقط خواندنی
+        init(self, 'freshness', freshness or {})
+        init(self, 'version', version)
+        init(self, '_categorized', None)
+        init(self, '_orders', {})
+        init(self, '_etag', None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('PriceSnapshot is immutable; use publish_prices()')
+
+    def replace(self, **changes):
+        """
+        snapshot جدید با تغییرات داده شده و نسخه بعدی
+        """
+        fields = {name: getattr(self, name) for name in self.FIELDS}
+        if changes.get('table', self.table) is not self.table:
+            fields['summary'] = None
+        fields.update(changes)
+        return PriceSnapshot(version=self.version + 1, **fields)
+
+    def categorized(self):
+        """
+        خروجی دسته‌بندی شده جدول؛ یک‌بار برای هر snapshot ساخته و بین
+        درخواست‌ها به اشتراک گذاشته می‌شود (نباید تغییر داده شود)
+        """
+        if self._categorized is None:
+            object.__setattr__(self, '_categorized', self.table.to_categorized())
+        return self._categorized
+
+    @property
+    def etag(self):
+        """
+        شناسه محتوای snapshot برای ETag پاسخ‌ها
+
+        version فقط داخل یک پروسس یکتاست؛ شناسه از زمان داده دسته‌ها ساخته
+        می‌شود تا در تمام workerها برای داده یکسان، یکسان باشد
+        """
+        if self._etag is None:
+            identity = json.dumps([self.last_updated, self.api_error, self.freshness], sort_keys=True)
+            object.__setattr__(self, '_etag', hashlib.blake2b(identity.encode(), digest_size=8).hexdigest())
+        return self._etag
+
+    def sorted_rows(self, field, descending=False):
+        """
+        ترتیب ردیف‌های کل جدول بر اساس یک فیلد (ایندکس یک‌بار برای هر snapshot
+        ساخته می‌شود)؛ ردیف‌های بدون مقدار در هر دو جهت در انتها می‌آیند
+        """
+        if field not in self._orders:
+            table = self.table
+            if field in table.numeric:
+                column = table.numeric[field]
+                filled = [row for row in range(len(table)) if not math.isnan(column[row])]
+            else:
+                column = table.text[field]
+                filled = [row for row in range(len(table)) if column[row]]
+            filled.sort(key=column.__getitem__)
+            present = set(filled)
+            self._orders[field] = (filled, [row for row in range(len(table)) if row not in present])
 
-        if response.status_code != 200:
-            print(f"⚠️ خطای API اصلی: {response.status_code}")
-            load_cached_prices()
-            return
+        filled, empty = self._orders[field]
+        return (filled[::-1] if descending else filled) + empty
 
-        data = response.json()
-        processed_prices = {"gold_coin": [], "currency": [], "crypto": []}
 
-        # ---------- پیدا کردن قیمت تتر برای تبدیلات ----------
-        usdt_price = None
-        for item in data.get('currency', []):
-            if item['symbol'] == 'USDT_IRT':
-                usdt_price = float(item['price'])
-                break
+current_prices = PriceSnapshot(PriceTable())
 
-        if not usdt_price:
-            usdt_price = current_prices.get('USDT', 160000)
+# سریال کردن read-modify-write نویسنده‌ها؛ خواننده‌ها قفل نمی‌گیرند
+prices_write_lock = threading.RLock()
 
-        # ---------- پردازش طلا و سکه ----------
-        for item in data.get('gold', []):
-            if item['symbol'] not in ASSET_TYPES['gold_coin']:
-                continue
 
-            try:
-                price = float(item['price'])
-                if item['symbol'] == 'XAUUSD' or item.get('unit') == 'دلار':
-                    price_in_toman = price * usdt_price
-                    usd_price_val = price
-                else:
-                    price_in_toman = price
-                    usd_price_val = price / usdt_price
+def publish_prices(**changes):
+    """
+    ساخت snapshot جدید از snapshot فعلی و جایگزینی اتمی مرجع سراسری
 
-                processed_prices['gold_coin'].append({
-                    'symbol': item['symbol'],
-                    'title': item['name'],
-                    'price': price_in_toman,
-                    'toman_price': price_in_toman,
-                    'usd_price': usd_price_val,
-                    'last_update': f"{item.get('date', '')} {item.get('time', '')}".strip(),
-                    'change_value': item.get('change_value'),
-                    'change_percent': item.get('change_percent')
-                })
-                current_prices[item['symbol']] = price_in_toman
-            except Exception as e:
-                print(f"⚠️ Error processing gold {item['symbol']}: {e}")
+    نویسنده‌ای که مقدار جدید را از snapshot فعلی می‌سازد (مثلاً with_category
+    یا freshness_with) باید کل محاسبه را داخل prices_write_lock انجام دهد
+    """
+    global current_prices
+    with prices_write_lock:
+        current_prices = current_prices.replace(**changes)
+        return current_prices
 
-        # ---------- پردازش ارزها ----------
-        for item in data.get('currency', []):
-            if item['symbol'] not in ASSET_TYPES['currency']:
-                continue
 
-            try:
-                price = float(item['price'])
-                processed_prices['currency'].append({
-                    'symbol': item['symbol'],
-                    'title': item['name'],
-                    'price': price,
-                    'toman_price': price,
-                    'usd_price': price / usdt_price if item['symbol'] != 'USDT_IRT' else 1.0,
-                    'last_update': f"{item.get('date', '')} {item.get('time', '')}".strip(),
-                    'change_value': item.get('change_value'),
-                    'change_percent': item.get('change_percent')
-                })
-                current_prices[item['symbol']] = price
+def save_price_snapshot():
+    """
+    ذخیره جدول قیمت فعلی در کش باینری (نوشتن اتمیک)
+    """
+    prices = current_prices
+    try:
+        payload = prices.table.to_bytes({
+            'last_updated': prices.last_updated,
+            'freshness': prices.freshness
+        })
+        write_file_atomic(PRICES_SNAPSHOT_FILE, payload)
+    except OSError as e:
+        print(f"❌ Error saving price snapshot: {e}")
 
-                # ذخیره قیمت‌های کلیدی
-                if item['symbol'] == 'USD':
-                    current_prices['USD'] = price
-                elif item['symbol'] == 'USDT_IRT':
-                    current_prices['usdt_price'] = price
-            except Exception as e:
-                print(f"⚠️ Error processing currency {item['symbol']}: {e}")
 
-        # ---------- پردازش رمزارزها ----------
-        for item in data.get('cryptocurrency', []):
-            if item['symbol'] not in ASSET_TYPES['crypto']:
-                continue
+def read_price_snapshot():
+    """
+    خواندن کش باینری قیمت‌ها با mmap (ستون‌های عددی بدون کپی)
 
-            try:
-                price_str = str(item['price']).replace(',', '')
-                price = float(price_str)
-                price_in_toman = price * usdt_price
+    Returns:
+        (table, meta) یا None در صورت نبود/خرابی فایل
+    """
+    if not os.path.exists(PRICES_SNAPSHOT_FILE):
+        return None
+    try:
+        with open(PRICES_SNAPSHOT_FILE, 'rb') as f:
+            if os.name == 'nt':
+                # در ویندوز فایل mmap شده قابل جایگزینی با rename نیست
+                buffer = f.read()
+            else:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return PriceTable.from_buffer(buffer)
+    except (OSError, ValueError, struct.error) as e:
+        print(f"⚠️ Price snapshot unreadable: {e}")
+        return None
 
-                processed_prices['crypto'].append({
-                    'symbol': item['symbol'],
-                    'title': item['name'],
-                    'price': price_in_toman,
-                    'toman_price': price_in_toman,
-                    'usd_price': price,
-                    'last_update': f"{item.get('date', '')} {item.get('time', '')}".strip(),
-                    'change_percent': item.get('change_percent')
-                })
-                current_prices[item['symbol']] = price_in_toman
-            except Exception as e:
-                print(f"⚠️ Error processing crypto {item['symbol']}: {e}")
 
-        # ---------- مرتب‌سازی و ذخیره ----------
-        for category in processed_prices:
-            processed_prices[category].sort(key=lambda x: x['symbol'])
+def get_symbol_price(symbol, default=0):
+    """
+    قیمت تومانی فعلی یک نماد از جدول قیمت‌ها
+    """
+    return current_prices.table.toman_price(symbol, default)
 
-        # اضافه کردن داده‌های بورس
-        if 'stock' in current_prices.get('categorized', {}):
-            processed_prices['stock'] = current_prices['categorized']['stock']
-        else:
-            stock_data = read_json_file(TSETMC_FILE)
-            if stock_data:
-                processed_prices['stock'] = stock_data
 
-        current_prices['categorized'] = processed_prices
-        current_prices['last_updated'] = datetime.now(timezone.utc).isoformat()
-        current_prices.pop('api_error', None)
+# ---------- تازگی قیمت‌ها (Stale-While-Revalidate) ----------
 
-        write_json_file(PRICES_FILE, processed_prices)
-        print(f"✅ Prices were successfully updated.")
+# زمان آخرین تلاش دریافت هر منبع (برای فاصله تلاش مجدد پس از خطا)
+price_refresh_attempts = {}
 
-    except Exception as e:
-        print(f"❌ خطا در دریافت قیمت‌ها: {e}")
-        load_cached_prices()
+# دریافت‌های همزمان هر منبع (درخواست‌ها، زمان‌بند، warm-up) در یک اجرا ادغام می‌شوند
+price_flights = SingleFlight()
 
 
-def load_cached_prices():
+def freshness_with(categories, source, updated_at=None):
     """
-    لود قیمت‌ها از فایل کش در صورت خطا در API
+    نقشه تازگی جدید با ثبت زمان واقعی داده هر دسته و منبع آن (live یا cache)
+    باید داخل prices_write_lock همراه با publish_prices فراخوانی شود
     """
-    global current_prices
+    freshness = dict(current_prices.freshness)
+    for category in categories:
+        freshness[category] = {'updated_at': updated_at or time.time(), 'source': source}
+    return freshness
 
-    try:
-        cached = read_json_file(PRICES_FILE)
-        if cached:
-            current_prices['categorized'] = cached
-            current_prices['last_updated'] = datetime.now(timezone.utc).isoformat()
-            current_prices['api_error'] = "Using cached prices"
-
-            for category_data in cached.values():
-                if isinstance(category_data, list):
-                    for item in category_data:
-                        current_prices[item['symbol']] = item.get('toman_price', item.get('price', 0))
-
-            print("⚠️ Cached prices loaded")
-    except Exception as e:
-        print(f"❌ Error loading price cache: {e}")
 
-# ============================================================
-#  بخش ۹: توابع محاسبات پورتفوی
-# ============================================================
+def is_price_stale(category, prices=None):
+    """
+    داده دسته قدیمی‌تر از مدت اعتبارش است (یا اصلاً وجود ندارد)؟
+    """
+    entry = (prices or current_prices).freshness.get(category)
+    if not entry:
+        return True
+    return time.time() - entry['updated_at'] > PRICE_TTL_SECONDS.get(category, PRICE_CACHE_MINUTES * 60)
 
-def aggregate_assets(user_id):
+
+def price_freshness(prices=None):
     """
-    محاسبه اطلاعات تجمیعی دارایی‌های یک کاربر
+    سن واقعی و وضعیت تازگی هر دسته برای پاسخ‌های API
+    """
+    prices = prices or current_prices
+    now = time.time()
+    result = {}
+    for category, entry in prices.freshness.items():
+        result[category] = {
+            'last_updated': datetime.fromtimestamp(entry['updated_at'], timezone.utc).isoformat(),
+            'age_seconds': int(now - entry['updated_at']),
+            'source': entry['source'],
+            'stale': is_price_stale(category, prices)
+        }
+    return result
+
 
-    تمام تراکنش‌ها را پردازش کرده و موجودی، قیمت سر به سر،
-    ارزش فعلی و سود/زیان هر دارایی را محاسبه می‌کند
+def refresh_in_background(source, func):
     """
-    db = get_db()
+    اجرای بروزرسانی در ترد پس‌زمینه؛ اگر بروزرسانی همین منبع در جریان باشد
+    یا تلاش قبلی به‌تازگی شکست خورده باشد، درخواست جدیدی ساخته نمی‌شود
+    """
+    if price_flights.in_flight(source):
+        return False
+    if time.time() - price_refresh_attempts.get(source, 0) < PRICE_RETRY_SECONDS:
+        return False
 
-    assets = db.execute(
-        'SELECT * FROM assets WHERE user_id = ? ORDER BY symbol',
-        (user_id,)
-    ).fetchall()
+    # func خودش از مسیر single-flight همین منبع عبور می‌کند
+    threading.Thread(target=func, name=f'refresh-{source}', daemon=True).start()
+    return True
 
-    aggregated = []
 
-    for asset in assets:
-        transactions = db.execute(
-            'SELECT * FROM transactions WHERE asset_id = ? ORDER BY date',
-            (asset['id'],)
-        ).fetchall()
+def ensure_prices():
+    """
+    SWR: آخرین قیمت‌های معتبر فوراً سرویس داده می‌شوند و دسته‌های قدیمی
+    در پس‌زمینه بروزرسانی می‌شوند
 
-        # متغیرهای محاسباتی با decimal برای دقت بالا
-        total_quantity = decimal.Decimal('0')
-        total_cost = decimal.Decimal('0')
-        buy_quantity_sum = decimal.Decimal('0')
-        buy_cost_sum = decimal.Decimal('0')
+    در شروع سرد (جدول خالی) همه درخواست‌های همزمان منتظر یک دریافت مشترک
+    می‌مانند و پس از PRICE_COLD_WAIT_SECONDS از کش دیسک استفاده می‌کنند
+    """
+    if not len(current_prices.table):
+        flight = price_flights.start('gold_currency', fetch_prices)
+        if not flight.wait(PRICE_COLD_WAIT_SECONDS) or not len(current_prices.table):
+            load_cached_prices()
 
-        processed_transactions = []
+    if any(is_price_stale(category) for category in GOLD_CURRENCY_CATEGORIES):
+        refresh_in_background('gold_currency', fetch_prices)
+    if is_price_stale('stock'):
+        refresh_in_background('tsetmc', update_tsetmc_prices)
 
-        for tx in transactions:
-            tx_type = tx['type']
-            tx_quantity = decimal.Decimal(str(tx['quantity']))
 
-            if tx_type in ['buy', 'sell', 'save_profit']:
-                tx_price = decimal.Decimal(str(tx['price_per_unit']))
-                tx_cost = tx_quantity * tx_price
-            else:
-                tx_price = decimal.Decimal('0')
-                tx_cost = decimal.Decimal('0')
-
-            # ---------- محاسبه تأثیر هر نوع تراکنش ----------
-            if tx_type == 'buy':
-                total_quantity += tx_quantity
-                total_cost += tx_cost
-                buy_quantity_sum += tx_quantity
-                buy_cost_sum += tx_cost
-            elif tx_type == 'sell':
-                if buy_quantity_sum > 0:
-                    cost_basis_reduction = (tx_quantity / buy_quantity_sum) * buy_cost_sum
-                    buy_cost_sum -= cost_basis_reduction
-                buy_quantity_sum -= tx_quantity
-                total_quantity -= tx_quantity
-                total_cost -= tx_cost
-            elif tx_type == 'save_profit':
-                if buy_quantity_sum > 0:
-                    cost_basis_reduction = (tx_quantity / buy_quantity_sum) * buy_cost_sum
-                    buy_cost_sum -= cost_basis_reduction
-                buy_quantity_sum -= tx_quantity
-                total_quantity -= tx_quantity
-                total_cost -= tx_cost
-            elif tx_type in ('deposit', 'withdrawal'):
-                if asset['symbol'] == RIAL_WALLET_SYMBOL:
-                    if tx_type == 'deposit':
-                        total_quantity += tx_quantity
-                    else:
-                        total_quantity -= tx_quantity
-
-            processed_transactions.append({
-                'transaction_id': tx['transaction_id'],
-                'date': tx['date'],
-                'type': tx['type'],
-                'quantity': str(tx_quantity),
-                'price_per_unit': str(tx_price) if tx_type in ['buy', 'sell', 'save_profit'] else None,
-                'category': tx['category'],
-                'comment': tx['comment']
-            })
+# ---------- انتخاب، مرتب‌سازی و صفحه‌بندی قیمت‌ها ----------
 
-        # ---------- محاسبه قیمت فعلی و سر به سر ----------
-        current_price = decimal.Decimal(str(current_prices.get(asset['symbol'], 0)))
+PRICE_QUERY_PARAMS = ('symbols', 'category', 'fields', 'sort', 'limit', 'offset')
 
-        break_even_price = decimal.Decimal('0')
-        if buy_quantity_sum > 0:
-            break_even_price = buy_cost_sum / buy_quantity_sum
 
-        current_value = total_quantity * current_price
+def split_arg(name):
+    """
+    پارامتر Query String با مقادیر جدا شده با کاما (a,b,c) ← لیست
+    """
+    return [value.strip() for value in request.args.get(name, '').split(',') if value.strip()]
 
-        # ---------- محاسبه سود/زیان ----------
-        if asset['symbol'] != RIAL_WALLET_SYMBOL:
-            cost_basis = buy_cost_sum
-            profit_loss = current_value - cost_basis
-            return_pct = (profit_loss / cost_basis) * 100 if cost_basis > 0 else 0
-        else:
-            cost_basis = total_quantity
-            profit_loss = decimal.Decimal('0')
-            return_pct = 0
-
-        aggregated.append({
-            'id': asset['id'],
-            'symbol': asset['symbol'],
-            'title': asset['title'],
-            'type': ALL_SYMBOLS.get(asset['symbol'], 'wallet') if asset['symbol'] != RIAL_WALLET_SYMBOL else 'wallet',
-            'current_price': str(current_price),
-            'total_quantity': str(total_quantity),
-            'cost_basis': str(cost_basis),
-            'break_even_price': str(break_even_price),
-            'current_value': str(current_value),
-            'profit_loss': str(profit_loss),
-            'return_pct': str(return_pct),
-            'transactions': processed_transactions
-        })
 
-    return aggregated
+def price_sort_arg(table):
+    """
+    پارامتر sort معتبر (فیلد موجود در جدول) به‌صورت (field, descending) یا None
+    """
+    sort = request.args.get('sort', '')
+    field = sort.lstrip('-')
+    if field in table.numeric or field in table.text:
+        return field, sort.startswith('-')
+    return None
 
 
-def calculate_total_value(user_id):
+def query_prices(prices, categories=None):
     """
-    محاسبه ارزش کل پورتفوی یک کاربر (شامل کیف پول ریالی)
+    انتخاب ردیف‌های snapshot بر اساس پارامترهای Query String
+
+    پارامترها:
+    - symbols: لیست نمادها (ترتیب درخواست حفظ می‌شود)
+    - category: لیست دسته‌ها (categories ورودی، مثلاً برای /api/tsetmc، اولویت دارد)
+    - fields: projection کلیدهای خروجی (مثلاً symbol,toman_price)
+    - sort: نام فیلد، با پیشوند - برای نزولی (از ایندکس مرتب snapshot)
+    - limit / offset: صفحه‌بندی
+
+    Returns:
+        (rows, fields, total) - fields برای projection یا None
     """
-    aggregated = aggregate_assets(user_id)
-    total = decimal.Decimal('0')
-    for asset in aggregated:
-        if asset['symbol'] != RIAL_WALLET_SYMBOL:
-            total += decimal.Decimal(asset['current_value'])
+    table = prices.table
+    args = request.args
+
+    categories = categories or split_arg('category')
+    ranges = [table.category_rows[name] for name in categories if name in table.category_rows]
+    if categories and not ranges:
+        return [], None, 0
+
+    def selected(row):
+        return not ranges or any(row in rows for rows in ranges)
+
+    symbols = split_arg('symbols')
+    if symbols:
+        rows = [table.index[symbol] for symbol in dict.fromkeys(symbols) if symbol in table.index]
+        rows = [row for row in rows if selected(row)]
+    elif ranges:
+        rows = [row for rows in ranges for row in rows]
+    else:
+        rows = range(len(table))
+
+    sort = price_sort_arg(table)
+    if sort:
+        if symbols:
+            rank = {row: position for position, row in enumerate(prices.sorted_rows(*sort))}
+            rows.sort(key=rank.__getitem__)
         else:
-            total += decimal.Decimal(asset['total_quantity'])
-    return float(total)
+            rows = [row for row in prices.sorted_rows(*sort) if selected(row)]
 
+    total = len(rows)
+    offset = max(0, args.get('offset', 0, type=int))
+    limit = args.get('limit', type=int)
+    if limit is not None:
+        rows = rows[offset:offset + max(1, min(limit, PRICE_QUERY_MAX_LIMIT))]
+    elif offset:
+        rows = rows[offset:]
 
-# ============================================================
-#  بخش ۱۰: توابع بروزرسانی - تک‌کاربره
-# ============================================================
+    fields = split_arg('fields')
+    return list(rows), set(fields) if fields else None, total
 
-def update_chart_data_for_user(user_id):
+
+def run_price_alerts(previous, snapshot):
     """
-    بروزرسانی داده‌های نمودار برای یک کاربر
-    ارزش کل امروز را در جدول chart_data ذخیره می‌کند
+    ارزیابی هشدارهای قیمت برای snapshot تازه منتشر شده (خطا مانع بروزرسانی قیمت نمی‌شود)
     """
     try:
-        db = get_db()
-        today = datetime.now().strftime('%Y-%m-%d')
-        total_value = calculate_total_value(user_id)
-
-        db.execute('''
-            INSERT OR REPLACE INTO chart_data (user_id, date, total_value)
-            VALUES (?, ?, ?)
-        ''', (user_id, today, total_value))
-        db.commit()
-        return True
+        evaluate_price_alerts(previous, snapshot)
     except Exception as e:
-        print(f"❌ خطا در بروزرسانی نمودار کاربر {user_id}: {e}")
-        return False
+        print(f"❌ Error evaluating price alerts: {e}")
 
 
-def update_value_analysis_for_user(user_id):
+# ---------- جدول قیمت مشترک بین پروسس‌ها (mmap) ----------
+#
+# با چند worker (مثلاً gunicorn) فقط یک پروسس (ناشر) قیمت‌ها را از API
+# می‌گیرد و جدول باینری را در فایل mmap شده منتشر می‌کند؛ بقیه فقط می‌خوانند.
+#
+# ساختار فایل: [هدر ۶۴ بایتی] [اسلات ۰] [اسلات ۱]
+# هدر: magic, seq, active_slot, length, publisher_pid
+# seq به روش seqlock کار می‌کند: فرد = در حال نوشتن، زوج = پایدار
+# نویسنده همیشه در اسلات غیرفعال می‌نویسد تا خواننده‌ها روی اسلات فعال بدون کپی بخوانند
+
+class SharedPriceTable:
     """
-    بروزرسانی تحلیل ارزش برای یک کاربر
-    معادل دلاری و طلایی پورتفوی را محاسبه می‌کند
+    جدول قیمت تک‌نویسنده/چندخواننده روی فایل mmap
     """
-    usd_price = current_prices.get('USD', 0)
-    gold_price = None
 
-    for item in current_prices.get('categorized', {}).get('gold_coin', []):
-        if item.get('symbol') == 'IR_GOLD_18K':
-            gold_price = item.get('toman_price', item.get('price', 0))
-            break
+    MAGIC = b'ASHM'
+    HEADER = struct.Struct('<4sxxxxQIIQ')
+    HEADER_SIZE = 64
 
-    if not gold_price:
-        gold_price = current_prices.get('GOL18', 0)
+    def __init__(self, path, slot_size):
+        self.path = path
+        self.slot_size = slot_size - slot_size % 8
+        self.lock_file = None
+        self.owner_pid = None
+        self.seen_seq = None
 
-    if usd_price <= 0 or not gold_price or gold_price <= 0:
-        return False
+        size = self.HEADER_SIZE + 2 * self.slot_size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self.mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+    def _read_header(self):
+        magic, seq, active, length, pid = self.HEADER.unpack_from(self.mm, 0)
+        if magic != self.MAGIC:
+            return 0, 0, 0, 0
+        return seq, active, length, pid
+
+    def try_become_publisher(self):
+        """
+        تلاش برای گرفتن نقش ناشر با قفل انحصاری فایل
+        قفل تا پایان عمر پروسس نگه داشته می‌شود و با مرگ پروسس آزاد می‌شود
+        """
+        if self.is_owner():
+            return True
 
-    try:
-        db = get_db()
-        today = datetime.now().strftime('%Y-%m-%d')
-        total_value = decimal.Decimal(str(calculate_total_value(user_id)))
+        lock_file = open(self.path + '.lock', 'a+')
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
 
-        total_usd = float(total_value) / float(usd_price)
-        total_gold = float(total_value) / float(gold_price)
+        self.lock_file = lock_file
+        self.owner_pid = os.getpid()
+        print(f"👑 Process {os.getpid()} is the shared price publisher")
+        return True
 
-        db.execute('''
-            INSERT OR REPLACE INTO value_analysis
-            (user_id, date, total_value_toman, usd_price, gold_price_per_gram,
-             equivalent_usd, equivalent_gold_grams)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (user_id, today, float(total_value), float(usd_price), float(gold_price),
-              total_usd, total_gold))
-        db.commit()
+    def release_publisher(self):
+        """
+        رها کردن نقش ناشر (مثلاً پس از از دست دادن lease زمان‌بند)
+        """
+        if not self.is_owner():
+            return
+        fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+        self.lock_file.close()
+        self.lock_file = None
+        self.owner_pid = None
+
+    def is_owner(self):
+        """
+        قفل ناشر متعلق به همین پروسس است؟ (پروسس‌های fork شده قفل والد را به ارث نمی‌برند)
+        """
+        return self.lock_file is not None and self.owner_pid == os.getpid()
+
+    def publish(self, table, meta):
+        """
+        انتشار یک نسخه جدید از جدول (فقط توسط ناشر)
+        """
+        payload = table.to_bytes(meta)
+        if len(payload) > self.slot_size:
+            print(f"❌ Shared price table too large ({len(payload)} bytes), publish skipped")
+            return False
+
+        seq, active, _, _ = self._read_header()
+        target = 1 - active if seq else 0
+        # ناشری که وسط انتشار مرده seq را فرد رها کرده؛ گرد کردن به زوج
+        # جلوی گیر کردن همیشگی خواننده‌ها را می‌گیرد. اسلات active دست نخورده است
+        seq = (seq + 1) & ~1
+        start = self.HEADER_SIZE + target * self.slot_size
+
+        # seq فرد: خواننده‌ها می‌دانند انتشار در جریان است
+        self.HEADER.pack_into(self.mm, 0, self.MAGIC, seq + 1, active, 0, os.getpid())
+        self.mm[start:start + len(payload)] = payload
+        self.HEADER.pack_into(self.mm, 0, self.MAGIC, seq + 2, target, len(payload), os.getpid())
+        self.mm.flush()
+        self.seen_seq = seq + 2
         return True
-    except Exception as e:
-        print(f"❌ خطا در بروزرسانی تحلیل ارزش کاربر {user_id}: {e}")
+
+    def read(self, retries=5):
+        """
+        خواندن آخرین نسخه منتشر شده
+
+        Returns:
+            (table, meta) یا None اگر نسخه جدیدی نسبت به آخرین خواندن وجود نداشته باشد
+        """
+        for _ in range(retries):
+            seq, active, length, _ = self._read_header()
+            if not seq or seq == self.seen_seq:
+                return None
+            if seq % 2:
+                time.sleep(0.001)
+                continue
+
+            start = self.HEADER_SIZE + active * self.slot_size
+            try:
+                # کپی ستون‌ها: ناشر دو انتشار بعد همین اسلات را بازنویسی می‌کند و
+                # snapshotهای در حال استفاده نباید تغییر کنند
+                table, meta = PriceTable.from_buffer(memoryview(self.mm)[start:start + length], copy=True)
+            except (ValueError, struct.error):
+                time.sleep(0.001)
+                continue
+
+            if self._read_header()[0] == seq:
+                self.seen_seq = seq
+                return table, meta
+
+        return None
+
+
+shared_prices = None
+if SHARED_PRICES_FILE:
+    if fcntl is None:
+        print("⚠️ SHARED_PRICES_FILE ignored: file locking is not available on this platform")
+    else:
+        shared_prices = SharedPriceTable(SHARED_PRICES_FILE, SHARED_PRICES_SLOT_MB * 1024 * 1024)
+
+
+def is_price_publisher():
+    """
+    آیا این پروسس مسئول دریافت قیمت‌ها از API است؟
+    در حالت تک‌پروسسی (بدون فایل مشترک) همیشه True است
+    """
+    if shared_prices is None:
+        return True
+    # در حالت off پروسس وب فقط خواننده است و worker.py ناشر است
+    if SCHEDULER_MODE == 'off':
         return False
+    # در حالت leader فقط مالک lease زمان‌بند قیمت‌ها را منتشر می‌کند
+    if SCHEDULER_MODE == 'leader' and not scheduler_state['leader']:
+        return False
+    return shared_prices.try_become_publisher()
 
 
-def calculate_daily_profit_for_user(user_id):
+def publish_shared_prices():
     """
-    محاسبه سود/زیان روزانه برای یک کاربر
-    تغییرات نسبت به دیروز را محاسبه و ذخیره می‌کند
+    انتشار جدول قیمت فعلی برای سایر پروسس‌ها
     """
-    try:
-        db = get_db()
-        today = datetime.now().strftime('%Y-%m-%d')
-        yesterday = (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d')
+    if shared_prices is None or not is_price_publisher():
+        return
+    prices = current_prices
+    shared_prices.publish(prices.table, {
+        'last_updated': prices.last_updated,
+        'api_error': prices.api_error,
+        'freshness': prices.freshness
+    })
+
+
+def sync_shared_prices():
+    """
+    جایگزینی جدول محلی با آخرین نسخه منتشر شده توسط ناشر
+    بررسی seq در هدر هزینه ناچیزی دارد و فقط در صورت تغییر، جدول بازسازی می‌شود
+    """
+    if shared_prices is None or shared_prices.is_owner():
+        return False
+
+    snapshot = shared_prices.read()
+    if snapshot is None:
+        return False
+
+    table, meta = snapshot
+    publish_prices(
+        table=table,
+        last_updated=meta.get('last_updated'),
+        api_error=meta.get('api_error'),
+        freshness=meta.get('freshness') or {}
+    )
+    return True
+
+
+@app.before_request
+def refresh_shared_prices():
+    """
+    همگام‌سازی جدول قیمت این worker با حافظه مشترک پیش از هر درخواست
+    """
+    sync_shared_prices()
+
+
+# ---------- منابع قیمت (Adapters) ----------
+#
+# دریافت قیمت‌ها از طریق منبع قابل تعویض انجام می‌شود:
+# - brsapi: APIهای BrsApi (Gold_Currency و AllSymbols)
+# - replay: بازپخش پاسخ‌های ضبط شده از پوشه محلی (برای تست بار و بنچمارک آفلاین)
+# با تنظیم PRICE_RECORD_DIR پاسخ‌های خام BrsApi برای بازپخش بعدی ذخیره می‌شوند
+
+class PriceSourceError(Exception):
+    """خطای دریافت از منبع قیمت"""
+
+
+class BrsApiGoldCurrencySource:
+    """
+    منبع قیمت طلا، ارز و رمزارز از BrsApi
+    """
+
+    kind = 'gold_currency'
+
+    def __init__(self, url, record_dir=''):
+        self.url = url
+        self.record_dir = record_dir
+
+    def fetch(self):
+        """
+        Returns:
+            پاسخ JSON با کلیدهای gold, currency, cryptocurrency
+        """
+        response = requests.get(self.url, headers=API_HEADERS, timeout=15)
+        if response.status_code != 200:
+            raise PriceSourceError(f"HTTP {response.status_code}")
+        if self.record_dir:
+            record_payload(self.record_dir, self.kind, [response.content])
+        return response.json()
+
+
+class BrsApiAllSymbolsSource:
+    """
+    منبع نمادهای بورس تهران از BrsApi (دریافت تدریجی)
+    """
+
+    kind = 'tsetmc'
+
+    def __init__(self, url, record_dir=''):
+        self.url = url
+        self.record_dir = record_dir
+
+    def iter_items(self):
+        """
+        نمادها را همزمان با دریافت از شبکه yield می‌کند
+        """
+        with requests.get(self.url, headers=API_HEADERS, timeout=30, stream=True) as response:
+            if response.status_code != 200:
+                raise PriceSourceError(f"HTTP {response.status_code}")
+
+            chunks = response.iter_content(chunk_size=TSETMC_STREAM_CHUNK)
+            if self.record_dir:
+                chunks = record_stream(self.record_dir, self.kind, chunks)
+            yield from iter_json_array(chunks)
+
+            # خواندن باقیمانده پاسخ تا ضبط کامل شود
+            for _ in chunks:
+                pass
+
+
+class ReplaySource:
+    """
+    بازپخش پاسخ‌های ضبط شده (فایل‌های <kind>-<timestamp_ms>.json)
+
+    speed: ضریب سرعت زمان ضبط (۱ = زمان واقعی، ۶۰ = هر دقیقه ضبط در یک ثانیه)
+    با speed=0 هر فراخوانی فایل بعدی را برمی‌گرداند. بعد از آخرین فایل از ابتدا تکرار می‌شود
+    """
+
+    def __init__(self, kind, directory, speed=1.0):
+        self.kind = kind
+        self.speed = speed
+        self.position = 0
+        self.started = time.monotonic()
+
+        recordings = []
+        prefix = f'{kind}-'
+        if os.path.isdir(directory):
+            for file_name in os.listdir(directory):
+                stem = file_name[:-len('.json')]
+                if file_name.startswith(prefix) and file_name.endswith('.json') and stem[len(prefix):].isdigit():
+                    recordings.append((int(stem[len(prefix):]), os.path.join(directory, file_name)))
+        recordings.sort()
+
+        self.timestamps = [timestamp for timestamp, _ in recordings]
+        self.files = [path for _, path in recordings]
+
+    def _next_file(self):
+        if not self.files:
+            raise PriceSourceError(f"No {self.kind} recordings to replay")
+
+        if self.speed <= 0:
+            path = self.files[self.position % len(self.files)]
+            self.position += 1
+            return path
+
+        span = self.timestamps[-1] - self.timestamps[0] + 1
+        elapsed_ms = (time.monotonic() - self.started) * 1000 * self.speed
+        target = self.timestamps[0] + elapsed_ms % span
+        return self.files[bisect.bisect_right(self.timestamps, target) - 1]
+
+    def fetch(self):
+        with open(self._next_file(), 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def iter_items(self):
+        with open(self._next_file(), 'rb') as f:
+            yield from iter_json_array(iter(lambda: f.read(TSETMC_STREAM_CHUNK), b''))
+
+
+def record_payload(directory, kind, chunks):
+    """
+    ذخیره یک پاسخ خام برای بازپخش (نوشتن اتمیک)
+    """
+    try:
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'{kind}-{int(time.time() * 1000)}.json')
+        write_file_atomic(path, b''.join(chunks))
+    except OSError as e:
+        print(f"⚠️ Error recording {kind} payload: {e}")
+
+
+def record_stream(directory, kind, chunks):
+    """
+    ذخیره پاسخ تدریجی در حین عبور قطعه‌ها (فایل فقط در صورت دریافت کامل ثبت می‌شود)
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'{kind}-{int(time.time() * 1000)}.json')
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+
+
+def create_price_sources(source=None, replay_dir=None, speed=None):
+    """
+    ساخت منابع قیمت بر اساس PRICE_SOURCE
+    Returns:
+        {'gold_currency': source, 'tsetmc': source}
+    """
+    source = source or PRICE_SOURCE
+    if source == 'replay':
+        replay_dir = replay_dir or PRICE_REPLAY_DIR
+        speed = PRICE_REPLAY_SPEED if speed is None else speed
+        return {
+            'gold_currency': ReplaySource('gold_currency', replay_dir, speed),
+            'tsetmc': ReplaySource('tsetmc', replay_dir, speed)
+        }
+    if source != 'brsapi':
+        raise ValueError(f"Unknown price source: {source}")
+    return {
+        'gold_currency': BrsApiGoldCurrencySource(API_GOLD_CURRENCY, PRICE_RECORD_DIR),
+        'tsetmc': BrsApiAllSymbolsSource(API_TSETMC, PRICE_RECORD_DIR)
+    }
+
+
+price_sources = create_price_sources()
+
+
+def rial_to_toman(value):
+    """
+    تبدیل مقدار ریالی بورس به تومان (حذف رقم آخر) با تقسیم صحیح
+    مقادیر خالی یا نامعتبر صفر برگردانده می‌شوند
+    """
+    if not value or isinstance(value, bool):
+        return 0
+    try:
+        number = int(float(value))
+    except (ValueError, TypeError, OverflowError):
+        return 0
+    # تقسیم به سمت صفر تا علامت مقادیر منفی حفظ شود
+    return number // 10 if number >= 0 else -(-number // 10)
+
+
+def normalize_tsetmc_item(item, last_update):
+    """
+    نرمال‌سازی یک نماد از پاسخ AllSymbols
+    Returns:
+        دیکشنری نماد یا None برای ردیف‌های ناقص
+    """
+    if 'l18' not in item or 'pl' not in item:
+        return None
+
+    symbol_name = (item.get('l18') or '').strip()
+    company_name = (item.get('l30') or symbol_name).strip()
+
+    change_percent = item.get('plp')
+    try:
+        change_percent = float(change_percent) if change_percent else 0
+    except (ValueError, TypeError):
+        change_percent = 0
+
+    price = rial_to_toman(item.get('pl'))
+
+    return {
+        'symbol': symbol_name,
+        'title': company_name,
+        'name': company_name,
+        'price': price,
+        'toman_price': price,
+        'change_value': rial_to_toman(item.get('plc')),
+        'change_percent': change_percent,
+        'last_update': last_update
+    }
+
+
+def normalize_tsetmc_payload(data):
+    """
+    نرمال‌سازی دسته‌ای پاسخ AllSymbols
+
+    یک حلقه فشرده روی تمام نمادها: تبدیل ریال به تومان با تقسیم صحیح
+    و یک زمان بروزرسانی (intern شده) برای کل دسته
+    Returns:
+        لیست نمادهای مرتب شده بر اساس symbol
+    """
+    last_update = sys.intern(datetime.now().strftime('%Y-%m-%d %H:%M'))
+    processed_data = []
+    append = processed_data.append
+
+    for item in data:
+        row = normalize_tsetmc_item(item, last_update)
+        if row is not None:
+            append(row)
+
+    processed_data.sort(key=lambda x: x['symbol'])
+    return processed_data
+
+
+def normalize_tsetmc_stream(items):
+    """
+    نرمال‌سازی نمادها همزمان با رسیدن از شبکه و درج در لیست مرتب
+    (معادل normalize_tsetmc_payload بدون نگهداری پاسخ خام)
+    """
+    last_update = sys.intern(datetime.now().strftime('%Y-%m-%d %H:%M'))
+    processed_data = []
+
+    for item in items:
+        row = normalize_tsetmc_item(item, last_update)
+        if row is not None:
+            bisect.insort(processed_data, row, key=lambda x: x['symbol'])
+
+    return processed_data
+
+
+def fetch_tsetmc_data():
+    """
+    دریافت داده‌های بورس تهران از API
+
+    قیمت‌ها را اصلاح (حذف رقم آخر) و پردازش می‌کند
+    Returns:
+        لیست نمادهای بورس یا None در صورت خطا
+    """
+    try:
+        print("📈 Fetching TSE data...")
+
+        # پارس و نرمال‌سازی همزمان با دریافت (بدون نگهداری کل پاسخ خام)
+        processed_data = normalize_tsetmc_stream(price_sources['tsetmc'].iter_items())
+
+        print(f"✅ TSE data processed: {len(processed_data)} symbols")
+        return processed_data
+
+    except PriceSourceError as e:
+        print(f"❌ خطای API بورس: {e}")
+        return None
+    except Exception as e:
+        print(f"❌ خطا در پردازش داده‌های بورس: {e}")
+        return None
+
+
+@price_flights.wrap('tsetmc')
+def update_tsetmc_prices():
+    """
+    بروزرسانی قیمت‌های بورس در کش
+    در صورت خطا از داده‌های ذخیره شده قبلی استفاده می‌کند
+    """
+    # در حالت چندپروسسی فقط ناشر از API دریافت می‌کند
+    if not is_price_publisher():
+        sync_shared_prices()
+        return False
+
+    try:
+        price_refresh_attempts['tsetmc'] = time.time()
+        new_data = fetch_tsetmc_data()
+
+        if new_data:
+            with prices_write_lock:
+                previous = current_prices
+                prices = publish_prices(
+                    table=current_prices.table.with_category('stock', new_data),
+                    freshness=freshness_with(('stock',), 'live')
+                )
+
+            # ذخیره در فایل کش
+            write_json_file(TSETMC_FILE, new_data)
+            save_price_snapshot()
+
+            # بروزرسانی خروجی JSON قیمت‌ها از جدول حافظه (بدون خواندن مجدد فایل)
+            if PRICES_JSON_EXPORT and len(prices.table.category_rows) > 1:
+                write_json_file(PRICES_FILE, prices.categorized())
+
+            publish_shared_prices()
+            run_price_alerts(previous, prices)
+            print(f"✅ Stock prices updated: {len(new_data)} symbol")
+            return True
+        else:
+            # استفاده از داده‌های کش شده
+            cached_data = read_json_file(TSETMC_FILE)
+            if cached_data:
+                # سن واقعی داده کش حفظ می‌شود (زمان فایل، نه زمان فعلی)
+                with prices_write_lock:
+                    publish_prices(
+                        table=current_prices.table.with_category('stock', cached_data),
+                        freshness=freshness_with(('stock',), 'cache', os.path.getmtime(TSETMC_FILE))
+                    )
+                publish_shared_prices()
+
+                print(f"⚠️ Using cached stock data: {len(cached_data)} symbol")
+            return False
+
+    except Exception as e:
+        print(f"❌ Error updating stock prices: {e}")
+        return False
+@price_flights.wrap('gold_currency')
+def fetch_prices(force=False):
+    """
+    دریافت قیمت‌های لحظه‌ای از API اصلی
+
+    قیمت‌های طلا، ارز و رمزارز را دریافت و پردازش می‌کند
+    در صورت وجود کش معتبر، از آن استفاده می‌کند (مگر با force=True)
+    """
+    # در حالت چندپروسسی فقط ناشر از API دریافت می‌کند
+    if not is_price_publisher():
+        if not sync_shared_prices() and not len(current_prices.table):
+            load_cached_prices()
+        return
+
+    # بررسی اعتبار کش (بر اساس سن واقعی هر دسته)
+    if not force and not any(is_price_stale(category) for category in GOLD_CURRENCY_CATEGORIES):
+        age = max(time.time() - current_prices.freshness[category]['updated_at']
+                  for category in GOLD_CURRENCY_CATEGORIES)
+        print(f"🔄 Using price cache ({(PRICE_CACHE_MINUTES * 60 - age) / 60:.1f} minutes until update)")
+        return
+
+    try:
+        print("📡 Fetching prices from API...")
+        price_refresh_attempts['gold_currency'] = time.time()
+        try:
+            data = price_sources['gold_currency'].fetch()
+        except PriceSourceError as e:
+            print(f"⚠️ خطای API اصلی: {e}")
+            load_cached_prices(GOLD_CURRENCY_CATEGORIES)
+            return
+
+        processed_prices = {"gold_coin": [], "currency": [], "crypto": []}
+
+        # ---------- پیدا کردن قیمت تتر برای تبدیلات ----------
+        usdt_price = None
+        for item in data.get('currency', []):
+            if item['symbol'] == 'USDT_IRT':
+                usdt_price = float(item['price'])
+                break
+
+        if not usdt_price:
+            usdt_price = get_symbol_price('USDT', 160000)
+
+        # ---------- پردازش طلا و سکه ----------
+        for item in data.get('gold', []):
+            if item['symbol'] not in ASSET_TYPES['gold_coin']:
+                continue
+
+            try:
+                price = float(item['price'])
+                if item['symbol'] == 'XAUUSD' or item.get('unit') == 'دلار':
+                    price_in_toman = price * usdt_price
+                    usd_price_val = price
+                else:
+                    price_in_toman = price
+                    usd_price_val = price / usdt_price
+
+                processed_prices['gold_coin'].append({
+                    'symbol': item['symbol'],
+                    'title': item['name'],
+                    'price': price_in_toman,
+                    'toman_price': price_in_toman,
+                    'usd_price': usd_price_val,
+                    'last_update': f"{item.get('date', '')} {item.get('time', '')}".strip(),
+                    'change_value': item.get('change_value'),
+                    'change_percent': item.get('change_percent')
+                })
+            except Exception as e:
+                print(f"⚠️ Error processing gold {item['symbol']}: {e}")
+
+        # ---------- پردازش ارزها ----------
+        for item in data.get('currency', []):
+            if item['symbol'] not in ASSET_TYPES['currency']:
+                continue
+
+            try:
+                price = float(item['price'])
+                processed_prices['currency'].append({
+                    'symbol': item['symbol'],
+                    'title': item['name'],
+                    'price': price,
+                    'toman_price': price,
+                    'usd_price': price / usdt_price if item['symbol'] != 'USDT_IRT' else 1.0,
+                    'last_update': f"{item.get('date', '')} {item.get('time', '')}".strip(),
+                    'change_value': item.get('change_value'),
+                    'change_percent': item.get('change_percent')
+                })
+            except Exception as e:
+                print(f"⚠️ Error processing currency {item['symbol']}: {e}")
+
+        # ---------- پردازش رمزارزها ----------
+        for item in data.get('cryptocurrency', []):
+            if item['symbol'] not in ASSET_TYPES['crypto']:
+                continue
+
+            try:
+                price_str = str(item['price']).replace(',', '')
+                price = float(price_str)
+                price_in_toman = price * usdt_price
+
+                processed_prices['crypto'].append({
+                    'symbol': item['symbol'],
+                    'title': item['name'],
+                    'price': price_in_toman,
+                    'toman_price': price_in_toman,
+                    'usd_price': price,
+                    'last_update': f"{item.get('date', '')} {item.get('time', '')}".strip(),
+                    'change_percent': item.get('change_percent')
+                })
+            except Exception as e:
+                print(f"⚠️ Error processing crypto {item['symbol']}: {e}")
+
+        # ---------- مرتب‌سازی و ذخیره ----------
+        for category in processed_prices:
+            processed_prices[category].sort(key=lambda x: x['symbol'])
+
+        # اضافه کردن داده‌های بورس (داخل قفل تا بروزرسانی همزمان بورس گم نشود)
+        with prices_write_lock:
+            if 'stock' in current_prices.table.category_rows:
+                processed_prices['stock'] = current_prices.table.category('stock')
+            else:
+                stock_data = read_json_file(TSETMC_FILE)
+                if stock_data:
+                    processed_prices['stock'] = stock_data
+
+            previous = current_prices
+            prices = publish_prices(
+                table=PriceTable.from_categorized(processed_prices),
+                last_updated=datetime.now(timezone.utc).isoformat(),
+                api_error=None,
+                freshness=freshness_with(GOLD_CURRENCY_CATEGORIES, 'live')
+            )
+
+        save_price_snapshot()
+        if PRICES_JSON_EXPORT:
+            write_json_file(PRICES_FILE, processed_prices)
+        publish_shared_prices()
+        run_price_alerts(previous, prices)
+        print(f"✅ Prices were successfully updated.")
+
+    except Exception as e:
+        print(f"❌ خطا در دریافت قیمت‌ها: {e}")
+        load_cached_prices(GOLD_CURRENCY_CATEGORIES)
+
+
+@price_flights.wrap('disk_cache')
+def load_cached_prices(categories=None):
+    """
+    لود قیمت‌ها از فایل کش در صورت خطا در API
+    ابتدا کش باینری و در نبود آن خروجی JSON خوانده می‌شود
+
+    زمان بروزرسانی همان زمان واقعی داده کش است تا قدیمی بودن پنهان نشود
+    و بروزرسانی بعدی به تعویق نیفتد
+
+    categories: فقط همین دسته‌ها (منبع شکست خورده) از کش پر می‌شوند و فقط اگر
+    کش از داده حافظه تازه‌تر باشد؛ داده زنده دسته‌های دیگر دست نمی‌خورد.
+    None = جایگزینی کل جدول (شروع سرد)
+    """
+    try:
+        snapshot = read_price_snapshot()
+        if snapshot:
+            table, meta = snapshot
+            file_time = os.path.getmtime(PRICES_SNAPSHOT_FILE)
+        else:
+            cached = read_json_file(PRICES_FILE)
+            table = PriceTable.from_categorized(cached) if cached else None
+            meta = {}
+            file_time = os.path.getmtime(PRICES_FILE) if cached else None
+
+        if table is None or not len(table):
+            return
+
+        saved_freshness = meta.get('freshness', {})
+        freshness = {
+            category: {
+                'updated_at': saved_freshness[category]['updated_at'] if category in saved_freshness else file_time,
+                'source': 'cache'
+            }
+            for category in table.categories()
+        }
+
+        if categories is None:
+            loaded = table.categories()
+            publish_prices(
+                table=table,
+                last_updated=meta.get('last_updated') or datetime.fromtimestamp(file_time, timezone.utc).isoformat(),
+                api_error="Using cached prices",
+                freshness=freshness
+            )
+        else:
+            with prices_write_lock:
+                current = current_prices
+                loaded = [
+                    category for category in categories
+                    if category in freshness and (
+                        category not in current.freshness
+                        or freshness[category]['updated_at'] > current.freshness[category]['updated_at']
+                    )
+                ]
+                if not loaded:
+                    print("⚠️ Price cache is not newer than memory, keeping current prices")
+                    return
+
+                categorized = current.table.to_categorized()
+                categorized.update((category, table.category(category)) for category in loaded)
+                publish_prices(
+                    table=PriceTable.from_categorized(categorized),
+                    api_error="Using cached prices",
+                    freshness=dict(current.freshness, **{category: freshness[category] for category in loaded})
+                )
+
+        publish_shared_prices()
+
+        print(f"⚠️ Cached prices loaded ({', '.join(loaded)})")
+    except Exception as e:
+        print(f"❌ Error loading price cache: {e}")
+
+# ============================================================
+#  بخش ۹: توابع محاسبات پورتفوی
+# ============================================================
+
+# ---------- هسته ارزش‌گذاری (اعداد صحیح مقیاس‌شده) ----------
+#
+# حلقه تراکنش‌ها برای جمع‌های پورتفوی فقط جمع و ضرب اعداد صحیح انجام می‌دهد؛
+# فیلدهای رشته‌ای /api/assets از DecimalLedger ذخیره شده می‌آیند تا با خروجی قبلی یکسان بمانند
+
+
+class LotQueue:
+    """
+    صف لات‌های باز یک دارایی
+
+    هر لات [seq, quantity, price] است (مقدار با مقیاس دارایی، قیمت با PRICE_DECIMALS).
+    fifo از ابتدای صف و lifo از انتهای صف مصرف می‌کند؛ average هر خرید را در
+    تنها لات صف با قیمت میانگین موزون ادغام می‌کند. هزینه هر فروش O(لات‌های مصرف شده) است.
+    realized (سود محقق شده) با مقیاس decimals + PRICE_DECIMALS است.
+    oversold مقدار فروخته شده بیش از لات‌های باز است (تاریخچه ناسازگار، مثلاً پس از ویرایش تراکنش).
+    changed و removed شماره لات‌های تغییر کرده برای ذخیره افزایشی هستند
+    """
+    __slots__ = ('method', 'lots', 'realized', 'oversold', 'next_seq', 'changed', 'removed')
+
+    def __init__(self, method, lots=(), realized=0, next_seq=0):
+        self.method = method
+        self.lots = deque(lots)
+        self.realized = realized
+        self.oversold = 0
+        self.next_seq = next_seq
+        self.changed = set()
+        self.removed = []
+
+    @property
+    def quantity(self):
+        return sum(lot[1] for lot in self.lots)
+
+    @property
+    def cost(self):
+        return sum(lot[1] * lot[2] for lot in self.lots)
+
+    def buy(self, quantity, price):
+        if self.method == 'average' and self.lots:
+            lot = self.lots[0]
+            total = lot[1] + quantity
+            lot[2] = fixed_div(lot[1] * lot[2] + quantity * price, total)
+            lot[1] = total
+            self.changed.add(lot[0])
+        else:
+            self.lots.append([self.next_seq, quantity, price])
+            self.changed.add(self.next_seq)
+            self.next_seq += 1
+
+    def sell(self, quantity, price):
+        """
+        مصرف لات‌ها و ثبت سود محقق شده
+
+        مقدار مازاد بر لات‌های باز بهای تمام‌شده‌ای ندارد؛ در oversold جمع و گزارش می‌شود
+        """
+        lots = self.lots
+        lifo = self.method == 'lifo'
+        while quantity > 0 and lots:
+            lot = lots[-1] if lifo else lots[0]
+            taken = min(quantity, lot[1])
+            self.realized += taken * (price - lot[2])
+            lot[1] -= taken
+            quantity -= taken
+            if lot[1] == 0:
+                lots.pop() if lifo else lots.popleft()
+                self.changed.discard(lot[0])
+                self.removed.append(lot[0])
+            else:
+                self.changed.add(lot[0])
+        self.oversold += quantity
+
+
+class DecimalLedger:
+    """
+    محاسبه دهدهی (Decimal) فیلدهای رشته‌ای /api/assets با همان ترتیب عملیات
+    نسخه قبلی، تا خروجی JSON رشته به رشته (حتی صفرهای انتهایی) یکسان بماند.
+    وضعیت آن در asset_lot_state به‌صورت str(Decimal) ذخیره می‌شود (رشته توان
+    دهدهی را هم نگه می‌دارد)؛ پس Decimal فقط برای تراکنش‌های جدید در sync_asset_lots
+    اجرا می‌شود و /api/assets تاریخچه را دوباره مرور نمی‌کند.
+
+    تنها تفاوت با نسخه قبلی فروش بیش از مقدار خریداری شده است: قبلاً مقدار خرید
+    منفی و بهای تمام‌شده نامعتبر می‌شد؛ اکنون مثل LotQueue فقط مقدار باز از
+    بهای تمام‌شده کم و مازاد در oversold گزارش می‌شود
+    """
+    __slots__ = ('is_wallet', 'quantity', 'buy_quantity', 'buy_cost', 'realized', 'oversold')
+    FIELDS = ('quantity', 'buy_quantity', 'buy_cost', 'realized', 'oversold')
+
+    def __init__(self, is_wallet, values=('0',) * 5):
+        self.is_wallet = is_wallet
+        self.quantity, self.buy_quantity, self.buy_cost, self.realized, self.oversold = map(decimal.Decimal, values)
+
+    def to_row(self):
+        """
+        رشته‌های ذخیره فیلدها به ترتیب FIELDS (ستون‌های ledger_* جدول asset_lot_state)
+        """
+        return tuple(str(getattr(self, field)) for field in self.FIELDS)
+
+    def apply(self, tx_type, quantity, price):
+        quantity = decimal.Decimal(str(quantity))
+        if tx_type == 'buy':
+            self.quantity += quantity
+            self.buy_quantity += quantity
+            self.buy_cost += quantity * decimal.Decimal(str(price))
+        elif tx_type in ('sell', 'save_profit'):
+            sold = quantity
+            if sold > self.buy_quantity:
+                sold = self.buy_quantity
+                self.oversold += quantity - sold
+            reduction = decimal.Decimal('0')
+            if self.buy_quantity > 0:
+                reduction = (sold / self.buy_quantity) * self.buy_cost
+                self.buy_cost -= reduction
+            self.realized += sold * decimal.Decimal(str(price)) - reduction
+            self.buy_quantity -= sold
+            self.quantity -= quantity
+        elif tx_type in ('deposit', 'withdrawal') and self.is_wallet:
+            self.quantity += quantity if tx_type == 'deposit' else -quantity
+
+    @property
+    def break_even(self):
+        return self.buy_cost / self.buy_quantity if self.buy_quantity > 0 else decimal.Decimal('0')
+
+
+class AssetValuation:
+    """
+    وضعیت ارزش‌گذاری یک دارایی
+
+    quantity با مقیاس 10^decimals و price با مقیاس 10^PRICE_DECIMALS نگهداری می‌شوند؛
+    بهای تمام‌شده و سود محقق شده از صف لات‌ها (lots) می‌آیند.
+    مبالغ خروجی (value, cost_basis, profit, realized) در مقیاس مشترک MONEY_DECIMALS هستند.
+    ledger (DecimalLedger) فقط برای ساخت خروجی JSON با to_json لازم است
+    """
+    __slots__ = ('id', 'symbol', 'title', 'decimals', 'scale', 'is_wallet', 'quantity', 'price', 'price_number',
+                 'lots', 'ledger')
+
+    def __init__(self, asset_id, symbol, title, price, method=DEFAULT_COST_BASIS_METHOD):
+        self.id = asset_id
+        self.symbol = symbol
+        self.title = title
+        self.decimals = QUANTITY_DECIMALS
+        self.scale = 10 ** self.decimals
+        self.is_wallet = symbol == RIAL_WALLET_SYMBOL
+        self.quantity = 0
+        self.price = to_fixed(price, PRICE_DECIMALS)
+        self.price_number = price
+        self.lots = LotQueue(method)
+        self.ledger = None
+
+    def apply(self, tx_type, quantity, price):
+        """
+        اعمال یک تراکنش به موجودی و صف لات‌ها
+        """
+        if self.ledger is not None:
+            self.ledger.apply(tx_type, quantity, price)
+        quantity = to_fixed(quantity, self.decimals)
+        if tx_type == 'buy':
+            self.quantity += quantity
+            self.lots.buy(quantity, to_fixed(price, PRICE_DECIMALS))
+        elif tx_type in ('sell', 'save_profit'):
+            self.quantity -= quantity
+            self.lots.sell(quantity, to_fixed(price, PRICE_DECIMALS))
+        elif tx_type in ('deposit', 'withdrawal') and self.is_wallet:
+            self.quantity += quantity if tx_type == 'deposit' else -quantity
+
+    def to_money(self, value):
+        """
+        تبدیل مبلغ با مقیاس مقدار × قیمت این دارایی به مقیاس MONEY_DECIMALS
+        """
+        return fixed_rescale(value, self.decimals + PRICE_DECIMALS, MONEY_DECIMALS)
+
+    @property
+    def market_value(self):
+        """
+        مقدار × قیمت فعلی (برای کیف پول ریالی قیمت بازار ندارد)
+        """
+        return self.to_money(self.quantity * self.price)
+
+    @property
+    def value(self):
+        """
+        سهم دارایی از ارزش کل پورتفوی (کیف پول ریالی با موجودی خود)
+        """
+        if self.is_wallet:
+            return fixed_rescale(self.quantity, self.decimals, MONEY_DECIMALS)
+        return self.market_value
+
+    @property
+    def cost_basis(self):
+        if self.is_wallet:
+            return self.value
+        return self.to_money(self.lots.cost)
+
+    @property
+    def profit(self):
+        """
+        سود/زیان محقق نشده (ارزش فعلی منهای بهای لات‌های باز)
+        """
+        return 0 if self.is_wallet else self.value - self.cost_basis
+
+    @property
+    def realized(self):
+        return self.to_money(self.lots.realized)
+
+    @property
+    def break_even(self):
+        """
+        قیمت سر به سر با مقیاس PRICE_DECIMALS
+        """
+        open_quantity = self.lots.quantity
+        return fixed_div(self.lots.cost, open_quantity) if open_quantity > 0 else 0
+
+    @property
+    def return_pct(self):
+        """
+        درصد بازده با مقیاس MONEY_DECIMALS
+        """
+        cost_basis = self.cost_basis
+        if self.is_wallet or cost_basis <= 0:
+            return 0
+        return fixed_div(self.profit * 100 * 10 ** MONEY_DECIMALS, cost_basis)
+
+    def to_json(self):
+        """
+        لایه سازگاری: همان فیلدهای رشته‌ای str(Decimal) خروجی قبلی /api/assets
+        به‌علاوه سود محقق شده و محقق نشده (نیازمند ledger)
+
+        روش average دقیقاً همان محاسبه قبلی است؛ fifo/lifo بهای تمام‌شده را از صف لات‌ها می‌گیرند
+        """
+        ledger = self.ledger
+        current_price = decimal.Decimal(str(self.price_number))
+        current_value = ledger.quantity * current_price
+
+        if self.is_wallet:
+            cost_basis, break_even, realized = ledger.quantity, ledger.break_even, decimal.Decimal('0')
+            profit, return_pct = decimal.Decimal('0'), 0
+        else:
+            if self.lots.method == 'average':
+                cost_basis, break_even, realized = ledger.buy_cost, ledger.break_even, ledger.realized
+            else:
+                cost_basis = decimal.Decimal(fixed_to_str(self.cost_basis, MONEY_DECIMALS))
+                break_even = decimal.Decimal(fixed_to_str(self.break_even, PRICE_DECIMALS))
+                realized = decimal.Decimal(fixed_to_str(self.realized, MONEY_DECIMALS))
+            profit = current_value - cost_basis
+            return_pct = (profit / cost_basis) * 100 if cost_basis > 0 else 0
+
+        return {
+            'id': self.id,
+            'symbol': self.symbol,
+            'title': self.title,
+            'type': 'wallet' if self.is_wallet else ALL_SYMBOLS.get(self.symbol, 'wallet'),
+            'current_price': str(current_price),
+            'total_quantity': str(ledger.quantity),
+            'cost_basis': str(cost_basis),
+            'cost_basis_method': self.lots.method,
+            'break_even_price': str(break_even),
+            'current_value': str(current_value),
+            'profit_loss': str(profit),
+            'unrealized_profit': str(profit),
+            'realized_profit': str(realized),
+            'oversold_quantity': str(ledger.oversold),
+            'return_pct': str(return_pct)
+        }
+
+
+def get_cost_basis_method(db, user_id):
+    """
+    روش محاسبه بهای تمام‌شده انتخابی کاربر
+    """
+    row = db.execute('SELECT cost_basis_method FROM user_settings WHERE user_id = ?', (user_id,)).fetchone()
+    return row['cost_basis_method'] if row else DEFAULT_COST_BASIS_METHOD
+
+
+def restore_lot_state(valuation, state, lots):
+    """
+    بازگردانی صف لات‌ها و دفتر دهدهی ذخیره شده (ردیف asset_lot_state) روی valuation
+
+    lots: [(seq, quantity, price)] رشته‌ای به ترتیب seq؛ دفتر فقط اگر valuation.ledger
+    ساخته شده باشد بازگردانده می‌شود
+    """
+    decimals = valuation.decimals
+    valuation.lots = LotQueue(
+        valuation.lots.method,
+        ([seq, fixed_from_str(quantity, decimals), fixed_from_str(price, PRICE_DECIMALS)] for seq, quantity, price in lots),
+        fixed_rescale(fixed_from_str(state['realized'], MONEY_DECIMALS), MONEY_DECIMALS, decimals + PRICE_DECIMALS),
+        state['next_seq']
+    )
+    if valuation.ledger is not None:
+        valuation.ledger = DecimalLedger(valuation.is_wallet,
+                                         [state[f'ledger_{field}'] for field in DecimalLedger.FIELDS])
+
+
+def apply_new_transactions(db, valuation, last_date, last_seq):
+    """
+    اعمال تراکنش‌های بعد از مکان‌نمای (date, seq) یک دارایی به ترتیب ثبت
+
+    Returns:
+        مکان‌نمای آخرین تراکنش اعمال شده (date, seq)
+    """
+    rows = db.execute('''
+        SELECT seq, date, type, quantity, price_per_unit FROM transactions
+        WHERE asset_id = ? AND (date > ? OR (date = ? AND seq > ?))
+        ORDER BY date, seq
+    ''', (valuation.id, last_date, last_date, last_seq))
+    for seq, tx_date, tx_type, quantity, price in rows:
+        valuation.apply(tx_type, quantity, price)
+        last_date, last_seq = tx_date, seq
+    return last_date, last_seq
+
+
+def sync_asset_lots(db, asset_id, method):
+    """
+    بروزرسانی صف لات‌ها و دفتر دهدهی ذخیره شده یک دارایی
+
+    اگر وضعیت ذخیره شده با همین روش موجود باشد فقط تراکنش‌های بعد از آخرین
+    تراکنش اعمال شده خوانده می‌شوند؛ در غیر این صورت صف از ابتدا ساخته می‌شود.
+    فقط لات‌های تغییر کرده نوشته می‌شوند (commit با فراخواننده است).
+    کیف پول ریالی لات ندارد و فقط دفتر آن ذخیره می‌شود
+    """
+    asset = db.execute('SELECT symbol FROM assets WHERE id = ?', (asset_id,)).fetchone()
+    if not asset:
+        return
+
+    valuation = AssetValuation(asset_id, asset['symbol'], None, 0, method)
+    valuation.ledger = DecimalLedger(valuation.is_wallet)
+    state = db.execute('SELECT * FROM asset_lot_state WHERE asset_id = ?', (asset_id,)).fetchone()
+
+    if state and state['method'] == method:
+        restore_lot_state(valuation, state, db.execute(
+            'SELECT seq, quantity, price FROM asset_lots WHERE asset_id = ? ORDER BY seq', (asset_id,)
+        ))
+        last_date, last_seq = state['last_date'] or '', state['last_seq']
+    else:
+        db.execute('DELETE FROM asset_lots WHERE asset_id = ?', (asset_id,))
+        last_date, last_seq = '', 0
+
+    last_date, last_seq = apply_new_transactions(db, valuation, last_date, last_seq)
+
+    queue = valuation.lots
+    if queue.oversold:
+        print(f"⚠️ Asset {asset_id}: sells exceed open lots by {fixed_to_str(queue.oversold, valuation.decimals)}")
+    if queue.removed:
+        db.executemany('DELETE FROM asset_lots WHERE asset_id = ? AND seq = ?',
+                       [(asset_id, seq) for seq in queue.removed])
+    if queue.changed:
+        db.executemany('INSERT OR REPLACE INTO asset_lots (asset_id, seq, quantity, price) VALUES (?, ?, ?, ?)', [
+            (asset_id, seq, fixed_to_str(quantity, valuation.decimals), fixed_to_str(price, PRICE_DECIMALS))
+            for seq, quantity, price in queue.lots if seq in queue.changed
+        ])
+    db.execute('''
+        INSERT OR REPLACE INTO asset_lot_state
+        (asset_id, method, realized, last_date, last_seq, next_seq, pending,
+         ledger_quantity, ledger_buy_quantity, ledger_buy_cost, ledger_realized, ledger_oversold)
+        VALUES (?, ?, ?, ?, ?, ?, 0, ?, ?, ?, ?, ?)
+    ''', (asset_id, method, fixed_to_str(valuation.realized, MONEY_DECIMALS),
+          last_date or None, last_seq, queue.next_seq) + valuation.ledger.to_row())
+
+
+def sync_user_lots(db, user_id):
+    """
+    بروزرسانی صف لات‌های تمام دارایی‌های یک کاربر با روش انتخابی او
+    """
+    method = get_cost_basis_method(db, user_id)
+    for asset in db.execute('SELECT id FROM assets WHERE user_id = ?', (user_id,)).fetchall():
+        sync_asset_lots(db, asset['id'], method)
+
+
+def valuate_assets(db, user_id, prices=None, ledgers=False):
+    """
+    ارزش‌گذاری تمام دارایی‌های یک کاربر با اعداد صحیح
+
+    موجودی از asset_balances و بهای تمام‌شده از لات‌های ذخیره شده خوانده می‌شود
+    (بدون مرور تاریخچه). اگر صف دارایی عقب باشد (pending) فقط تراکنش‌های بعد از
+    مکان‌نمای ذخیره شده در حافظه اعمال می‌شوند و فقط دارایی‌های بدون صف معتبر
+    (باطل شده یا با روش دیگر) از روی تمام تراکنش‌ها محاسبه می‌شوند
+
+    با ledgers=True دفتر دهدهی هر دارایی (برای to_json) هم از وضعیت ذخیره شده ساخته می‌شود
+
+    Returns:
+        لیست AssetValuation به ترتیب نماد
+    """
+    table = (prices or current_prices).table
+    method = get_cost_basis_method(db, user_id)
+
+    assets = db.execute('''
+        SELECT a.id, a.symbol, a.title, b.balance, s.*
+        FROM assets a
+        LEFT JOIN asset_balances b ON b.asset_id = a.id
+        LEFT JOIN asset_lot_state s ON s.asset_id = a.id
+        WHERE a.user_id = ?
+        ORDER BY a.symbol
+    ''', (user_id,)).fetchall()
+
+    lots = defaultdict(list)
+    for asset_id, seq, quantity, price in db.execute('''
+        SELECT l.asset_id, l.seq, l.quantity, l.price
+        FROM asset_lots l JOIN assets a ON a.id = l.asset_id
+        WHERE a.user_id = ?
+        ORDER BY l.asset_id, l.seq
+    ''', (user_id,)):
+        lots[asset_id].append((seq, quantity, price))
+
+    valuations = []
+    for asset in assets:
+        valuation = AssetValuation(asset['id'], asset['symbol'], asset['title'],
+                                   table.toman_price(asset['symbol'], 0), method)
+        if ledgers:
+            valuation.ledger = DecimalLedger(valuation.is_wallet)
+        valuations.append(valuation)
+
+        if asset['method'] == method:
+            restore_lot_state(valuation, asset, lots[asset['id']])
+            if asset['pending']:
+                apply_new_transactions(db, valuation, asset['last_date'] or '', asset['last_seq'])
+        elif not valuation.is_wallet or ledgers:
+            apply_new_transactions(db, valuation, '', 0)
+            continue
+        valuation.quantity = to_fixed(asset['balance'], valuation.decimals)
+
+    return valuations
+
+
+def portfolio_totals(valuations):
+    """
+    جمع ارزش، بهای تمام‌شده و سود پورتفوی (مقیاس MONEY_DECIMALS) و تعداد دارایی‌های دارای موجودی
+    """
+    total_value = total_cost = total_profit = asset_count = 0
+    for valuation in valuations:
+        total_value += valuation.value
+        if not valuation.is_wallet:
+            total_cost += valuation.cost_basis
+            total_profit += valuation.profit
+        if valuation.quantity > 0:
+            asset_count += 1
+    return total_value, total_cost, total_profit, asset_count
+
+
+def aggregate_assets(user_id, include_transactions=True):
+    """
+    محاسبه اطلاعات تجمیعی دارایی‌های یک کاربر
+
+    موجودی، قیمت سر به سر، ارزش فعلی و سود/زیان محقق شده و نشده هر دارایی
+    با روش بهای تمام‌شده کاربر از وضعیت ذخیره شده (valuate_assets) ساخته می‌شوند؛
+    تاریخچه فقط برای فهرست تراکنش‌های پاسخ خوانده می‌شود
+
+    با include_transactions=False تراکنش‌ها اصلاً خوانده نمی‌شوند
+    """
+    db = get_db()
+    valuations = valuate_assets(db, user_id, ledgers=True)
+    if not include_transactions:
+        return [valuation.to_json() for valuation in valuations]
+
+    transactions = defaultdict(list)
+    for asset_id, transaction_id, tx_date, tx_type, quantity, price, category, comment in db.execute('''
+        SELECT t.asset_id, t.transaction_id, t.date, t.type, t.quantity, t.price_per_unit, t.category, t.comment
+        FROM assets a JOIN transactions t ON t.asset_id = a.id
+        WHERE a.user_id = ?
+        ORDER BY a.symbol, t.date, t.seq
+    ''', (user_id,)):
+        transactions[asset_id].append({
+            'transaction_id': transaction_id,
+            'date': tx_date,
+            'type': tx_type,
+            'quantity': decimal_text(quantity),
+            'price_per_unit': decimal_text(price) if tx_type in ('buy', 'sell', 'save_profit') else None,
+            'category': category,
+            'comment': comment
+        })
+
+    aggregated = []
+    for valuation in valuations:
+        result = valuation.to_json()
+        result['transactions'] = transactions[valuation.id]
+        aggregated.append(result)
+    return aggregated
+
+
+def get_asset_balance(db, asset_id):
+    """
+    موجودی جاری یک دارایی از جدول asset_balances
+    """
+    row = db.execute('SELECT balance FROM asset_balances WHERE asset_id = ?', (asset_id,)).fetchone()
+    return decimal.Decimal(str(row['balance'])) if row else decimal.Decimal('0')
+
+
+def replay_asset_balance(asset_symbol, transactions):
+    """
+    محاسبه موجودی با مرور کامل تراکنش‌ها (Decimal) - مرجع بررسی سازگاری
+    """
+    balance = decimal.Decimal('0')
+    for tx in transactions:
+        quantity = decimal.Decimal(str(tx['quantity']))
+        if tx['type'] == 'buy':
+            balance += quantity
+        elif tx['type'] in ('sell', 'save_profit'):
+            balance -= quantity
+        elif tx['type'] in ('deposit', 'withdrawal') and asset_symbol == RIAL_WALLET_SYMBOL:
+            balance += quantity if tx['type'] == 'deposit' else -quantity
+    return balance
+
+
+def check_asset_balances(db, repair=False):
+    """
+    مقایسه موجودی‌های نگهداری شده با مرور کامل تراکنش‌ها
+
+    نبود ردیف در asset_balances مانند get_asset_balance موجودی صفر است
+    (دارایی تازه بدون تراکنش، مثل کیف پول ریالی کاربر جدید، اختلاف نیست)
+
+    Returns:
+        لیست اختلاف‌ها [{asset_id, user_id, symbol, stored, expected}]
+        با repair=True موجودی‌های کاربران دارای اختلاف بازسازی می‌شوند
+    """
+    assets = db.execute('''
+        SELECT a.id, a.user_id, a.symbol, b.balance
+        FROM assets a LEFT JOIN asset_balances b ON b.asset_id = a.id
+    ''').fetchall()
+
+    transactions = defaultdict(list)
+    for tx in db.execute('SELECT asset_id, type, quantity FROM transactions'):
+        transactions[tx['asset_id']].append(tx)
+
+    mismatches = []
+    for asset in assets:
+        expected = replay_asset_balance(asset['symbol'], transactions[asset['id']])
+        stored = decimal.Decimal(str(asset['balance'])) if asset['balance'] is not None else decimal.Decimal('0')
+        tolerance = max(BALANCE_TOLERANCE, abs(expected) * BALANCE_RELATIVE_TOLERANCE)
+        if abs(stored - expected) > tolerance:
+            mismatches.append({
+                'asset_id': asset['id'],
+                'user_id': asset['user_id'],
+                'symbol': asset['symbol'],
+                'stored': float(stored),
+                'expected': float(expected)
+            })
+
+    if repair and mismatches:
+        for user_id in {mismatch['user_id'] for mismatch in mismatches}:
+            rebuild_asset_balances(db, user_id)
+        db.commit()
+
+    return mismatches
+
+
+def verify_asset_balances():
+    """
+    بررسی دوره‌ای سازگاری موجودی‌ها و اصلاح خودکار اختلاف‌ها
+    """
+    mismatches = check_asset_balances(get_db(), repair=True)
+    if mismatches:
+        print(f"⚠️ Repaired {len(mismatches)} inconsistent asset balances")
+    else:
+        print("✅ Asset balances are consistent")
+    return mismatches
+
+
+def calculate_total_value(user_id):
+    """
+    محاسبه ارزش کل پورتفوی یک کاربر (شامل کیف پول ریالی)
+    """
+    total_value = portfolio_totals(valuate_assets(get_db(), user_id))[0]
+    return total_value / 10 ** MONEY_DECIMALS
+
+
+# ---------- کش نتایج تحلیلی هر کاربر ----------
+
+class UserResultCache:
+    """
+    کش LRU محدود نتایج تحلیلی: user_id -> (کلید نسخه، نتیجه)
+
+    کلید نسخه شامل نسخه قیمت‌ها و نسخه داده‌های کاربر در SQLite است، پس نوشتن
+    در هر پروسسی کش پروسس‌های دیگر را هم باطل می‌کند
+    """
+
+    def __init__(self, max_size=ANALYTICS_CACHE_MAX_USERS):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, user_id, key):
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None or entry[0] != key:
+                return None
+            self.entries.move_to_end(user_id)
+            return entry[1]
+
+    def put(self, user_id, key, value):
+        with self.lock:
+            self.entries[user_id] = (key, value)
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def discard(self, user_id):
+        with self.lock:
+            self.entries.pop(user_id, None)
+
+
+# ---------- توزیع پورتفوی (Allocation) ----------
+
+# آخرین توزیع محاسبه شده هر کاربر با کلید (نسخه قیمت‌ها، نسخه داده‌های کاربر)
+# در همان مرور ارزش‌گذاری update_value_analysis_for_user پر می‌شود
+allocation_cache = UserResultCache()
+
+def asset_category(symbol, table):
+    """
+    دسته دارایی برای توزیع پورتفوی (نمادهای بورس از جدول قیمت‌ها تشخیص داده می‌شوند)
+    """
+    if symbol == RIAL_WALLET_SYMBOL:
+        return 'wallet'
+    category = ALL_SYMBOLS.get(symbol)
+    if category is None:
+        row = table.row_of(symbol)
+        category = table.category_of(row) if row is not None else None
+    return category or 'other'
+
+
+def portfolio_allocation(valuations, prices, usd_price=None, gold_price=None):
+    """
+    وزن هر دسته و هر دارایی از ارزش کل، معادل دلاری/طلایی و سود/زیان هر دسته
+
+    usd_price و gold_price (تومان) اختیاری هستند؛ در نبود آن‌ها معادل‌ها None هستند
+    """
+    money_scale = 10 ** MONEY_DECIMALS
+    groups = {}
+    for valuation in valuations:
+        value = valuation.value
+        if not value:
+            continue
+        category = asset_category(valuation.symbol, prices.table)
+        group = groups.setdefault(category, {'value': 0, 'cost_basis': 0, 'profit': 0, 'realized': 0, 'assets': []})
+        group['value'] += value
+        group['assets'].append((value, valuation))
+        if not valuation.is_wallet:
+            group['cost_basis'] += valuation.cost_basis
+            group['profit'] += valuation.profit
+            group['realized'] += valuation.realized
+
+    total_value = sum(group['value'] for group in groups.values())
+
+    def equivalents(value):
+        toman = value / money_scale
+        return {
+            'value': toman,
+            'value_usd': toman / usd_price if usd_price else None,
+            'value_gold_grams': toman / gold_price if gold_price else None
+        }
+
+    def weight(value):
+        return round(value * 100 / total_value, 4) if total_value else 0
+
+    categories = []
+    for category, group in sorted(groups.items(), key=lambda item: -item[1]['value']):
+        categories.append(dict(
+            equivalents(group['value']),
+            category=category,
+            weight=weight(group['value']),
+            cost_basis=group['cost_basis'] / money_scale,
+            unrealized_profit=group['profit'] / money_scale,
+            realized_profit=group['realized'] / money_scale,
+            return_pct=round(group['profit'] * 100 / group['cost_basis'], 4) if group['cost_basis'] > 0 else 0,
+            assets=[
+                {'symbol': valuation.symbol, 'title': valuation.title, 'value': value / money_scale, 'weight': weight(value)}
+                for value, valuation in sorted(group['assets'], key=lambda item: -item[0])
+            ]
+        ))
+
+    return dict(
+        equivalents(total_value),
+        usd_price=usd_price or None,
+        gold_price=gold_price or None,
+        last_updated=prices.last_updated,
+        categories=categories
+    )
+
+
+def valuation_reference_prices():
+    """
+    قیمت دلار و طلای ۱۸ عیار (تومان) برای معادل‌سازی؛ None در صورت نبود قیمت
+    """
+    usd_price = get_symbol_price('USD')
+    gold_price = get_symbol_price('IR_GOLD_18K', None) or get_symbol_price('GOL18')
+    return (usd_price if usd_price > 0 else None), (gold_price if gold_price and gold_price > 0 else None)
+
+
+# ---------- تحلیل عملکرد (TWR، XIRR، افت و نوسان) ----------
+
+# نتایج /api/performance برای هر کاربر با کلید (نسخه قیمت‌ها، نسخه داده‌های کاربر)
+# ثبت ارزش جدید نمودار یا تراکنش نسخه داده‌ها را زیاد و کش را باطل می‌کند
+performance_cache = UserResultCache()
+
+
+def external_cash_flows(db, user_id):
+    """
+    جریان‌های نقدی خارجی هر روز (ورود پول مثبت، برداشت منفی)
+
+    خرید (ورود پول به دارایی) و فروش (خروج) با تراکنش خودکار کیف پول همان روز
+    خنثی می‌شوند؛ آنچه می‌ماند واریز/برداشت دستی کیف پول و خرید/فروش‌های
+    بدون کیف پول ریالی است
+
+    Returns:
+        لیست مرتب [(روز YYYY-MM-DD, مبلغ)]
+    """
+    rows = db.execute('''
+        SELECT substr(t.date, 1, 10) AS day, SUM(
+            CASE
+                WHEN a.symbol = ? AND t.type = 'deposit' THEN t.quantity
+                WHEN a.symbol = ? AND t.type = 'withdrawal' THEN -t.quantity
+                WHEN a.symbol != ? AND t.type = 'buy' THEN t.quantity * t.price_per_unit
+                WHEN a.symbol != ? AND t.type IN ('sell', 'save_profit') THEN -t.quantity * t.price_per_unit
+                ELSE 0
+            END
+        ) AS flow
+        FROM transactions t JOIN assets a ON a.id = t.asset_id
+        WHERE t.user_id = ?
+        GROUP BY day
+        ORDER BY day
+    ''', (RIAL_WALLET_SYMBOL,) * 4 + (user_id,)).fetchall()
+    return [(row['day'], row['flow']) for row in rows if abs(row['flow']) > PERFORMANCE_FLOW_EPSILON]
+
+
+def day_number(day):
+    return date.fromisoformat(day).toordinal()
+
+
+def xirr(flows):
+    """
+    نرخ بازده داخلی سالانه جریان‌های نقدی نامنظم [(روز ordinal, مبلغ)]
+
+    نیوتن-رافسون با شروع از ۱۰٪ و در صورت واگرایی تنصیف؛
+    None اگر جریان‌ها هم‌علامت باشند یا NPV سرریز کند (نرخ تعریف نشده)
+    """
+    if not flows or min(amount for _, amount in flows) >= 0 or max(amount for _, amount in flows) <= 0:
+        return None
+    start = flows[0][0]
+    if flows[-1][0] == start:
+        return None
+    years = [(day - start) / 365 for day, _ in flows]
+    amounts = [amount for _, amount in flows]
+
+    def npv(rate):
+        try:
+            return math.fsum(amount * (1 + rate) ** -t for t, amount in zip(years, amounts))
+        except OverflowError:
+            return None
+
+    def npv_slope(rate):
+        try:
+            return math.fsum(-t * amount * (1 + rate) ** (-t - 1) for t, amount in zip(years, amounts))
+        except OverflowError:
+            return None
+
+    rate = 0.1
+    for _ in range(XIRR_MAX_ITERATIONS):
+        value = npv(rate)
+        slope = npv_slope(rate)
+        if value is None or not slope:
+            break
+        step = value / slope
+        rate -= step
+        if rate <= -1:
+            break
+        if abs(step) < XIRR_TOLERANCE:
+            return rate
+
+    # تنصیف روی بازه‌ای که NPV در دو سر آن تغییر علامت می‌دهد
+    low, high = -0.9999, 1.0
+    low_value, high_value = npv(low), npv(high)
+    while high_value is not None and high_value > 0 and high < 1e6:
+        high *= 10
+        high_value = npv(high)
+    if low_value is None or high_value is None or low_value * high_value > 0:
+        return None
+    for _ in range(200):
+        middle = (low + high) / 2
+        middle_value = npv(middle)
+        if middle_value is None:
+            return None
+        if low_value * middle_value <= 0:
+            high = middle
+        else:
+            low, low_value = middle, middle_value
+        if high - low < XIRR_TOLERANCE:
+            break
+    return (low + high) / 2
+
+
+def compute_performance(db, user_id):
+    """
+    شاخص‌های عملکرد پورتفوی از سری ارزش (chart_data) و جریان‌های نقدی خارجی
+
+    - بازده زمان‌موزون (TWR): زنجیره بازده دوره‌های بین دو ارزش ثبت شده با حذف
+      جریان‌های نقدی آن دوره (جریان در پایان دوره فرض می‌شود)
+    - بازده پول‌موزون (XIRR): نرخ داخلی واریز/برداشت‌های بازه سری با ارزش اولین روز
+      سری به‌عنوان جریان آغازین و ارزش فعلی به‌عنوان جریان پایانی
+    - بیشترین افت و نوسان سالانه روی شاخص TWR (مستقل از واریز و برداشت)
+    جریان‌های قبل از شروع سری در ارزش آغازین آن هستند و جریان‌های با تاریخ آینده
+    (یا تاریخ نامعتبر مثل سال شمسی ۱۴۰۴ ذخیره شده به‌جای میلادی) به بازه سری محدود می‌شوند
+    همه درصدها به‌صورت درصد (نه کسر) برگردانده می‌شوند
+    """
+    valuations = valuate_assets(db, user_id)
+    current_value, _, unrealized, _ = portfolio_totals(valuations)
+    realized = sum(valuation.realized for valuation in valuations if not valuation.is_wallet)
+    money_scale = 10 ** MONEY_DECIMALS
+    current_value /= money_scale
+
+    today = datetime.now().strftime('%Y-%m-%d')
+    series = [(row['date'], row['total_value']) for row in db.execute(
+        'SELECT date, total_value FROM chart_data WHERE user_id = ? ORDER BY date', (user_id,)
+    )]
+    if not series or series[-1][0] != today:
+        series.append((today, current_value))
+    else:
+        series[-1] = (today, current_value)
+
+    flows = external_cash_flows(db, user_id)
+    net_deposits = math.fsum(amount for _, amount in flows)
+    # جریان‌های بعد از امروز در دوره آخر حساب می‌شوند
+    flows = [(min(day, today), amount) for day, amount in flows]
+    flow_days = [day for day, _ in flows]
+
+    # ---------- بازده دوره‌ها و شاخص TWR ----------
+    index = peak = 1.0
+    max_drawdown = 0.0
+    drawdown_peak = drawdown_trough = peak_day = series[0][0]
+    returns, lengths = [], []
+    for (previous_day, previous_value), (day, value) in zip(series, series[1:]):
+        period_flow = math.fsum(amount for _, amount in flows[
+            bisect.bisect_right(flow_days, previous_day):bisect.bisect_right(flow_days, day)
+        ])
+        if previous_value <= 0:
+            continue
+        period_return = (value - period_flow) / previous_value - 1
+        returns.append(period_return)
+        lengths.append(day_number(day) - day_number(previous_day))
+
+        index *= 1 + period_return
+        if index > peak:
+            peak, peak_day = index, day
+        elif index / peak - 1 < max_drawdown:
+            max_drawdown = index / peak - 1
+            drawdown_peak, drawdown_trough = peak_day, day
+
+    days = day_number(series[-1][0]) - day_number(series[0][0])
+    twr = index - 1
+
+    volatility = None
+    if len(returns) >= 2:
+        mean = math.fsum(returns) / len(returns)
+        variance = math.fsum((r - mean) ** 2 for r in returns) / (len(returns) - 1)
+        volatility = math.sqrt(variance) * math.sqrt(365 / (math.fsum(lengths) / len(lengths)))
+
+    # ---------- بازده پول‌موزون ----------
+    # از دید سرمایه‌گذار: واریز خروج پول (منفی) و ارزش فعلی ورود پول (مثبت) است
+    # جریان‌های تا اولین روز سری در ارزش آن روز هستند و جداگانه حساب نمی‌شوند
+    cash_flows = []
+    if series[0][0] < today:
+        cash_flows.append((day_number(series[0][0]), -series[0][1]))
+    cash_flows.extend((day_number(day), -amount) for day, amount in flows[bisect.bisect_right(flow_days, series[0][0]):])
+    cash_flows.append((day_number(today), current_value))
+    irr = xirr(sorted(cash_flows))
+    mwr = None
+    if irr is not None:
+        mwr = (1 + irr) ** ((cash_flows[-1][0] - min(day for day, _ in cash_flows)) / 365) - 1
+
+    def percent(value):
+        return round(value * 100, 4) if value is not None else None
+
+    return {
+        'start': series[0][0],
+        'end': series[-1][0],
+        'days': days,
+        'periods': len(returns),
+        'current_value': current_value,
+        'net_deposits': net_deposits,
+        'realized_profit': realized / money_scale,
+        'unrealized_profit': unrealized / money_scale,
+        'time_weighted_return': percent(twr),
+        'time_weighted_return_annualized': percent((1 + twr) ** (365 / days) - 1) if days >= 365 and twr > -1 else None,
+        'money_weighted_return': percent(mwr),
+        'xirr': percent(irr),
+        'max_drawdown': percent(max_drawdown),
+        'drawdown_peak': drawdown_peak if max_drawdown < 0 else None,
+        'drawdown_trough': drawdown_trough if max_drawdown < 0 else None,
+        'volatility': percent(volatility)
+    }
+
+
+# ============================================================
+#  بخش ۱۰: توابع بروزرسانی - تک‌کاربره
+# ============================================================
+
+def update_chart_data_for_user(user_id):
+    """
+    بروزرسانی داده‌های نمودار برای یک کاربر
+    ارزش کل امروز را در جدول chart_data ذخیره می‌کند
+    """
+    try:
+        db = get_db()
+        today = datetime.now().strftime('%Y-%m-%d')
+        total_value = calculate_total_value(user_id)
+
+        db.execute('''
+            INSERT OR REPLACE INTO chart_data (user_id, date, total_value)
+            VALUES (?, ?, ?)
+        ''', (user_id, today, total_value))
+        db.commit()
+        performance_cache.discard(user_id)
+        return True
+    except Exception as e:
+        print(f"❌ خطا در بروزرسانی نمودار کاربر {user_id}: {e}")
+        return False
+
+
+def update_value_analysis_for_user(user_id):
+    """
+    بروزرسانی تحلیل ارزش برای یک کاربر
+    معادل دلاری و طلایی پورتفوی را محاسبه می‌کند
+
+    توزیع پورتفوی (/api/allocation) هم از همین ارزش‌گذاری ساخته و کش می‌شود
+    """
+    prices = current_prices
+    usd_price, gold_price = valuation_reference_prices()
+
+    try:
+        db = get_db()
+        key = (prices.version, user_data_version(db, user_id))
+        allocation = portfolio_allocation(valuate_assets(db, user_id, prices), prices, usd_price, gold_price)
+        allocation_cache.put(user_id, key, allocation)
+
+        if not usd_price or not gold_price:
+            return False
+
+        today = datetime.now().strftime('%Y-%m-%d')
+        total_value = allocation['value']
+
+        db.execute('''
+            INSERT OR REPLACE INTO value_analysis
+            (user_id, date, total_value_toman, usd_price, gold_price_per_gram,
+             equivalent_usd, equivalent_gold_grams)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (user_id, today, total_value, float(usd_price), float(gold_price),
+              allocation['value_usd'], allocation['value_gold_grams']))
+        db.commit()
+        return True
+    except Exception as e:
+        print(f"❌ خطا در بروزرسانی تحلیل ارزش کاربر {user_id}: {e}")
+        return False
+
+
+def calculate_daily_profit_for_user(user_id):
+    """
+    محاسبه سود/زیان روزانه برای یک کاربر
+    تغییرات نسبت به دیروز را محاسبه و ذخیره می‌کند
+    """
+    try:
+        db = get_db()
+        today = datetime.now().strftime('%Y-%m-%d')
+        yesterday = (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d')
+
+        total_value, total_cost_basis, total_profit, asset_count = portfolio_totals(valuate_assets(db, user_id))
+
+        # محاسبه تغییر نسبت به دیروز
+        yesterday_row = db.execute(
+            'SELECT total_value FROM daily_profit WHERE user_id = ? AND date = ?',
+            (user_id, yesterday)
+        ).fetchone()
+
+        if yesterday_row:
+            yesterday_value = to_fixed(yesterday_row['total_value'], MONEY_DECIMALS)
+            daily_change = total_value - yesterday_value
+            daily_change_percent = daily_change * 100 / yesterday_value if yesterday_value > 0 else 0
+        else:
+            daily_change = 0
+            daily_change_percent = 0
+            yesterday_value = None
+
+        # محاسبه سود کل
+        total_profit_percent = total_profit * 100 / total_cost_basis if total_cost_basis > 0 else 0
+
+        money_scale = 10 ** MONEY_DECIMALS
+        total_value /= money_scale
+
+        db.execute('''
+            INSERT OR REPLACE INTO daily_profit
+            (user_id, date, total_value, total_profit, profit_percent, daily_change,
+             daily_change_percent, yesterday_value, asset_count, timestamp)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            user_id, today, total_value, total_profit / money_scale,
+            float(total_profit_percent), daily_change / money_scale,
+            float(daily_change_percent),
+            yesterday_value / money_scale if yesterday_value else None,
+            asset_count, datetime.now().isoformat()
+        ))
+        update_goal_progress(db, user_id, total_value)
+        db.commit()
+        return True
+    except Exception as e:
+        print(f"❌ خطا در محاسبه سود روزانه کاربر {user_id}: {e}")
+        return False
+
+
+def goal_unit_price(goal_type):
+    """
+    قیمت تومانی واحد هدف (۱ برای هدف تومانی، None اگر قیمت موجود نباشد)
+    """
+    symbol = GOAL_UNIT_SYMBOLS.get(goal_type)
+    if symbol is None:
+        return 1 if goal_type == 'toman' else None
+    return get_symbol_price(symbol, None) or None
+
+
+def update_goal_progress(db, user_id, total_value):
+    """
+    بروزرسانی پیشرفت هدف سرمایه‌گذاری از ارزش کل محاسبه شده (تومان)
+
+    در همان مسیر ارزش‌گذاری daily_profit فراخوانی می‌شود؛ فقط یک ردیف upsert
+    می‌شود و commit با فراخواننده است
+    """
+    goal = db.execute(
+        'SELECT goal_type, target_amount FROM investment_goals WHERE user_id = ?',
+        (user_id,)
+    ).fetchone()
+    if not goal:
+        return None
+
+    unit_price = goal_unit_price(goal['goal_type'])
+    if not unit_price or goal['target_amount'] <= 0:
+        return None
+
+    current = float(total_value) / unit_price
+    percent = min(100.0, current / goal['target_amount'] * 100)
+    now = datetime.now().isoformat()
+
+    db.execute('''
+        INSERT INTO investment_goal_progress
+        (user_id, current_value, progress_percent, total_value_toman, achieved_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            current_value = excluded.current_value,
+            progress_percent = excluded.progress_percent,
+            total_value_toman = excluded.total_value_toman,
+            achieved_at = COALESCE(investment_goal_progress.achieved_at, excluded.achieved_at),
+            updated_at = excluded.updated_at
+    ''', (user_id, current, percent, float(total_value), now if percent >= 100 else None, now))
+    return percent
+
+
+# ============================================================
+#  بخش ۱۱: توابع بروزرسانی - همه کاربران
+# ============================================================
+
+def update_chart_data_for_all_users():
+    """
+    بروزرسانی داده‌های نمودار برای تمام کاربران
+    """
+    print("📊 Updating chart data for all users...")
+    db = get_db()
+    users = db.execute('SELECT id FROM users').fetchall()
+
+    success = 0
+    for user in users:
+        if update_chart_data_for_user(user['id']):
+            success += 1
+
+    print(f"✅ Charts updated for {success} out of {len(users)} users")
+
+
+def update_value_analysis_for_all_users():
+    """
+    بروزرسانی تحلیل ارزش برای تمام کاربران
+    """
+    print("📈 Updating value analysis for all users...")
+    db = get_db()
+    users = db.execute('SELECT id FROM users').fetchall()
+
+    success = 0
+    for user in users:
+        if update_value_analysis_for_user(user['id']):
+            success += 1
+
+    print(f"✅ Value analysis updated for {success} out of {len(users)} users")
+
+
+def calculate_daily_profit_for_all_users():
+    """
+    محاسبه سود روزانه برای تمام کاربران
+    """
+    print("💰 Calculating daily profit for all users...")
+    db = get_db()
+    users = db.execute('SELECT id FROM users').fetchall()
+
+    success = 0
+    for user in users:
+        if calculate_daily_profit_for_user(user['id']):
+            success += 1
+
+    print(f"✅ Daily profit calculated for {success} out of {len(users)} users")
+
+
+# ---------- هشدارهای قیمت ----------
+#
+# هشدارها یک‌بار برای هر snapshot منتشر شده (فقط در پروسس ناشر) ارزیابی می‌شوند.
+# برای هر (نماد، فیلد) آستانه‌ها مرتب نگهداری می‌شوند؛ با تغییر مقدار از old به new
+# فقط آستانه‌های داخل این بازه با دو جستجوی دودویی پیدا می‌شوند، پس هزینه ارزیابی
+# متناسب با هشدارهای عبور کرده است نه کل هشدارها
+
+ALERT_TYPES = ('above', 'below', 'change', 'break_even')
+
+
+class AlertIndex:
+    """
+    ایندکس بازه‌ای هشدارهای فعال
+    entries: {(symbol, field): (thresholds مرتب, alerts هم‌ردیف)}
+    هر alert: (alert_id, user_id, alert_type, direction, threshold)
+    """
+
+    __slots__ = ('entries', 'signature')
+
+    def __init__(self, rows=(), signature=None):
+        self.signature = signature
+        pending = defaultdict(list)
+
+        for row in rows:
+            target = row['target']
+            if row['alert_type'] == 'change':
+                # عبور درصد تغییر از +target به بالا یا از -target به پایین
+                key = (row['symbol'], 'change_percent')
+                pending[key].append((abs(target), (row['id'], row['user_id'], 'change', 'up', target)))
+                pending[key].append((-abs(target), (row['id'], row['user_id'], 'change', 'down', target)))
+            else:
+                direction = {'above': 'up', 'below': 'down'}.get(row['alert_type'], 'any')
+                pending[(row['symbol'], 'toman_price')].append(
+                    (target, (row['id'], row['user_id'], row['alert_type'], direction, target))
+                )
+
+        self.entries = {}
+        for key, items in pending.items():
+            items.sort(key=lambda item: item[0])
+            self.entries[key] = ([item[0] for item in items], [item[1] for item in items])
+
+    def __len__(self):
+        return sum(len(thresholds) for thresholds, _ in self.entries.values())
+
+    def crossed(self, key, old, new):
+        """
+        هشدارهایی که آستانه‌شان بین old و new قرار دارد و جهت حرکت را می‌پذیرند
+        (بالا: old < t <= new، پایین: new <= t < old)
+        """
+        thresholds, alerts = self.entries[key]
+        if new > old:
+            matched = alerts[bisect.bisect_right(thresholds, old):bisect.bisect_right(thresholds, new)]
+            move = 'up'
+        elif new < old:
+            matched = alerts[bisect.bisect_left(thresholds, new):bisect.bisect_left(thresholds, old)]
+            move = 'down'
+        else:
+            return []
+        return [alert for alert in matched if alert[3] in (move, 'any')]
+
+
+alert_state = {'index': AlertIndex()}
+
+
+def alert_value(table, symbol, field):
+    """
+    مقدار فیلد مورد ارزیابی یک نماد (قیمت تومانی یا درصد تغییر)
+    """
+    row = table.row_of(symbol)
+    if row is None:
+        return None
+    if field == 'toman_price':
+        return table.toman_price(symbol, None)
+    return table.value(row, field)
+
+
+def load_alert_index(db):
+    """
+    ایندکس هشدارها؛ فقط وقتی بیشترین updated_at جدول تغییر کرده باشد
+    (هر پروسسی که هشدار را تغییر دهد) دوباره ساخته می‌شود
+    """
+    signature = db.execute('SELECT MAX(updated_at) FROM price_alerts').fetchone()[0]
+    index = alert_state['index']
+    if index.signature != signature or signature is None:
+        rows = db.execute(
+            'SELECT id, user_id, symbol, alert_type, target FROM price_alerts WHERE active = 1'
+        ).fetchall()
+        index = alert_state['index'] = AlertIndex(rows, signature)
+    return index
+
+
+def alert_message(alert_type, symbol, target, value):
+    if alert_type == 'above':
+        return f"📈 {symbol} به بالای {target:,.0f} تومان رسید ({value:,.0f})"
+    if alert_type == 'below':
+        return f"📉 {symbol} به زیر {target:,.0f} تومان رسید ({value:,.0f})"
+    if alert_type == 'change':
+        return f"⚡ تغییر روزانه {symbol} به {value:+.2f}% رسید (آستانه {abs(target):.2f}%)"
+    return f"⚖️ {symbol} از قیمت سر به سر ({target:,.0f} تومان) عبور کرد ({value:,.0f})"
+
+
+def evaluate_price_alerts(previous, snapshot):
+    """
+    ارزیابی هشدارها بین دو snapshot متوالی و ثبت هشدارهای فعال شده در alert_outbox
+    هر هشدار یک‌بار فعال و سپس غیرفعال می‌شود
+
+    Returns:
+        تعداد هشدارهای فعال شده
+    """
+    if not has_app_context():
+        with app.app_context():
+            return evaluate_price_alerts(previous, snapshot)
+
+    db = get_db()
+    index = load_alert_index(db)
+    triggered = {}
+
+    # فقط نمادهایی که هشدار دارند بررسی می‌شوند
+    for key in index.entries:
+        symbol, field = key
+        old = alert_value(previous.table, symbol, field)
+        new = alert_value(snapshot.table, symbol, field)
+        if old is None or new is None or old == new:
+            continue
+        for alert_id, user_id, alert_type, _, target in index.crossed(key, old, new):
+            triggered.setdefault(alert_id, (user_id, symbol, alert_type, target, new))
+
+    if not triggered:
+        return 0
+
+    def record(db):
+        # غیرفعال‌سازی شرطی: اگر پروسس دیگری (یا حذف کاربر) زودتر هشدار را
+        # غیرفعال کرده باشد rowcount صفر است و پیام تکراری در outbox ثبت نمی‌شود
+        now = time.time()
+        recorded = 0
+        for alert_id, (user_id, symbol, alert_type, target, value) in triggered.items():
+            cursor = db.execute(
+                'UPDATE price_alerts SET active = 0, triggered_at = CURRENT_TIMESTAMP, updated_at = ? '
+                'WHERE id = ? AND active = 1',
+                (now, alert_id)
+            )
+            if cursor.rowcount != 1:
+                continue
+            db.execute(
+                'INSERT INTO alert_outbox (alert_id, user_id, symbol, message, value) VALUES (?, ?, ?, ?, ?)',
+                (alert_id, user_id, symbol, alert_message(alert_type, symbol, target, value), value)
+            )
+            recorded += 1
+        return recorded
+
+    recorded = run_in_transaction(db, record)
+    if recorded:
+        print(f"🔔 {recorded} price alerts triggered")
+    return recorded
+
+
+def refresh_break_even_alerts(user_id):
+    """
+    بروزرسانی آستانه هشدارهای سر به سر یک کاربر پس از تغییر تراکنش‌ها
+    """
+    db = get_db()
+    alerts = db.execute(
+        "SELECT id, symbol, target FROM price_alerts WHERE user_id = ? AND alert_type = 'break_even' AND active = 1",
+        (user_id,)
+    ).fetchall()
+    if not alerts:
+        return
+
+    break_even = {
+        valuation.symbol: valuation.break_even / 10 ** PRICE_DECIMALS
+        for valuation in valuate_assets(db, user_id)
+    }
+    now = time.time()
+    for alert in alerts:
+        target = break_even.get(alert['symbol'], 0)
+        if not target:
+            # دارایی فروخته شده: هشدار سر به سر معنی ندارد
+            db.execute('UPDATE price_alerts SET active = 0, updated_at = ? WHERE id = ?', (now, alert['id']))
+        elif target != alert['target']:
+            db.execute('UPDATE price_alerts SET target = ?, updated_at = ? WHERE id = ?',
+                       (target, now, alert['id']))
+    db.commit()
+
+
+# ---------- ثبت اتمیک تراکنش‌ها ----------
+
+class TransactionError(Exception):
+    """
+    خطای اعتبارسنجی تراکنش (پیام قابل نمایش به کاربر و کد HTTP)
+    """
+
+    def __init__(self, message, status=400, index=None):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        # شماره ردیف خطادار در درخواست‌های دسته‌ای
+        self.index = index
+
+
+def is_busy_error(error):
+    message = str(error).lower()
+    return 'locked' in message or 'busy' in message
+
+
+def run_in_transaction(db, func):
+    """
+    اجرای func(db) داخل تراکنش BEGIN IMMEDIATE
+
+    قفل نوشتن از ابتدا گرفته می‌شود، پس بررسی موجودی و درج بین درخواست‌های
+    همزمان سریالی است. در صورت SQLITE_BUSY کل تراکنش با تأخیر نمایی (و کمی
+    تصادفی) دوباره اجرا می‌شود؛ هر خطای دیگر rollback و دوباره raise می‌شود
+    """
+    for attempt in range(DB_WRITE_RETRIES):
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                result = func(db)
+                db.commit()
+                return result
+            except BaseException:
+                db.rollback()
+                raise
+        except sqlite3.OperationalError as e:
+            if not is_busy_error(e) or attempt == DB_WRITE_RETRIES - 1:
+                raise
+            time.sleep(DB_WRITE_BACKOFF_SECONDS * (2 ** attempt) * (0.5 + random.random()))
+
+
+def request_fingerprint(data):
+    return hashlib.blake2b(json.dumps(data, sort_keys=True).encode(), digest_size=16).hexdigest()
+
+
+def find_idempotent_response(db, user_id, key, data):
+    """
+    پاسخ ذخیره شده برای کلید تکراری (None اگر کلید جدید باشد)
+    استفاده دوباره از کلید با بدنه متفاوت خطای 422 است
+    """
+    row = db.execute(
+        'SELECT request_hash, response FROM idempotency_keys WHERE user_id = ? AND idempotency_key = ?',
+        (user_id, key)
+    ).fetchone()
+    if row is None:
+        return None
+    if row['request_hash'] != request_fingerprint(data):
+        raise TransactionError('Idempotency-Key قبلاً با درخواست دیگری استفاده شده است', 422)
+    return json.loads(row['response'])
+
+
+def save_idempotent_response(db, user_id, key, data, response):
+    db.execute(
+        'INSERT INTO idempotency_keys (user_id, idempotency_key, request_hash, response, created_at) '
+        'VALUES (?, ?, ?, ?, ?)',
+        (user_id, key, request_fingerprint(data), json.dumps(response), time.time())
+    )
+
+
+def purge_idempotency_keys():
+    """
+    حذف کلیدهای قدیمی‌تر از IDEMPOTENCY_KEY_HOURS
+    """
+    db = get_db()
+    db.execute('DELETE FROM idempotency_keys WHERE created_at < ?',
+               (time.time() - IDEMPOTENCY_KEY_HOURS * 3600,))
+    db.commit()
+
+
+def apply_transaction(db, user_id, data, touched_assets=None):
+    """
+    اعتبارسنجی و ثبت یک تراکنش
+
+    برای خرید، موجودی کیف پول ریالی بررسی می‌شود
+    برای فروش و سیو سود، موجودی دارایی بررسی می‌شود
+    تراکنش‌های buy/sell/save_profit به‌صورت خودکار
+    تراکنش متناظر در کیف پول ایجاد می‌کنند
+
+    باید داخل run_in_transaction فراخوانی شود (commit با فراخواننده است)
 
-        aggregated = aggregate_assets(user_id)
+    صف لات‌های دارایی و کیف پول ریالی (در صورت تراکنش خودکار) همگام می‌شوند؛
+    با touched_assets (set) همگام نمی‌شوند و شناسه‌ها به آن اضافه می‌شوند
+    تا فراخواننده (ثبت دسته‌ای) برای هر دارایی یک‌بار sync کند
 
-        total_value = decimal.Decimal('0')
-        total_cost_basis = decimal.Decimal('0')
+    Returns:
+        شناسه تراکنش ثبت شده
+    Raises:
+        TransactionError در صورت نامعتبر بودن یا کافی نبودن موجودی
+    """
+    if not all(field in data for field in ['symbol', 'type', 'quantity']):
+        raise TransactionError('Missing required fields')
 
-        for asset in aggregated:
-            if asset['symbol'] != RIAL_WALLET_SYMBOL:
-                total_value += decimal.Decimal(asset['current_value'])
-                total_cost_basis += decimal.Decimal(asset['cost_basis'])
-            else:
-                total_value += decimal.Decimal(asset['total_quantity'])
+    tx_type = data['type']
+    symbol = data['symbol']
+    quantity = data['quantity']
 
-        # محاسبه تغییر نسبت به دیروز
-        yesterday_row = db.execute(
-            'SELECT total_value FROM daily_profit WHERE user_id = ? AND date = ?',
-            (user_id, yesterday)
+    if tx_type in ['buy', 'sell', 'save_profit'] and 'price_per_unit' not in data:
+        raise TransactionError('price_per_unit is required')
+
+    # ---------- بررسی موجودی کیف پول برای خرید ----------
+    if tx_type == 'buy' and symbol != RIAL_WALLET_SYMBOL:
+        rial_asset = db.execute(
+            'SELECT * FROM assets WHERE user_id = ? AND symbol = ?',
+            (user_id, RIAL_WALLET_SYMBOL)
         ).fetchone()
 
-        if yesterday_row:
-            yesterday_value = decimal.Decimal(str(yesterday_row['total_value']))
-            daily_change = total_value - yesterday_value
-            daily_change_percent = (daily_change / yesterday_value) * 100 if yesterday_value > 0 else 0
-        else:
-            daily_change = decimal.Decimal('0')
-            daily_change_percent = 0
-            yesterday_value = None
+        if rial_asset:
+            wallet_balance = get_asset_balance(db, rial_asset['id'])
 
-        # محاسبه سود کل
-        total_profit = decimal.Decimal('0')
-        for asset in aggregated:
-            if asset['symbol'] != RIAL_WALLET_SYMBOL:
-                total_profit += decimal.Decimal(asset['profit_loss'])
+            total_cost = decimal.Decimal(str(quantity)) * decimal.Decimal(str(data['price_per_unit']))
 
-        total_profit_percent = (total_profit / total_cost_basis * 100) if total_cost_basis > 0 else 0
-        asset_count = len([a for a in aggregated if decimal.Decimal(a['total_quantity']) > 0])
+            if total_cost > wallet_balance:
+                raise TransactionError(f'موجودی کیف پول کافی نیست. موجودی: {wallet_balance:,.0f} تومان')
 
-        db.execute('''
-            INSERT OR REPLACE INTO daily_profit
-            (user_id, date, total_value, total_profit, profit_percent, daily_change,
-             daily_change_percent, yesterday_value, asset_count, timestamp)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            user_id, today, float(total_value), float(total_profit),
-            float(total_profit_percent), float(daily_change),
-            float(daily_change_percent),
-            float(yesterday_value) if yesterday_value else None,
-            asset_count, datetime.now().isoformat()
-        ))
-        db.commit()
-        return True
-    except Exception as e:
-        print(f"❌ خطا در محاسبه سود روزانه کاربر {user_id}: {e}")
-        return False
+    # ---------- پیدا کردن یا ساخت دارایی ----------
+    asset = db.execute(
+        'SELECT * FROM assets WHERE user_id = ? AND symbol = ?',
+        (user_id, symbol)
+    ).fetchone()
 
+    # اگر دارایی وجود نداره و نوع تراکنش فروش یا سیو سود باشه = ارور
+    if not asset and tx_type in ['sell', 'save_profit'] and symbol != RIAL_WALLET_SYMBOL:
+        raise TransactionError(f'شما مالک "{symbol}" نیستید. ابتدا باید این دارایی را خریداری کنید.')
 
-# ============================================================
-#  بخش ۱۱: توابع بروزرسانی - همه کاربران
-# ============================================================
+    if not asset:
+        asset_id = str(uuid.uuid4())
+        asset_title = current_prices.table.title(symbol) or symbol
 
-def update_chart_data_for_all_users():
-    """
-    بروزرسانی داده‌های نمودار برای تمام کاربران
-    """
-    print("📊 Updating chart data for all users...")
-    db = get_db()
-    users = db.execute('SELECT id FROM users').fetchall()
+        db.execute(
+            'INSERT INTO assets (id, user_id, symbol, title) VALUES (?, ?, ?, ?)',
+            (asset_id, user_id, symbol, asset_title)
+        )
+    else:
+        asset_id = asset['id']
 
-    success = 0
-    for user in users:
-        if update_chart_data_for_user(user['id']):
-            success += 1
+    # ============================================================
+    # 🔥 بررسی موجودی دارایی برای فروش و سیو سود
+    # ============================================================
+    if tx_type in ['sell', 'save_profit'] and symbol != RIAL_WALLET_SYMBOL:
+        # موجودی جاری نگهداری شده (یک ردیف، بدون مرور تراکنش‌ها)
+        current_holding = get_asset_balance(db, asset_id)
 
-    print(f"✅ Charts updated for {success} out of {len(users)} users")
+        requested_qty = decimal.Decimal(str(quantity))
 
+        if requested_qty > current_holding:
+            raise TransactionError(
+                f'موجودی شما کافی نیست!\n'
+                f'موجودی فعلی {symbol}: {float(current_holding):.8f}\n'
+                f'مقدار درخواستی: {float(requested_qty):.8f}'
+            )
 
-def update_value_analysis_for_all_users():
-    """
-    بروزرسانی تحلیل ارزش برای تمام کاربران
-    """
-    print("📈 Updating value analysis for all users...")
-    db = get_db()
-    users = db.execute('SELECT id FROM users').fetchall()
+    # ---------- ثبت تراکنش اصلی ----------
+    transaction_id = str(uuid.uuid4())
+    db.execute('''
+        INSERT INTO transactions
+        (transaction_id, asset_id, user_id, type, quantity, price_per_unit, category, comment, date)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (
+        transaction_id, asset_id, user_id,
+        tx_type, float(quantity),
+        float(data['price_per_unit']) if tx_type in ['buy', 'sell', 'save_profit'] else None,
+        data.get('category', ''),
+        data.get('comment', ''),
+        data.get('date', datetime.now().isoformat())
+    ))
+    changed_assets = {asset_id}
 
-    success = 0
-    for user in users:
-        if update_value_analysis_for_user(user['id']):
-            success += 1
+    # ---------- تراکنش خودکار کیف پول ----------
+    rial_asset = db.execute(
+        'SELECT * FROM assets WHERE user_id = ? AND symbol = ?',
+        (user_id, RIAL_WALLET_SYMBOL)
+    ).fetchone()
 
-    print(f"✅ Value analysis updated for {success} out of {len(users)} users")
+    if rial_asset:
+        tx_amount = float(quantity) * float(data.get('price_per_unit', 0))
+
+        if tx_type == 'buy' and symbol != RIAL_WALLET_SYMBOL:
+            db.execute('''
+                INSERT INTO transactions
+                (transaction_id, asset_id, user_id, type, quantity, price_per_unit, category, comment, date)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                str(uuid.uuid4()), rial_asset['id'], user_id,
+                'withdrawal', tx_amount, 1,
+                data.get('category', 'خرید دارایی'),
+                f"خرید {quantity} {symbol}",
+                data.get('date', datetime.now().isoformat())
+            ))
+        elif tx_type == 'sell' and symbol != RIAL_WALLET_SYMBOL:
+            db.execute('''
+                INSERT INTO transactions
+                (transaction_id, asset_id, user_id, type, quantity, price_per_unit, category, comment, date)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                str(uuid.uuid4()), rial_asset['id'], user_id,
+                'deposit', tx_amount, 1,
+                data.get('category', 'فروش دارایی'),
+                f"فروش {quantity} {symbol}",
+                data.get('date', datetime.now().isoformat())
+            ))
+        elif tx_type == 'save_profit' and symbol != RIAL_WALLET_SYMBOL:
+            db.execute('''
+                INSERT INTO transactions
+                (transaction_id, asset_id, user_id, type, quantity, price_per_unit, category, comment, date)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                str(uuid.uuid4()), rial_asset['id'], user_id,
+                'deposit', tx_amount, 1,
+                data.get('category', 'سود سیو شده'),
+                f"انتقال سود از {symbol}",
+                data.get('date', datetime.now().isoformat())
+            ))
+        if tx_type in ('buy', 'sell', 'save_profit') and symbol != RIAL_WALLET_SYMBOL:
+            changed_assets.add(rial_asset['id'])
+
+    # ---------- همگام‌سازی صف لات‌ها و دفتر دهدهی ----------
+    if touched_assets is None:
+        method = get_cost_basis_method(db, user_id)
+        for changed_asset in changed_assets:
+            sync_asset_lots(db, changed_asset, method)
+    else:
+        touched_assets.update(changed_assets)
 
+    return transaction_id
 
-def calculate_daily_profit_for_all_users():
+
+def refresh_user_analytics(user_id):
     """
-    محاسبه سود روزانه برای تمام کاربران
+    بروزرسانی تحلیل‌های کاربر پس از تغییر تراکنش‌ها
     """
-    print("💰 Calculating daily profit for all users...")
-    db = get_db()
-    users = db.execute('SELECT id FROM users').fetchall()
-
-    success = 0
-    for user in users:
-        if calculate_daily_profit_for_user(user['id']):
-            success += 1
-
-    print(f"✅ Daily profit calculated for {success} out of {len(users)} users")
+    update_chart_data_for_user(user_id)
+    update_value_analysis_for_user(user_id)
+    calculate_daily_profit_for_user(user_id)
+    refresh_break_even_alerts(user_id)
 
 
 # ============================================================
@@ -1302,28 +4524,91 @@ def update_profile():
 def get_assets():
     """
     دریافت لیست دارایی‌های کاربر با محاسبات تجمیعی
+    با ?transactions=0 آرایه تراکنش‌های هر دارایی حذف می‌شود: تراکنش‌ها اصلاً
+    خوانده نمی‌شوند و تمام فیلدها از وضعیت ذخیره شده صف لات‌ها (valuate_assets) می‌آیند
     """
     user = get_current_user()
-    if not current_prices.get('categorized'):
-        fetch_prices()
-    return jsonify(aggregate_assets(user['id']))
+    ensure_prices()
+    include_transactions = request.args.get('transactions', '1').lower() not in ('0', 'false', 'no')
+    return jsonify(aggregate_assets(user['id'], include_transactions))
 
 
 @app.route('/api/prices', methods=['GET'])
 def get_prices():
     """
     دریافت قیمت‌های لحظه‌ای تمام بازارها (عمومی)
+
+    بدون sort ردیف‌ها به تفکیک دسته ({category: [...]}) برمی‌گردند؛ با sort ترتیب
+    سراسری حفظ می‌شود: لیست یکپارچه items که هر ردیف دسته خود (category) را دارد
+    و X-Total-Count و صفحه‌ها با همین ترتیب هستند
     """
-    if not current_prices.get('categorized'):
-        fetch_prices()
+    ensure_prices()
+    prices = current_prices
+    table = prices.table
+    total = None
+
+    if any(name in request.args for name in PRICE_QUERY_PARAMS):
+        # فیلتر/projection/صفحه‌بندی: فقط ردیف‌های انتخاب شده ساخته می‌شوند
+        rows, fields, total = query_prices(prices)
+        if price_sort_arg(table):
+            result = {'items': [dict(table.item(row, fields), category=table.category_of(row)) for row in rows]}
+        else:
+            result = {}
+            for row in rows:
+                result.setdefault(table.category_of(row), []).append(table.item(row, fields))
+    else:
+        # کپی سطحی: خروجی دسته‌بندی شده snapshot بین درخواست‌ها مشترک است
+        result = dict(prices.categorized())
 
-    result = current_prices.get('categorized', {})
-    if 'api_error' in current_prices:
-        result['api_error'] = current_prices['api_error']
-    if 'last_updated' in current_prices:
-        result['last_updated'] = current_prices['last_updated']
+    if prices.api_error:
+        result['api_error'] = prices.api_error
+    if prices.last_updated:
+        result['last_updated'] = prices.last_updated
+
+    freshness = price_freshness(prices)
+    result['freshness'] = freshness
+    result['stale'] = any(entry['stale'] for entry in freshness.values())
+
+    response = jsonify(result)
+    if total is not None:
+        response.headers['X-Total-Count'] = str(total)
+    return response
 
-    return jsonify(result)
+
+@app.route('/api/markets/summary', methods=['GET'])
+def get_markets_summary():
+    """
+    خلاصه فشرده بازارها (گسترش بازار و بیشترین رشد/افت/تغییر هر دسته)
+
+    پارامترها:
+        category: فقط یک دسته (اختیاری)
+        top: تعداد آیتم هر فهرست (حداکثر MARKET_SUMMARY_TOP)
+    """
+    ensure_prices()
+    prices = current_prices
+
+    summary = prices.summary
+    category = request.args.get('category')
+    if category:
+        if category not in summary:
+            return jsonify({'error': f'Category "{category}" not found'}), 400
+        summary = {category: summary[category]}
+
+    top = request.args.get('top', type=int)
+    if top is not None and 0 <= top < MARKET_SUMMARY_TOP:
+        summary = {
+            name: {
+                key: value[:top] if isinstance(value, list) else value
+                for key, value in stats.items()
+            }
+            for name, stats in summary.items()
+        }
+
+    return jsonify({
+        'last_updated': prices.last_updated,
+        'stale': any(is_price_stale(name, prices) for name in summary),
+        'categories': summary
+    })
 
 
 @app.route('/api/chart-data', methods=['GET'])
@@ -1331,16 +4616,19 @@ def get_prices():
 def get_chart_data():
     """
     دریافت داده‌های نمودار ارزش پورتفوی در طول زمان
+    پشتیبانی از from, to, limit, cursor و max_points
+
+    پاسخ دیکشنری {تاریخ: ارزش} است که همیشه به ترتیب صعودی تاریخ برمی‌گردد
+    (کلیدهای JSON مرتب می‌شوند)، پس order پشتیبانی نمی‌شود و صفحه‌ها از قدیمی‌ترین شروع می‌شوند
     """
     user = get_current_user()
     db = get_db()
 
-    rows = db.execute(
-        'SELECT date, total_value FROM chart_data WHERE user_id = ? ORDER BY date',
-        (user['id'],)
-    ).fetchall()
+    rows, next_cursor = query_history(
+        db, 'chart_data', 'date, total_value', user['id'], 'total_value', ordered=False
+    )
 
-    return jsonify({row['date']: row['total_value'] for row in rows})
+    return history_response({row['date']: row['total_value'] for row in rows}, next_cursor)
 
 
 # ============================================================
@@ -1392,17 +4680,17 @@ def get_value_analysis():
 @login_required
 def get_comparison_data():
     """
-    دریافت تاریخچه کامل تحلیل ارزش
+    دریافت تاریخچه تحلیل ارزش
+    پشتیبانی از from, to, limit, cursor, order و max_points
     """
     user = get_current_user()
     db = get_db()
 
-    rows = db.execute(
-        'SELECT * FROM value_analysis WHERE user_id = ? ORDER BY date',
-        (user['id'],)
-    ).fetchall()
+    rows, next_cursor = query_history(
+        db, 'value_analysis', '*', user['id'], 'total_value_toman'
+    )
 
-    return jsonify([dict(row) for row in rows])
+    return history_response([dict(row) for row in rows], next_cursor)
 
 
 @app.route('/api/today-profit', methods=['GET'])
@@ -1436,201 +4724,182 @@ def get_today_profit():
 def get_daily_profit_history():
     """
     دریافت تاریخچه سود روزانه
+    پشتیبانی از from, to, limit, cursor, order و max_points
     """
     user = get_current_user()
     db = get_db()
 
-    rows = db.execute(
-        'SELECT * FROM daily_profit WHERE user_id = ? ORDER BY date',
-        (user['id'],)
-    ).fetchall()
-
-    return jsonify([dict(row) for row in rows])
+    rows, next_cursor = query_history(
+        db, 'daily_profit', '*', user['id'], 'total_value'
+    )
 
+    return history_response([dict(row) for row in rows], next_cursor)
 
-# ============================================================
-#  بخش ۱۵: روت‌های تراکنش‌ها
-# ============================================================
 
-@app.route('/api/transactions', methods=['POST'])
+@app.route('/api/performance', methods=['GET'])
 @login_required
-def add_transaction():
+def get_performance():
     """
-    ثبت تراکنش جدید
+    شاخص‌های عملکرد پورتفوی: بازده زمان‌موزون و پول‌موزون (XIRR)،
+    بیشترین افت، نوسان سالانه و سود محقق شده/نشده
 
-    برای خرید، موجودی کیف پول ریالی بررسی می‌شود
-    برای فروش و سیو سود، موجودی دارایی بررسی می‌شود
-    تراکنش‌های buy/sell/save_profit به‌صورت خودکار
-    تراکنش متناظر در کیف پول ایجاد می‌کنند
+    نتیجه برای هر کاربر تا انتشار قیمت‌های جدید یا تغییر داده‌های کاربر
+    (تراکنش، نمودار، تنظیمات) کش می‌شود
     """
     user = get_current_user()
-    data = request.json
+    ensure_prices()
     db = get_db()
+    key = (current_prices.version, user_data_version(db, user['id']))
 
-    if not all(field in data for field in ['symbol', 'type', 'quantity']):
-        return jsonify({'error': 'Missing required fields'}), 400
+    result = performance_cache.get(user['id'], key)
+    if result is None:
+        result = compute_performance(db, user['id'])
+        performance_cache.put(user['id'], key, result)
 
-    tx_type = data['type']
-    symbol = data['symbol']
-    quantity = data['quantity']
+    return jsonify(result)
 
-    if tx_type in ['buy', 'sell', 'save_profit'] and 'price_per_unit' not in data:
-        return jsonify({'error': 'price_per_unit is required'}), 400
 
-    # ---------- بررسی موجودی کیف پول برای خرید ----------
-    if tx_type == 'buy' and symbol != RIAL_WALLET_SYMBOL:
-        rial_asset = db.execute(
-            'SELECT * FROM assets WHERE user_id = ? AND symbol = ?',
-            (user['id'], RIAL_WALLET_SYMBOL)
-        ).fetchone()
+@app.route('/api/allocation', methods=['GET'])
+@login_required
+def get_allocation():
+    """
+    توزیع پورتفوی به تفکیک دسته (crypto, gold_coin, currency, stock, wallet)
+    با وزن، معادل دلاری و طلایی و سود/زیان هر دسته
 
-        if rial_asset:
-            rial_transactions = db.execute(
-                'SELECT type, quantity FROM transactions WHERE asset_id = ?',
-                (rial_asset['id'],)
-            ).fetchall()
-
-            wallet_balance = sum(
-                decimal.Decimal(str(tx['quantity'])) if tx['type'] == 'deposit'
-                else -decimal.Decimal(str(tx['quantity']))
-                for tx in rial_transactions
-            )
+    نتیجه در کش همین پروسس تا انتشار قیمت‌های جدید یا تغییر دارایی‌ها و
+    تراکنش‌های کاربر نگه داشته می‌شود. بروزرسانی تحلیل ارزش فقط کش پروسسی را
+    پر می‌کند که جاب زمان‌بند را اجرا می‌کند؛ در حالت leader/off پروسس‌های وب
+    (که جاب ندارند) نتیجه را با اولین درخواست پس از هر تغییر خودشان محاسبه می‌کنند
+    """
+    user = get_current_user()
+    ensure_prices()
+    prices = current_prices
+    db = get_db()
+    key = (prices.version, user_data_version(db, user['id']))
 
-            total_cost = decimal.Decimal(str(quantity)) * decimal.Decimal(str(data['price_per_unit']))
+    allocation = allocation_cache.get(user['id'], key)
+    if allocation is None:
+        usd_price, gold_price = valuation_reference_prices()
+        allocation = portfolio_allocation(valuate_assets(db, user['id'], prices), prices, usd_price, gold_price)
+        allocation_cache.put(user['id'], key, allocation)
 
-            if total_cost > wallet_balance:
-                return jsonify({
-                    'error': f'موجودی کیف پول کافی نیست. موجودی: {wallet_balance:,.0f} تومان'
-                }), 400
+    return jsonify(allocation)
 
-    # ---------- پیدا کردن یا ساخت دارایی ----------
-    asset = db.execute(
-        'SELECT * FROM assets WHERE user_id = ? AND symbol = ?',
-        (user['id'], symbol)
-    ).fetchone()
 
-    # اگر دارایی وجود نداره و نوع تراکنش فروش یا سیو سود باشه = ارور
-    if not asset and tx_type in ['sell', 'save_profit'] and symbol != RIAL_WALLET_SYMBOL:
-        return jsonify({
-            'error': f'شما مالک "{symbol}" نیستید. ابتدا باید این دارایی را خریداری کنید.'
-        }), 400
+# ============================================================
+#  بخش ۱۵: روت‌های تراکنش‌ها
+# ============================================================
 
-    if not asset:
-        asset_id = str(uuid.uuid4())
-        asset_title = symbol
+@app.route('/api/transactions', methods=['POST'])
+@login_required
+def add_transaction():
+    """
+    ثبت تراکنش جدید
 
-        for category_items in current_prices.get('categorized', {}).values():
-            if isinstance(category_items, list):
-                for item in category_items:
-                    if item.get('symbol') == symbol:
-                        asset_title = item.get('title') or item.get('name') or symbol
-                        break
+    بررسی موجودی و درج داخل یک تراکنش BEGIN IMMEDIATE انجام می‌شود تا
+    درخواست‌های همزمان نتوانند کیف پول یا دارایی را منفی کنند
 
-        db.execute(
-            'INSERT INTO assets (id, user_id, symbol, title) VALUES (?, ?, ?, ?)',
-            (asset_id, user['id'], symbol, asset_title)
-        )
-    else:
-        asset_id = asset['id']
+    هدر اختیاری Idempotency-Key: تکرار همان درخواست (مثلاً retry کلاینت)
+    پاسخ قبلی را برمی‌گرداند و ردیف تکراری نمی‌سازد
+    """
+    user = get_current_user()
+    data = request.json or {}
+    idempotency_key = request.headers.get('Idempotency-Key')
 
-    # ============================================================
-    # 🔥 بررسی موجودی دارایی برای فروش و سیو سود
-    # ============================================================
-    if tx_type in ['sell', 'save_profit'] and symbol != RIAL_WALLET_SYMBOL:
-        # محاسبه موجودی فعلی از روی تمام تراکنش‌های قبلی این دارایی
-        txs = db.execute(
-            'SELECT type, quantity FROM transactions WHERE asset_id = ? ORDER BY date',
-            (asset_id,)
-        ).fetchall()
+    def write(db):
+        if idempotency_key:
+            stored = find_idempotent_response(db, user['id'], idempotency_key, data)
+            if stored is not None:
+                return stored, True
+
+        transaction_id = apply_transaction(db, user['id'], data)
+        result = {'success': True, 'transaction_id': transaction_id}
+
+        if idempotency_key:
+            save_idempotent_response(db, user['id'], idempotency_key, data, result)
+        return result, False
+
+    try:
+        result, replayed = run_in_transaction(get_db(), write)
+    except TransactionError as e:
+        return jsonify({'error': e.message}), e.status
+
+    if replayed:
+        response = jsonify(result)
+        response.headers['Idempotent-Replayed'] = 'true'
+        return response
 
-        current_holding = decimal.Decimal('0')
-        for tx in txs:
-            qty = decimal.Decimal(str(tx['quantity']))
-            if tx['type'] == 'buy':
-                current_holding += qty
-            elif tx['type'] in ['sell', 'save_profit']:
-                current_holding -= qty
+    # بروزرسانی همه تحلیل‌ها
+    refresh_user_analytics(user['id'])
 
-        requested_qty = decimal.Decimal(str(quantity))
+    return jsonify(result)
 
-        if requested_qty > current_holding:
-            return jsonify({
-                'error': (
-                    f'موجودی شما کافی نیست!\n'
-                    f'موجودی فعلی {symbol}: {float(current_holding):.8f}\n'
-                    f'مقدار درخواستی: {float(requested_qty):.8f}'
-                )
-            }), 400
+@app.route('/api/transactions/batch', methods=['POST'])
+@login_required
+def add_transactions_batch():
+    """
+    ثبت دسته‌ای تراکنش‌ها (مثلاً انتقال از اکسل یا صورتحساب کارگزاری)
 
-    # ---------- ثبت تراکنش اصلی ----------
-    transaction_id = str(uuid.uuid4())
-    db.execute('''
-        INSERT INTO transactions
-        (transaction_id, asset_id, user_id, type, quantity, price_per_unit, category, comment, date)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (
-        transaction_id, asset_id, user['id'],
-        tx_type, float(quantity),
-        float(data['price_per_unit']) if tx_type in ['buy', 'sell', 'save_profit'] else None,
-        data.get('category', ''),
-        data.get('comment', ''),
-        data.get('date', datetime.now().isoformat())
-    ))
+    بدنه: {"transactions": [{symbol, type, quantity, price_per_unit, ...}, ...]}
 
-    # ---------- تراکنش خودکار کیف پول ----------
-    rial_asset = db.execute(
-        'SELECT * FROM assets WHERE user_id = ? AND symbol = ?',
-        (user['id'], RIAL_WALLET_SYMBOL)
-    ).fetchone()
+    ردیف‌ها به ترتیب ارسال و هرکدام با موجودی جاری حاصل از ردیف‌های قبلی
+    همین دسته (به همراه تراکنش‌های متناظر کیف پول) اعتبارسنجی می‌شوند.
+    کل دسته در یک تراکنش ثبت می‌شود: با خطای هر ردیف هیچ ردیفی ثبت نمی‌شود.
+    صف لات‌ها پس از ثبت همه ردیف‌ها برای هر دارایی یک‌بار همگام می‌شود (ردیف‌های
+    با تاریخ قبلی به‌جای بازسازی به ازای هر ردیف فقط یک بازسازی دارند) و
+    تحلیل‌ها فقط یک‌بار در پایان بروز می‌شوند. Idempotency-Key مانند ثبت تکی
+    """
+    user = get_current_user()
+    data = request.json or {}
+    items = data.get('transactions') if isinstance(data, dict) else data
+    idempotency_key = request.headers.get('Idempotency-Key')
+
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'لیست تراکنش‌ها خالی یا نامعتبر است'}), 400
+    if len(items) > TRANSACTION_BATCH_MAX:
+        return jsonify({'error': f'حداکثر {TRANSACTION_BATCH_MAX} تراکنش در هر درخواست مجاز است'}), 400
+
+    def write(db):
+        if idempotency_key:
+            stored = find_idempotent_response(db, user['id'], idempotency_key, data)
+            if stored is not None:
+                return stored, True
+
+        transaction_ids = []
+        touched_assets = set()
+        for index, item in enumerate(items):
+            if not isinstance(item, dict):
+                raise TransactionError(f'ردیف {index + 1}: تراکنش نامعتبر است', index=index)
+            try:
+                transaction_ids.append(apply_transaction(db, user['id'], item, touched_assets))
+            except TransactionError as e:
+                raise TransactionError(f'ردیف {index + 1}: {e.message}', e.status, index) from e
+            except (TypeError, ValueError, decimal.InvalidOperation) as e:
+                raise TransactionError(f'ردیف {index + 1}: مقادیر عددی نامعتبر است', index=index) from e
 
-    if rial_asset:
-        tx_amount = float(quantity) * float(data.get('price_per_unit', 0))
+        method = get_cost_basis_method(db, user['id'])
+        for asset_id in touched_assets:
+            sync_asset_lots(db, asset_id, method)
 
-        if tx_type == 'buy' and symbol != RIAL_WALLET_SYMBOL:
-            db.execute('''
-                INSERT INTO transactions
-                (transaction_id, asset_id, user_id, type, quantity, price_per_unit, category, comment, date)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                str(uuid.uuid4()), rial_asset['id'], user['id'],
-                'withdrawal', tx_amount, 1,
-                data.get('category', 'خرید دارایی'),
-                f"خرید {quantity} {symbol}",
-                data.get('date', datetime.now().isoformat())
-            ))
-        elif tx_type == 'sell' and symbol != RIAL_WALLET_SYMBOL:
-            db.execute('''
-                INSERT INTO transactions
-                (transaction_id, asset_id, user_id, type, quantity, price_per_unit, category, comment, date)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                str(uuid.uuid4()), rial_asset['id'], user['id'],
-                'deposit', tx_amount, 1,
-                data.get('category', 'فروش دارایی'),
-                f"فروش {quantity} {symbol}",
-                data.get('date', datetime.now().isoformat())
-            ))
-        elif tx_type == 'save_profit' and symbol != RIAL_WALLET_SYMBOL:
-            db.execute('''
-                INSERT INTO transactions
-                (transaction_id, asset_id, user_id, type, quantity, price_per_unit, category, comment, date)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                str(uuid.uuid4()), rial_asset['id'], user['id'],
-                'deposit', tx_amount, 1,
-                data.get('category', 'سود سیو شده'),
-                f"انتقال سود از {symbol}",
-                data.get('date', datetime.now().isoformat())
-            ))
+        result = {'success': True, 'count': len(transaction_ids), 'transaction_ids': transaction_ids}
+        if idempotency_key:
+            save_idempotent_response(db, user['id'], idempotency_key, data, result)
+        return result, False
 
-    db.commit()
+    try:
+        result, replayed = run_in_transaction(get_db(), write)
+    except TransactionError as e:
+        return jsonify({'error': e.message, 'index': e.index}), e.status
 
-    # بروزرسانی همه تحلیل‌ها
-    update_chart_data_for_user(user['id'])
-    update_value_analysis_for_user(user['id'])
-    calculate_daily_profit_for_user(user['id'])
+    if replayed:
+        response = jsonify(result)
+        response.headers['Idempotent-Replayed'] = 'true'
+        return response
+
+    refresh_user_analytics(user['id'])
+
+    return jsonify(result)
 
-    return jsonify({'success': True, 'transaction_id': transaction_id})
 
 @app.route('/api/transactions/<transaction_id>', methods=['PUT'])
 @login_required
@@ -1673,11 +4942,10 @@ def update_transaction(transaction_id):
     if updates:
         params.append(transaction_id)
         db.execute(f'UPDATE transactions SET {", ".join(updates)} WHERE transaction_id = ?', params)
+        sync_asset_lots(db, tx['asset_id'], get_cost_basis_method(db, user['id']))
         db.commit()
 
-        update_chart_data_for_user(user['id'])
-        update_value_analysis_for_user(user['id'])
-        calculate_daily_profit_for_user(user['id'])
+        refresh_user_analytics(user['id'])
 
     return jsonify({'success': True})
 
@@ -1713,15 +4981,46 @@ def delete_transaction(transaction_id):
         if asset and asset['symbol'] != RIAL_WALLET_SYMBOL:
             db.execute('DELETE FROM assets WHERE id = ?', (tx['asset_id'],))
 
+    sync_asset_lots(db, tx['asset_id'], get_cost_basis_method(db, user['id']))
     db.commit()
 
-    update_chart_data_for_user(user['id'])
-    update_value_analysis_for_user(user['id'])
-    calculate_daily_profit_for_user(user['id'])
+    refresh_user_analytics(user['id'])
 
     return jsonify({'success': True})
 
 
+@app.route('/api/user/cost-basis-method', methods=['GET', 'POST'])
+@login_required
+def cost_basis_method_route():
+    """
+    دریافت یا تغییر روش محاسبه بهای تمام‌شده (average، fifo یا lifo)
+    با تغییر روش، صف لات‌های تمام دارایی‌ها دوباره ساخته می‌شود
+    """
+    user = get_current_user()
+    db = get_db()
+
+    if request.method == 'GET':
+        return jsonify({'method': get_cost_basis_method(db, user['id']), 'methods': list(COST_BASIS_METHODS)})
+
+    method = (request.json or {}).get('method')
+    if method not in COST_BASIS_METHODS:
+        return jsonify({'error': f'روش نامعتبر است ({", ".join(COST_BASIS_METHODS)})'}), 400
+
+    def save(db):
+        db.execute('''
+            INSERT INTO user_settings (user_id, cost_basis_method, updated_at) VALUES (?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                cost_basis_method = excluded.cost_basis_method,
+                updated_at = excluded.updated_at
+        ''', (user['id'], method, datetime.now().isoformat()))
+        sync_user_lots(db, user['id'])
+
+    run_in_transaction(db, save)
+    refresh_user_analytics(user['id'])
+
+    return jsonify({'success': True, 'method': method})
+
+
 # ============================================================
 #  بخش ۱۶: روت‌های واچ‌لیست و هدف‌گذاری
 # ============================================================
@@ -1764,6 +5063,151 @@ def handle_watchlist():
     return jsonify({'success': True, 'action': action})
 
 
+@app.route('/api/watchlist/quotes', methods=['GET'])
+@login_required
+def get_watchlist_quotes():
+    """
+    قیمت لحظه‌ای نمادهای واچ‌لیست در یک پاسخ کوچک
+
+    ETag از نسخه snapshot قیمت‌ها، نمادهای واچ‌لیست و وضعیت کهنگی قیمت‌ها ساخته
+    می‌شود (کهنه شدن بدون انتشار نسخه جدید هم پاسخ را تغییر می‌دهد)؛
+    اگر هیچ‌کدام تغییر نکرده باشد پاسخ 304 بدون بدنه است
+    """
+    user = get_current_user()
+    db = get_db()
+    ensure_prices()
+    prices = current_prices
+
+    rows = db.execute(
+        'SELECT symbol, category FROM watchlist WHERE user_id = ? ORDER BY rowid',
+        (user['id'],)
+    ).fetchall()
+
+    stale = any(is_price_stale(category, prices) for category in prices.freshness)
+    watchlist_key = '\n'.join(f"{row['symbol']}:{row['category']}" for row in rows)
+    etag = hashlib.blake2b(f'{prices.etag}\n{int(stale)}\n{watchlist_key}'.encode(), digest_size=8).hexdigest()
+
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+    else:
+        table = prices.table
+        quotes = []
+        for row in rows:
+            index = table.row_of(row['symbol'])
+            quote = table.item(index, WATCHLIST_QUOTE_FIELDS) if index is not None else {}
+            quote.update(symbol=row['symbol'], category=row['category'], available=index is not None)
+            quotes.append(quote)
+
+        response = jsonify({
+            'last_updated': prices.last_updated,
+            'stale': stale,
+            'quotes': quotes
+        })
+
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+@app.route('/api/alerts', methods=['GET', 'POST'])
+@login_required
+def handle_price_alerts():
+    """
+    مدیریت هشدارهای قیمت
+    GET: لیست هشدارها (فعال و فعال شده)
+    POST: ثبت هشدار جدید
+        {symbol, type: above|below|change|break_even, target}
+        target برای change درصد است و برای break_even از قیمت سر به سر دارایی محاسبه می‌شود
+    """
+    user = get_current_user()
+    db = get_db()
+
+    if request.method == 'GET':
+        rows = db.execute(
+            'SELECT id, symbol, alert_type, target, active, created_at, triggered_at '
+            'FROM price_alerts WHERE user_id = ? AND (active = 1 OR triggered_at IS NOT NULL) '
+            'ORDER BY active DESC, id DESC',
+            (user['id'],)
+        ).fetchall()
+        return jsonify([dict(row) for row in rows])
+
+    data = request.json or {}
+    symbol = data.get('symbol')
+    alert_type = data.get('type')
+
+    if alert_type not in ALERT_TYPES:
+        return jsonify({'error': f'نوع هشدار نامعتبر است ({", ".join(ALERT_TYPES)})'}), 400
+    if symbol not in current_prices.table:
+        return jsonify({'error': f'نماد "{symbol}" یافت نشد'}), 400
+
+    if alert_type == 'break_even':
+        break_even = {valuation.symbol: valuation.break_even for valuation in valuate_assets(db, user['id'])}
+        target = break_even.get(symbol, 0) / 10 ** PRICE_DECIMALS
+        if not target:
+            return jsonify({'error': f'برای "{symbol}" قیمت سر به سر وجود ندارد. ابتدا باید این دارایی را خریداری کنید.'}), 400
+    else:
+        try:
+            target = float(data.get('target'))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'مقدار هدف نامعتبر است'}), 400
+        if target <= 0:
+            return jsonify({'error': 'مقدار هدف باید بزرگتر از صفر باشد'}), 400
+
+    cursor = db.execute(
+        'INSERT INTO price_alerts (user_id, symbol, alert_type, target, updated_at) VALUES (?, ?, ?, ?, ?)',
+        (user['id'], symbol, alert_type, target, time.time())
+    )
+    db.commit()
+    return jsonify({'success': True, 'id': cursor.lastrowid, 'target': target})
+
+
+@app.route('/api/alerts/<int:alert_id>', methods=['DELETE'])
+@login_required
+def delete_price_alert(alert_id):
+    """
+    حذف یک هشدار قیمت
+    """
+    user = get_current_user()
+    db = get_db()
+
+    # حذف نرم: ردیف با updated_at جدید می‌ماند تا ایندکس حافظه تغییر را ببیند
+    cursor = db.execute(
+        'UPDATE price_alerts SET active = 0, updated_at = ? WHERE id = ? AND user_id = ? AND active = 1',
+        (time.time(), alert_id, user['id'])
+    )
+    db.commit()
+
+    if not cursor.rowcount:
+        return jsonify({'error': 'Alert not found'}), 404
+    return jsonify({'success': True})
+
+
+@app.route('/api/alerts/outbox', methods=['GET'])
+@login_required
+def get_alert_outbox():
+    """
+    تحویل هشدارهای فعال شده‌ای که هنوز به کاربر نرسیده‌اند
+    پیام‌های برگردانده شده تحویل شده علامت می‌خورند
+    """
+    user = get_current_user()
+    db = get_db()
+
+    rows = db.execute(
+        'SELECT id, alert_id, symbol, message, value, created_at FROM alert_outbox '
+        'WHERE user_id = ? AND delivered_at IS NULL ORDER BY id',
+        (user['id'],)
+    ).fetchall()
+
+    if rows:
+        db.execute(
+            'UPDATE alert_outbox SET delivered_at = CURRENT_TIMESTAMP WHERE user_id = ? AND delivered_at IS NULL AND id <= ?',
+            (user['id'], rows[-1]['id'])
+        )
+        db.commit()
+
+    return jsonify([dict(row) for row in rows])
+
+
 @app.route('/api/investment-goal', methods=['GET', 'POST', 'DELETE'])
 @login_required
 def handle_investment_goal():
@@ -1786,20 +5230,125 @@ def handle_investment_goal():
     elif request.method == 'POST':
         data = request.json
         db.execute('DELETE FROM investment_goals WHERE user_id = ?', (user['id'],))
+        db.execute('DELETE FROM investment_goal_progress WHERE user_id = ?', (user['id'],))
         db.execute('''
             INSERT INTO investment_goals (user_id, goal_type, target_amount, days, start_date)
             VALUES (?, ?, ?, ?, ?)
         ''', (user['id'], data['type'], float(data['amount']),
               data.get('days'), datetime.now().date().isoformat()))
+
+        # پیشرفت اولیه از آخرین ارزش‌گذاری ذخیره شده
+        latest = db.execute(
+            'SELECT total_value FROM daily_profit WHERE user_id = ? ORDER BY date DESC LIMIT 1',
+            (user['id'],)
+        ).fetchone()
+        if latest:
+            update_goal_progress(db, user['id'], latest['total_value'])
         db.commit()
         return jsonify({'success': True})
 
     elif request.method == 'DELETE':
         db.execute('DELETE FROM investment_goals WHERE user_id = ?', (user['id'],))
+        db.execute('DELETE FROM investment_goal_progress WHERE user_id = ?', (user['id'],))
         db.commit()
         return jsonify({'success': True})
 
 
+@app.route('/api/investment-goal/progress', methods=['GET'])
+@login_required
+def get_investment_goal_progress():
+    """
+    پیشرفت هدف سرمایه‌گذاری و پیش‌بینی زمان رسیدن به آن
+
+    پیش‌بینی با دو برازش روی ارزش کل chart_data در GOAL_PROJECTION_DAYS روز اخیر:
+    - linear: رشد ثابت روزانه (تومان در روز)
+    - compound: رشد مرکب روزانه (برازش خطی روی لگاریتم ارزش)
+    هدف‌های غیرتومانی با قیمت فعلی واحد به تومان تبدیل می‌شوند
+    """
+    user = get_current_user()
+    db = get_db()
+
+    goal = db.execute('SELECT * FROM investment_goals WHERE user_id = ?', (user['id'],)).fetchone()
+    if not goal:
+        return jsonify({'error': 'هدفی ثبت نشده است'}), 404
+
+    progress = db.execute(
+        'SELECT * FROM investment_goal_progress WHERE user_id = ?', (user['id'],)
+    ).fetchone()
+
+    today = datetime.now().date()
+    deadline = None
+    if goal['days']:
+        deadline = date.fromisoformat(goal['start_date']) + timedelta(days=goal['days'])
+
+    result = {
+        'goal': {
+            'type': goal['goal_type'],
+            'target_amount': goal['target_amount'],
+            'days': goal['days'],
+            'start_date': goal['start_date'],
+            'deadline': deadline.isoformat() if deadline else None
+        },
+        'current': progress['current_value'] if progress else None,
+        'percent': progress['progress_percent'] if progress else None,
+        'remaining': max(0.0, goal['target_amount'] - progress['current_value']) if progress else None,
+        'achieved_at': progress['achieved_at'] if progress else None,
+        'updated_at': progress['updated_at'] if progress else None,
+        'days_left': max(0, (deadline - today).days) if deadline else None,
+        'projection': None
+    }
+
+    unit_price = goal_unit_price(goal['goal_type'])
+    if not progress or not unit_price:
+        return jsonify(result)
+
+    since = (today - timedelta(days=GOAL_PROJECTION_DAYS)).isoformat()
+    rows = db.execute(
+        'SELECT julianday(date) AS day, total_value FROM chart_data '
+        'WHERE user_id = ? AND date >= ? AND total_value > 0 ORDER BY date',
+        (user['id'], since)
+    ).fetchall()
+
+    days = [row['day'] - rows[0]['day'] for row in rows]
+    values = [row['total_value'] for row in rows]
+    target = goal['target_amount'] * unit_price
+    current = progress['total_value_toman']
+
+    def completion(days_needed):
+        if days_needed is None:
+            return {'completion_date': None, 'on_track': False if deadline else None}
+        completion_date = today + timedelta(days=math.ceil(max(0.0, days_needed)))
+        return {
+            'completion_date': completion_date.isoformat(),
+            'on_track': completion_date <= deadline if deadline else None
+        }
+
+    linear = fit_trend(days, values)
+    compound = fit_trend(days, [math.log(value) for value in values])
+
+    linear_rate = linear[1] if linear else None
+    compound_rate = compound[1] if compound else None
+
+    result['projection'] = {
+        'points': len(rows),
+        'linear': {
+            'daily_change': linear_rate,
+            **completion(
+                0.0 if current >= target else
+                (target - current) / linear_rate if linear_rate and linear_rate > 0 else None
+            )
+        },
+        'compound': {
+            'daily_growth_percent': math.expm1(compound_rate) * 100 if compound_rate is not None else None,
+            **completion(
+                0.0 if current >= target else
+                math.log(target / current) / compound_rate if compound_rate and compound_rate > 0 and current > 0 else None
+            )
+        }
+    }
+    return jsonify(result)
+
+
 # ============================================================
 #  بخش ۱۷: روت‌های ورودی/خروجی اطلاعات
 # ============================================================
@@ -1973,7 +5522,9 @@ def import_user_data():
                 (str(uuid.uuid4()), user['id'], RIAL_WALLET_SYMBOL, 'کیف پول ریالی')
             )
 
+        sync_user_lots(db, user['id'])
         db.commit()
+        refresh_break_even_alerts(user['id'])
         return jsonify({'success': True, 'message': 'اطلاعات با موفقیت بازیابی شد'})
 
     except Exception as e:
@@ -2020,7 +5571,8 @@ def simple_api_browser(api_key):
     db.commit()
 
     # دریافت قیمت‌ها
-    prices_data = read_json_file(PRICES_FILE)
+    prices = current_prices
+    prices_data = prices.categorized()
 
     if not prices_data:
         return jsonify({'error': 'Prices not available'}), 503
@@ -2030,7 +5582,7 @@ def simple_api_browser(api_key):
     return jsonify({
         'status': 'success',
         'timestamp': datetime.now(timezone.utc).isoformat(),
-        'last_updated': current_prices.get('last_updated', 'unknown'),
+        'last_updated': prices.last_updated or 'unknown',
         'rate_limit': rate_status,
         'data': prices_data
     })
@@ -2130,7 +5682,7 @@ def get_api_stats():
     return jsonify({
         'today_requests': today_requests['count'] if today_requests else 0,
         'total_requests': total_requests['count'] if total_requests else 0,
-        'last_price_update': current_prices.get('last_updated', '-')
+        'last_price_update': current_prices.last_updated or '-'
     })
 
 
@@ -2170,7 +5722,8 @@ def public_api_prices():
     db.commit()
 
     category = request.args.get('category')
-    prices_data = read_json_file(PRICES_FILE)
+    prices = current_prices
+    prices_data = prices.categorized()
 
     if not prices_data:
         return jsonify({'error': 'Prices not available'}), 503
@@ -2186,7 +5739,7 @@ def public_api_prices():
 
     return jsonify({
         'status': 'success',
-        'last_updated': current_prices.get('last_updated', ''),
+        'last_updated': prices.last_updated or '',
         'data': prices_data
     })
 
@@ -2198,10 +5751,19 @@ def public_api_prices():
 @app.route('/api/tsetmc', methods=['GET'])
 def get_tsetmc_data():
     """
-    دریافت تمام داده‌های بورس
+    دریافت داده‌های بورس
+    پارامترهای symbols, fields, sort, limit, offset مانند /api/prices
     """
-    if 'categorized' in current_prices and 'stock' in current_prices['categorized']:
-        return jsonify(current_prices['categorized']['stock'])
+    prices = current_prices
+    table = prices.table
+    if 'stock' in table.category_rows:
+        if not any(name in request.args for name in PRICE_QUERY_PARAMS):
+            return jsonify(prices.categorized()['stock'])
+
+        rows, fields, total = query_prices(prices, categories=['stock'])
+        response = jsonify([table.item(row, fields) for row in rows])
+        response.headers['X-Total-Count'] = str(total)
+        return response
 
     data = read_json_file(TSETMC_FILE)
     return jsonify(data if data else [])
@@ -2216,11 +5778,20 @@ def search_tsetmc():
     if not query:
         return jsonify([])
 
-    stock_data = current_prices.get('categorized', {}).get('stock', [])
-    if not stock_data:
-        stock_data = read_json_file(TSETMC_FILE)
-
+    table = current_prices.table
     query_lower = query.lower()
+
+    if 'stock' in table.category_rows:
+        # جستجو مستقیم روی ستون‌های جدول، بدون ساخت dict برای هر نماد
+        symbols = table.text['symbol']
+        titles = table.text['title']
+        rows = [
+            row for row in table.category_rows['stock']
+            if query_lower in symbols[row].lower() or query_lower in titles[row].lower()
+        ]
+        return jsonify([table.item(row) for row in rows[:20]])
+
+    stock_data = read_json_file(TSETMC_FILE)
     results = [
         item for item in stock_data
         if query_lower in item.get('symbol', '').lower()
@@ -2280,38 +5851,204 @@ def page_not_found(e):
 # ============================================================
 #  بخش ۲۳: زمان‌بند (Scheduler)
 # ============================================================
+#
+# حالت‌های SCHEDULER_MODE:
+# - local : هر پروسس همه جاب‌ها را اجرا می‌کند (رفتار پیش‌فرض، تک‌پروسسی)
+# - leader: فقط پروسسی که lease جدول scheduler_lease را دارد جاب‌ها را اجرا می‌کند
+# - off   : این پروسس جابی اجرا نمی‌کند (وب‌سرور کنار worker.py)
 
 scheduler = BackgroundScheduler()
 
-# قیمت‌ها هر ۱۰ دقیقه
-scheduler.add_job(func=fetch_prices, trigger="interval", minutes=10)
-# بورس هر ۱۷ دقیقه (برای پخش شدن بار)
-scheduler.add_job(func=update_tsetmc_prices, trigger="interval", minutes=17)
-# نمودار هر ۱ ساعت
-scheduler.add_job(func=update_chart_data_for_all_users, trigger="interval", hours=1)
-# تحلیل ارزش هر ۳ ساعت
-scheduler.add_job(func=update_value_analysis_for_all_users, trigger="interval", hours=3)
-# سود روزانه هر ۲ ساعت
-scheduler.add_job(func=calculate_daily_profit_for_all_users, trigger="interval", hours=2)
+# وضعیت رهبری این پروسس در حالت leader
+scheduler_state = {'leader': False}
+
+
+def scheduler_owner_id():
+    """
+    شناسه یکتای پروسس برای lease (بعد از fork هم تغییر می‌کند)
+    """
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def acquire_scheduler_lease():
+    """
+    گرفتن یا تمدید lease زمان‌بند در SQLite
+
+    اگر lease آزاد، منقضی یا متعلق به همین پروسس باشد، برای
+    SCHEDULER_LEASE_SECONDS ثانیه دیگر به این پروسس تعلق می‌گیرد
+    """
+    owner = scheduler_owner_id()
+    now = time.time()
+
+    conn = sqlite3.connect(DATABASE, timeout=5)
+    try:
+        conn.execute('''
+            INSERT INTO scheduler_lease (name, owner, expires_at)
+            VALUES ('scheduler', ?, ?)
+            ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+            WHERE scheduler_lease.owner = excluded.owner OR scheduler_lease.expires_at < ?
+        ''', (owner, now + SCHEDULER_LEASE_SECONDS, now))
+        conn.commit()
+        row = conn.execute("SELECT owner FROM scheduler_lease WHERE name = 'scheduler'").fetchone()
+    finally:
+        conn.close()
+
+    return row is not None and row[0] == owner
+
+
+def release_scheduler_lease():
+    """
+    آزاد کردن lease هنگام خروج برای جابجایی سریع رهبری
+    """
+    if not scheduler_state['leader']:
+        return
+    try:
+        conn = sqlite3.connect(DATABASE, timeout=5)
+        conn.execute("DELETE FROM scheduler_lease WHERE name = 'scheduler' AND owner = ?",
+                     (scheduler_owner_id(),))
+        conn.commit()
+        conn.close()
+    except sqlite3.Error as e:
+        print(f"⚠️ Error releasing scheduler lease: {e}")
+    scheduler_state['leader'] = False
+
+
+def renew_scheduler_lease():
+    """
+    تمدید دوره‌ای lease؛ در صورت مرگ رهبر، پروسس دیگری پس از انقضا جایگزین می‌شود
+    """
+    was_leader = scheduler_state['leader']
+    try:
+        is_leader = acquire_scheduler_lease()
+    except sqlite3.Error as e:
+        print(f"⚠️ Error renewing scheduler lease: {e}")
+        is_leader = False
+
+    scheduler_state['leader'] = is_leader
+    if is_leader and not was_leader:
+        print(f"👑 Process {os.getpid()} acquired the scheduler lease")
+    elif was_leader and not is_leader:
+        print(f"⚠️ Process {os.getpid()} lost the scheduler lease")
+        if shared_prices is not None:
+            shared_prices.release_publisher()
+
+
+def owns_jobs():
+    """
+    آیا این پروسس باید جاب‌های همه کاربران را اجرا کند؟
+    """
+    if SCHEDULER_MODE == 'local':
+        return True
+    return SCHEDULER_MODE == 'leader' and scheduler_state['leader']
+
+
+def scheduled_job(func, price_job=False):
+    """
+    اجرای جاب زمان‌بند داخل app context و فقط در پروسس مالک جاب‌ها
+
+    جاب‌های قیمت بدون جدول قیمت مشترک در همه پروسس‌ها اجرا می‌شوند،
+    چون هر پروسس به قیمت‌های خودش نیاز دارد
+    """
+    @wraps(func)
+    def job():
+        if not owns_jobs() and not (price_job and shared_prices is None):
+            return
+        with app.app_context():
+            func()
+    return job
+
+
+def start_scheduler():
+    """
+    ثبت جاب‌ها و شروع زمان‌بند بر اساس SCHEDULER_MODE
+    """
+    if SCHEDULER_MODE == 'off':
+        if shared_prices is None:
+            print("⚠️ SCHEDULER_MODE=off without SHARED_PRICES_FILE: prices will not be refreshed")
+        print("⏸️ Scheduler disabled in this process")
+        return
+
+    # قیمت‌ها هر ۱۰ دقیقه (force: سن داده در لحظه اجرا کمی کمتر از بازه است)
+    scheduler.add_job(func=scheduled_job(partial(fetch_prices, force=True), price_job=True),
+                      trigger="interval", minutes=PRICE_CACHE_MINUTES)
+    # بورس هر ۱۷ دقیقه (برای پخش شدن بار)
+    scheduler.add_job(func=scheduled_job(update_tsetmc_prices, price_job=True), trigger="interval",
+                      minutes=TSETMC_CACHE_MINUTES)
+    # نمودار هر ۱ ساعت
+    scheduler.add_job(func=scheduled_job(update_chart_data_for_all_users), trigger="interval", hours=1)
+    # تحلیل ارزش هر ۳ ساعت
+    scheduler.add_job(func=scheduled_job(update_value_analysis_for_all_users), trigger="interval", hours=3)
+    # سود روزانه هر ۲ ساعت
+    scheduler.add_job(func=scheduled_job(calculate_daily_profit_for_all_users), trigger="interval", hours=2)
+    # بررسی سازگاری موجودی‌های جاری و پاکسازی کلیدهای Idempotency روزی یک بار
+    scheduler.add_job(func=scheduled_job(verify_asset_balances), trigger="interval", days=1)
+    scheduler.add_job(func=scheduled_job(purge_idempotency_keys), trigger="interval", days=1)
+
+    if SCHEDULER_MODE == 'leader':
+        # تمدید lease سه بار در هر دوره اعتبار
+        scheduler.add_job(func=renew_scheduler_lease, trigger="interval",
+                          seconds=max(1, SCHEDULER_LEASE_SECONDS // 3))
+        atexit.register(release_scheduler_lease)
+
+    scheduler.start()
+
+
+def run_worker():
+    """
+    اجرای پروسس مستقل جاب‌ها (worker.py) بدون وب‌سرور
+    """
+    print(f"🛠️ Assetly worker running (mode: {SCHEDULER_MODE}, pid: {os.getpid()})")
+    try:
+        while True:
+            time.sleep(3600)
+    except (KeyboardInterrupt, SystemExit):
+        print("👋 Worker stopped")
+
 
-scheduler.start()
+start_scheduler()
 
 
 # ============================================================
 #  بخش ۲۴: راه‌اندازی اولیه
 # ============================================================
 
+def warm_up_app():
+    """
+    دریافت قیمت‌ها از API و ساخت داده‌های اولیه کاربران
+    در حالت FAST_START در پس‌زمینه و بعد از شروع سرویس‌دهی اجرا می‌شود
+    """
+    started = time.perf_counter()
+
+    # اولین دریافت قیمت‌ها (کش لود شده از دیسک نادیده گرفته می‌شود)
+    fetch_prices(force=True)
+    update_tsetmc_prices()
+
+    # ساخت داده‌های اولیه برای همه کاربران (فقط در پروسس مالک جاب‌ها)
+    if owns_jobs():
+        print("📊 Building initial data for all users...")
+        update_chart_data_for_all_users()
+        update_value_analysis_for_all_users()
+        calculate_daily_profit_for_all_users()
+
+    print(f"🔥 Warm-up finished ({time.perf_counter() - started:.2f}s)")
+
+
 def initialize_app():
     """
     راه‌اندازی اولیه اپلیکیشن
     - ساخت جداول
     - ایجاد کاربر پیش‌فرض (در صورت عدم وجود)
     - ساخت کیف پول ریالی برای کاربران موجود
-    - اولین دریافت قیمت‌ها
+    - اولین دریافت قیمت‌ها (در حالت FAST_START: لود از کش و دریافت در پس‌زمینه)
     """
+    started = time.perf_counter()
+
     with app.app_context():
         init_db()
 
+        if SCHEDULER_MODE == 'leader':
+            renew_scheduler_lease()
+
         conn = sqlite3.connect(DATABASE)
         conn.row_factory = sqlite3.Row
         db = conn
@@ -2336,34 +6073,38 @@ def initialize_app():
             conn.commit()
             print(f"✅ Default user created (ID: {user_id})")
         else:
-            # ساخت کیف پول ریالی برای کاربرانی که ندارند
-            users = db.execute('SELECT id FROM users').fetchall()
-            for user in users:
-                rial_exists = db.execute(
-                    'SELECT id FROM assets WHERE user_id = ? AND symbol = ?',
-                    (user['id'], RIAL_WALLET_SYMBOL)
-                ).fetchone()
-
-                if not rial_exists:
-                    db.execute(
-                        'INSERT INTO assets (id, user_id, symbol, title) VALUES (?, ?, ?, ?)',
-                        (str(uuid.uuid4()), user['id'], RIAL_WALLET_SYMBOL, 'کیف پول ریالی')
-                    )
+            # ساخت کیف پول ریالی برای کاربرانی که ندارند (یک کوئری برای همه کاربران)
+            # شناسه با فرمت UUID4 داخل SQLite ساخته می‌شود
+            cursor = db.execute('''
+                INSERT INTO assets (id, user_id, symbol, title)
+                SELECT
+                    lower(hex(randomblob(4))) || '-' || lower(hex(randomblob(2))) || '-4' ||
+                    substr(lower(hex(randomblob(2))), 2) || '-' ||
+                    substr('89ab', 1 + (abs(random()) % 4), 1) ||
+                    substr(lower(hex(randomblob(2))), 2) || '-' || lower(hex(randomblob(6))),
+                    u.id, ?, ?
+                FROM users u
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM assets a WHERE a.user_id = u.id AND a.symbol = ?
+                )
+            ''', (RIAL_WALLET_SYMBOL, 'کیف پول ریالی', RIAL_WALLET_SYMBOL))
+
+            if cursor.rowcount:
+                print(f"✅ Rial wallet created for {cursor.rowcount} users")
 
         conn.commit()
         conn.close()
 
-        # اولین دریافت قیمت‌ها
-        fetch_prices()
-        update_tsetmc_prices()
-
-        # ساخت داده‌های اولیه برای همه کاربران
-        print("📊 Building initial data for all users...")
-        update_chart_data_for_all_users()
-        update_value_analysis_for_all_users()
-        calculate_daily_profit_for_all_users()
+        if FAST_START:
+            # سرویس‌دهی فوری از کش دیسک؛ API و محاسبات در پس‌زمینه
+            load_cached_prices()
+            if scheduler.running:
+                scheduler.add_job(func=scheduled_job(warm_up_app, price_job=True),
+                                  next_run_time=datetime.now())
+        else:
+            warm_up_app()
 
-        print("✅ Application startup complete")
+    print(f"✅ Application startup complete ({time.perf_counter() - started:.2f}s)")
 
 
 # اجرای راه‌اندازی اولیه
@@ -2371,7 +6112,7 @@ with app.app_context():
     initialize_app()
 
 # بستن زمان‌بند در هنگام خروج
-atexit.register(lambda: scheduler.shutdown())
+atexit.register(lambda: scheduler.shutdown() if scheduler.running else None)
 
 
 # ============================================================
@@ -0,0 +1 @@
+python worker.py
\ No newline at end of file
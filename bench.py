@@ -0,0 +1,730 @@
+# ============================================================
+#  Assetly - اسکریپت‌های اندازه‌گیری کارایی
+#  اجرا: python bench.py <نام بنچمارک>
+# ============================================================
+
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import decimal
+import tempfile
+import threading
+import tracemalloc
+
+# جلوگیری از تغییر پایگاه داده اصلی هنگام ایمپورت app
+os.environ.setdefault('DB_NAME', os.path.join(tempfile.gettempdir(), 'assetly_bench.db'))
+
+import app as assetly
+
+
+def _load_prices():
+    with open(assetly.PRICES_FILE, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _measure(build):
+    """
+    اندازه‌گیری حافظه نگهداری شده توسط ساختار ساخته شده با build
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    obj = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return obj, after - before
+
+
+def bench_memory():
+    """
+    مقایسه حافظه ساختار قدیمی (dict تخت + dict هر نماد) با PriceTable
+    """
+    raw = json.dumps(_load_prices(), ensure_ascii=False)
+
+    def build_legacy():
+        categorized = json.loads(raw)
+        flat = {'categorized': categorized}
+        for items in categorized.values():
+            for item in items:
+                flat[item['symbol']] = item.get('toman_price', item.get('price', 0))
+        return flat
+
+    def build_table():
+        return assetly.PriceTable.from_categorized(json.loads(raw))
+
+    legacy, legacy_bytes = _measure(build_legacy)
+    table, table_bytes = _measure(build_table)
+
+    rows = len(table)
+    print(f"symbols:        {rows}")
+    print(f"legacy dicts:   {legacy_bytes / 1024:8.1f} KiB")
+    print(f"PriceTable:     {table_bytes / 1024:8.1f} KiB")
+    print(f"ratio:          {legacy_bytes / max(table_bytes, 1):8.2f}x")
+
+    assert table.to_categorized() == {k: v for k, v in legacy['categorized'].items()}
+
+
+def bench_snapshot(repeat=50):
+    """
+    مقایسه حجم و زمان لود سرد کش JSON با کش باینری (mmap)
+    """
+    table = assetly.PriceTable.from_categorized(_load_prices())
+    snapshot_path = os.path.join(tempfile.gettempdir(), 'assetly_bench_prices.bin')
+    assetly.write_file_atomic(snapshot_path, table.to_bytes())
+
+    def load_json():
+        with open(assetly.PRICES_FILE, 'r', encoding='utf-8') as f:
+            return assetly.PriceTable.from_categorized(json.load(f))
+
+    def load_snapshot():
+        with open(snapshot_path, 'rb') as f:
+            buffer = assetly.mmap.mmap(f.fileno(), 0, access=assetly.mmap.ACCESS_READ)
+        return assetly.PriceTable.from_buffer(buffer)[0]
+
+    timings = {}
+    for name, loader in (('json', load_json), ('binary', load_snapshot)):
+        started = time.perf_counter()
+        for _ in range(repeat):
+            loaded = loader()
+        timings[name] = (time.perf_counter() - started) / repeat * 1000
+        assert loaded.to_categorized() == table.to_categorized()
+
+    json_size = os.path.getsize(assetly.PRICES_FILE)
+    binary_size = os.path.getsize(snapshot_path)
+    print(f"prices.json:    {json_size / 1024:8.1f} KiB   load {timings['json']:6.2f} ms")
+    print(f"prices.bin:     {binary_size / 1024:8.1f} KiB   load {timings['binary']:6.2f} ms")
+    print(f"ratio:          {json_size / binary_size:8.2f}x size, {timings['json'] / timings['binary']:.2f}x load")
+
+
+def bench_shared(repeat=200):
+    """
+    بررسی جدول قیمت مشترک: پایداری snapshotهای خوانده شده پس از بازنویسی اسلات‌ها
+    و بازیابی پس از ناشری که وسط انتشار مرده (seq فرد)
+    """
+    table = assetly.PriceTable.from_categorized(_load_prices())
+    path = os.path.join(tempfile.gettempdir(), f'assetly_bench_shared_{uuid.uuid4().hex}.mmap')
+    publisher = assetly.SharedPriceTable(path, 4 * 1024 * 1024)
+    reader = assetly.SharedPriceTable(path, 4 * 1024 * 1024)
+    recovered = assetly.SharedPriceTable(path, 4 * 1024 * 1024)
+    try:
+        publisher.publish(table, {'version': 1})
+        first, _ = reader.read()
+        expected = first.to_categorized()
+
+        # دو انتشار بعدی اسلات جدول اول را بازنویسی می‌کنند
+        changed = assetly.PriceTable.from_categorized(_load_prices())
+        changed.numeric['price'] = assetly.array('d', [999.0] * len(changed.numeric['price']))
+        for version in (2, 3):
+            publisher.publish(changed, {'version': version})
+        assert first.to_categorized() == expected, "snapshot changed after slot was overwritten"
+        assert reader.read()[1]['version'] == 3
+
+        # شبیه‌سازی کرش ناشر بین نوشتن seq+1 و seq+2
+        seq, active, length, pid = reader._read_header()
+        assetly.SharedPriceTable.HEADER.pack_into(publisher.mm, 0, publisher.MAGIC, seq + 1, active, 0, pid)
+        assert reader.read() is None
+        recovered.publish(table, {'version': 4})
+        seq = reader._read_header()[0]
+        assert seq % 2 == 0, "seq left odd after recovery publish"
+        loaded, meta = reader.read()
+        assert meta['version'] == 4 and loaded.to_categorized() == expected
+
+        started = time.perf_counter()
+        for version in range(repeat):
+            publisher.publish(table, {'version': version})
+            reader.read()
+        elapsed = (time.perf_counter() - started) / repeat * 1000
+        print(f"publish+read (copied columns): {elapsed:6.2f} ms")
+        print("snapshot isolation and crashed-publisher recovery: ok")
+    finally:
+        for shared in (publisher, reader, recovered):
+            shared.mm.close()
+        os.remove(path)
+
+
+def _tsetmc_payload():
+    """
+    ساخت پاسخ AllSymbols هم‌اندازه با tsetmc_data.json (قیمت‌ها به ریال)
+    """
+    with open(assetly.TSETMC_FILE, 'r', encoding='utf-8') as f:
+        stocks = json.load(f)
+    return [{
+        'l18': item['symbol'],
+        'l30': item['title'],
+        'pl': item['price'] * 10 + 7,
+        'plc': item['change_value'] * 10 - 3,
+        'plp': item['change_percent']
+    } for item in stocks]
+
+
+def _legacy_normalize(data):
+    """
+    نسخه قبلی پردازش بورس (حذف رقم آخر با عملیات رشته‌ای) برای مقایسه
+    """
+    processed_data = []
+    for item in data:
+        if 'l18' not in item or 'pl' not in item:
+            continue
+        symbol_name = item.get('l18', '').strip()
+        company_name = item.get('l30', symbol_name).strip()
+        raw_price = item.get('pl', 0)
+        raw_change = item.get('plc', 0)
+        try:
+            change_percent = float(item.get('plp', 0)) if item.get('plp') else 0
+        except (ValueError, TypeError):
+            change_percent = 0
+        if raw_price and str(raw_price).replace('-', '').replace('.', '').isdigit():
+            price_str = str(abs(int(float(raw_price))))
+            adjusted_price = int(price_str[:-1]) if len(price_str) > 1 else 0
+            if float(raw_price) < 0:
+                adjusted_price = -adjusted_price
+        else:
+            adjusted_price = 0
+        if raw_change and str(raw_change).replace('-', '').replace('.', '').isdigit():
+            change_str = str(abs(int(float(raw_change))))
+            adjusted_change = int(change_str[:-1]) if len(change_str) > 1 else 0
+            if float(raw_change) < 0:
+                adjusted_change = -adjusted_change
+        else:
+            adjusted_change = 0
+        processed_data.append({
+            'symbol': symbol_name, 'title': company_name, 'name': company_name,
+            'price': adjusted_price, 'toman_price': adjusted_price,
+            'change_value': adjusted_change, 'change_percent': change_percent,
+            'last_update': assetly.datetime.now().strftime('%Y-%m-%d %H:%M')
+        })
+    processed_data.sort(key=lambda x: x['symbol'])
+    return processed_data
+
+
+def bench_tsetmc(repeat=200):
+    """
+    مقایسه نرمال‌سازی قدیمی (ردیف به ردیف با رشته) و دسته‌ای بورس
+    """
+    payload = _tsetmc_payload()
+    timings = {}
+    for name, normalize in (('legacy', _legacy_normalize), ('batch', assetly.normalize_tsetmc_payload)):
+        started = time.perf_counter()
+        for _ in range(repeat):
+            result = normalize(payload)
+        timings[name] = (time.perf_counter() - started) / repeat * 1000
+        timings[name + '_result'] = result
+
+    strip = lambda rows: [{k: v for k, v in row.items() if k != 'last_update'} for row in rows]
+    assert strip(timings['legacy_result']) == strip(timings['batch_result'])
+
+    print(f"symbols:        {len(payload)}")
+    print(f"legacy:         {timings['legacy']:8.3f} ms")
+    print(f"batch:          {timings['batch']:8.3f} ms")
+    print(f"speedup:        {timings['legacy'] / timings['batch']:8.2f}x")
+
+
+def bench_stream():
+    """
+    مقایسه حافظه اوج پارس کامل پاسخ بورس با پارس تدریجی
+    """
+    # پاسخ واقعی AllSymbols برای هر نماد ده‌ها فیلد دیگر هم دارد
+    payload = _tsetmc_payload()
+    for item in payload:
+        item.update({f'f{i}': item['pl'] * i for i in range(50)})
+    raw = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    del payload
+    chunk = assetly.TSETMC_STREAM_CHUNK
+    chunks = lambda: (raw[i:i + chunk] for i in range(0, len(raw), chunk))
+
+    def peak(run):
+        tracemalloc.start()
+        result = run()
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return result, peak_bytes
+
+    full, full_peak = peak(lambda: assetly.normalize_tsetmc_payload(json.loads(b''.join(chunks()))))
+    streamed, stream_peak = peak(lambda: assetly.normalize_tsetmc_stream(assetly.iter_json_array(chunks())))
+    assert [r['symbol'] for r in full] == [r['symbol'] for r in streamed]
+
+    print(f"payload:        {len(raw) / 1024:8.1f} KiB")
+    print(f"full parse:     {full_peak / 1024:8.1f} KiB peak")
+    print(f"streaming:      {stream_peak / 1024:8.1f} KiB peak")
+
+
+def _record_replay_payloads(directory, count=5):
+    """
+    ساخت پاسخ‌های ضبط شده Gold_Currency و AllSymbols از داده‌های کش موجود
+    """
+    prices = _load_prices()
+    stocks = _tsetmc_payload()
+
+    for step in range(count):
+        factor = 1 + step / 100
+        stamp = lambda item: dict(zip(('date', 'time'), (item.get('last_update') or ' ').split(' ', 1)))
+        gold_currency = {
+            'gold': [dict(stamp(item), symbol=item['symbol'], name=item['title'],
+                          price=(item['usd_price'] if item['symbol'] == 'XAUUSD' else item['price']) * factor,
+                          unit='دلار' if item['symbol'] == 'XAUUSD' else 'تومان',
+                          change_value=item.get('change_value'), change_percent=item.get('change_percent'))
+                     for item in prices.get('gold_coin', [])],
+            'currency': [dict(stamp(item), symbol=item['symbol'], name=item['title'],
+                              price=item['price'] * factor,
+                              change_value=item.get('change_value'), change_percent=item.get('change_percent'))
+                         for item in prices.get('currency', [])],
+            'cryptocurrency': [dict(stamp(item), symbol=item['symbol'], name=item['title'],
+                                    price=str(item['usd_price'] * factor),
+                                    change_percent=item.get('change_percent'))
+                               for item in prices.get('crypto', [])]
+        }
+        tsetmc = [dict(item, pl=int(item['pl'] * factor)) for item in stocks]
+
+        timestamp = 1_700_000_000_000 + step * 600_000
+        for kind, payload in (('gold_currency', gold_currency), ('tsetmc', tsetmc)):
+            with open(os.path.join(directory, f'{kind}-{timestamp}.json'), 'w', encoding='utf-8') as f:
+                json.dump(payload, f, ensure_ascii=False)
+
+
+def bench_pipeline(cycles=20, requests_count=200):
+    """
+    اجرای کامل دریافت ← کش ← API به‌صورت آفلاین با منبع replay
+    """
+    workdir = tempfile.mkdtemp(prefix='assetly_pipeline_')
+    replay_dir = os.path.join(workdir, 'recordings')
+    os.makedirs(replay_dir)
+    _record_replay_payloads(replay_dir)
+
+    for file_name in (assetly.PRICES_FILE, assetly.TSETMC_FILE):
+        with open(file_name, 'rb') as src, open(os.path.join(workdir, file_name), 'wb') as dst:
+            dst.write(src.read())
+
+    original_dir = os.getcwd()
+    original_sources = assetly.price_sources
+    os.chdir(workdir)
+    try:
+        assetly.price_sources = assetly.create_price_sources('replay', replay_dir, speed=0)
+
+        started = time.perf_counter()
+        for _ in range(cycles):
+            assetly.fetch_prices(force=True)
+            assetly.update_tsetmc_prices()
+        refresh_ms = (time.perf_counter() - started) / cycles * 1000
+
+        client = assetly.app.test_client()
+        started = time.perf_counter()
+        for _ in range(requests_count):
+            response = client.get('/api/prices')
+            assert response.status_code == 200
+        request_ms = (time.perf_counter() - started) / requests_count * 1000
+    finally:
+        assetly.price_sources = original_sources
+        os.chdir(original_dir)
+
+    print(f"refresh cycle:  {refresh_ms:8.2f} ms (gold/currency + {len(assetly.current_prices.table)} symbols)")
+    print(f"/api/prices:    {request_ms:8.2f} ms/request ({1000 / request_ms:.0f} req/s)")
+
+
+def _reset_user_transactions(user_id):
+    with assetly.app.app_context():
+        db = assetly.get_db()
+        db.execute('DELETE FROM transactions WHERE user_id = ?', (user_id,))
+        db.execute('DELETE FROM assets WHERE user_id = ? AND symbol != ?', (user_id, assetly.RIAL_WALLET_SYMBOL))
+        db.execute('DELETE FROM idempotency_keys WHERE user_id = ?', (user_id,))
+        # حذف تراکنش‌های بزرگ باقی‌مانده اعشاری در موجودی کیف پول می‌گذارد
+        assetly.rebuild_asset_balances(db, user_id)
+        db.commit()
+
+
+def _run_concurrently(count, target):
+    barrier = threading.Barrier(count)
+    results = [None] * count
+
+    def run(index):
+        client = assetly.app.test_client()
+        with client.session_transaction() as session:
+            session['user_id'] = 1
+        barrier.wait()
+        results[index] = target(client, index)
+
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def bench_concurrency(threads=16, buys_per_thread=10, affordable=25):
+    """
+    تست فشار ثبت همزمان تراکنش‌ها: کیف پول نباید منفی شود و کلید Idempotency
+    تکراری نباید ردیف تکراری بسازد
+    """
+    # تحلیل‌های پس از هر تراکنش در این تست اندازه‌گیری نمی‌شوند
+    original_refresh = assetly.refresh_user_analytics
+    assetly.refresh_user_analytics = lambda user_id: None
+    try:
+        _reset_user_transactions(1)
+        client = assetly.app.test_client()
+        with client.session_transaction() as session:
+            session['user_id'] = 1
+        price = 100000
+        client.post('/api/transactions', json={
+            'symbol': assetly.RIAL_WALLET_SYMBOL, 'type': 'deposit', 'quantity': price * affordable
+        })
+
+        def buy_many(client, index):
+            statuses = []
+            for _ in range(buys_per_thread):
+                response = client.post('/api/transactions', json={
+                    'symbol': 'USD', 'type': 'buy', 'quantity': 1, 'price_per_unit': price
+                })
+                statuses.append(response.status_code)
+            return statuses
+
+        started = time.perf_counter()
+        results = _run_concurrently(threads, buy_many)
+        elapsed = time.perf_counter() - started
+        statuses = [status for result in results for status in result]
+
+        def same_key(client, index):
+            response = client.post('/api/transactions', headers={'Idempotency-Key': 'bench-key'}, json={
+                'symbol': assetly.RIAL_WALLET_SYMBOL, 'type': 'deposit', 'quantity': 1
+            })
+            return response.status_code, (response.get_json() or {}).get('transaction_id')
+
+        replies = _run_concurrently(threads, same_key)
+
+        with assetly.app.app_context():
+            db = assetly.get_db()
+            wallet = db.execute(
+                'SELECT b.balance FROM asset_balances b JOIN assets a ON a.id = b.asset_id '
+                'WHERE a.user_id = 1 AND a.symbol = ?', (assetly.RIAL_WALLET_SYMBOL,)
+            ).fetchone()['balance']
+            keyed_rows = db.execute(
+                "SELECT COUNT(*) FROM transactions WHERE user_id = 1 AND type = 'deposit' AND quantity = 1"
+            ).fetchone()[0]
+            mismatches = assetly.check_asset_balances(db)
+    finally:
+        assetly.refresh_user_analytics = original_refresh
+
+    accepted = statuses.count(200)
+    print(f"buy requests:   {len(statuses)} from {threads} threads in {elapsed:.2f}s "
+          f"({len(statuses) / elapsed:.0f} req/s)")
+    print(f"accepted:       {accepted} (affordable: {affordable}), rejected: {statuses.count(400)}, "
+          f"other: {len(statuses) - accepted - statuses.count(400)}")
+    print(f"wallet balance: {wallet:,.0f}")
+    print(f"idempotent:     {keyed_rows} row(s), {len({reply[1] for reply in replies})} distinct id(s)")
+    print(f"consistency:    {len(mismatches)} mismatch(es)")
+
+    assert accepted == affordable and wallet == 1, 'wallet overdrawn or buys lost'
+    assert keyed_rows == 1 and all(status == 200 for status, _ in replies), 'duplicate idempotent write'
+    assert not mismatches, 'running balances diverged from replay'
+
+
+def _legacy_aggregate(db, user_id):
+    """
+    ارزش‌گذاری قبلی: Decimal برای هر تراکنش و رشته برای هر فیلد خروجی
+    """
+    aggregated = []
+    assets = db.execute('SELECT * FROM assets WHERE user_id = ? ORDER BY symbol', (user_id,)).fetchall()
+    for asset in assets:
+        total_quantity = buy_quantity_sum = buy_cost_sum = decimal.Decimal('0')
+        processed_transactions = []
+        for tx in db.execute('SELECT * FROM transactions WHERE asset_id = ? ORDER BY date, seq', (asset['id'],)):
+            tx_quantity = decimal.Decimal(str(tx['quantity']))
+            has_price = tx['type'] in ('buy', 'sell', 'save_profit')
+            tx_price = decimal.Decimal(str(tx['price_per_unit'])) if has_price else decimal.Decimal('0')
+            processed_transactions.append({
+                'transaction_id': tx['transaction_id'],
+                'date': tx['date'],
+                'type': tx['type'],
+                'quantity': str(tx_quantity),
+                'price_per_unit': str(tx_price) if has_price else None,
+                'category': tx['category'],
+                'comment': tx['comment']
+            })
+            if tx['type'] == 'buy':
+                total_quantity += tx_quantity
+                buy_quantity_sum += tx_quantity
+                buy_cost_sum += tx_quantity * tx_price
+            elif tx['type'] in ('sell', 'save_profit'):
+                if buy_quantity_sum > 0:
+                    buy_cost_sum -= (tx_quantity / buy_quantity_sum) * buy_cost_sum
+                buy_quantity_sum -= tx_quantity
+                total_quantity -= tx_quantity
+            elif tx['type'] in ('deposit', 'withdrawal') and asset['symbol'] == assetly.RIAL_WALLET_SYMBOL:
+                total_quantity += tx_quantity if tx['type'] == 'deposit' else -tx_quantity
+
+        current_price = decimal.Decimal(str(assetly.get_symbol_price(asset['symbol'])))
+        break_even = buy_cost_sum / buy_quantity_sum if buy_quantity_sum > 0 else decimal.Decimal('0')
+        current_value = total_quantity * current_price
+        if asset['symbol'] != assetly.RIAL_WALLET_SYMBOL:
+            cost_basis = buy_cost_sum
+            profit_loss = current_value - cost_basis
+            return_pct = (profit_loss / cost_basis) * 100 if cost_basis > 0 else 0
+        else:
+            cost_basis, profit_loss, return_pct = total_quantity, decimal.Decimal('0'), 0
+        aggregated.append({
+            'symbol': asset['symbol'],
+            'current_price': str(current_price),
+            'total_quantity': str(total_quantity),
+            'cost_basis': str(cost_basis),
+            'break_even_price': str(break_even),
+            'current_value': str(current_value),
+            'profit_loss': str(profit_loss),
+            'return_pct': str(return_pct),
+            'transactions': processed_transactions
+        })
+    return aggregated
+
+
+def _legacy_total_value(db, user_id):
+    total = decimal.Decimal('0')
+    for asset in _legacy_aggregate(db, user_id):
+        field = 'total_quantity' if asset['symbol'] == assetly.RIAL_WALLET_SYMBOL else 'current_value'
+        total += decimal.Decimal(asset[field])
+    return float(total)
+
+
+def _seed_portfolio(db, user_id, transactions_per_asset):
+    """
+    پورتفوی آزمایشی: تمام نمادهای طلا/ارز/رمزارز با خرید و فروش‌های متناوب
+    """
+    rng = random.Random(47)
+    symbols = [symbol for symbol in assetly.ALL_SYMBOLS if assetly.get_symbol_price(symbol)]
+    rows = []
+    db.execute('DELETE FROM assets WHERE user_id = ?', (user_id,))
+    for symbol in symbols + [assetly.RIAL_WALLET_SYMBOL]:
+        asset_id = str(uuid.uuid4())
+        db.execute('INSERT INTO assets (id, user_id, symbol, title) VALUES (?, ?, ?, ?)',
+                   (asset_id, user_id, symbol, symbol))
+        price = assetly.get_symbol_price(symbol) or 1
+        for index in range(transactions_per_asset):
+            if symbol == assetly.RIAL_WALLET_SYMBOL:
+                tx_type = 'deposit' if index % 3 else 'withdrawal'
+                quantity, unit_price = round(rng.uniform(1e5, 1e8), 2), None
+            else:
+                # فروش‌ها گاهی بیش از موجودی هستند (مثل تاریخچه‌ای که بعداً ویرایش شده)
+                tx_type = 'sell' if index % 3 == 2 else 'buy'
+                quantity = round(rng.uniform(0.01, 5), 4 if tx_type == 'buy' else 3) / (2 if tx_type == 'sell' else 1)
+                unit_price = round(price * rng.uniform(0.7, 1.3), 2)
+            rows.append((str(uuid.uuid4()), asset_id, user_id, tx_type, quantity, unit_price,
+                         f'2025-01-01T00:{index // 60 % 60:02d}:{index % 60:02d}'))
+    db.executemany('''
+        INSERT INTO transactions (transaction_id, asset_id, user_id, type, quantity, price_per_unit, date)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', rows)
+    db.commit()
+    return len(symbols) + 1, len(rows)
+
+
+def bench_valuation(transactions_per_asset=60, repeat=20):
+    """
+    مقایسه ارزش‌گذاری Decimal قبلی با هسته اعداد صحیح (ارزش کل و خروجی JSON /api/assets)
+    """
+    user_id = 1
+    _reset_user_transactions(user_id)
+    with assetly.app.test_request_context():
+        db = assetly.get_db()
+        asset_count, tx_count = _seed_portfolio(db, user_id, transactions_per_asset)
+
+        def timed(func):
+            # کمترین زمان از چند اجرا (کم‌نویزترین برآورد)
+            best = float('inf')
+            for _ in range(repeat):
+                started = time.perf_counter()
+                result = func()
+                best = min(best, time.perf_counter() - started)
+            return result, best * 1000
+
+        legacy_total, legacy_ms = timed(lambda: _legacy_total_value(db, user_id))
+        fixed_total, fixed_ms = timed(lambda: assetly.calculate_total_value(user_id))
+        legacy_assets, legacy_json_ms = timed(lambda: _legacy_aggregate(db, user_id))
+        replay_assets = assetly.aggregate_assets(user_id)
+
+        # تراکنش‌های آزمایشی مستقیم درج شده‌اند؛ پس از ساخت صف لات‌ها (مثل ثبت از API)
+        # ارزش کل و فیلدهای /api/assets بدون مرور تاریخچه از وضعیت ذخیره شده می‌آیند
+        assetly.sync_user_lots(db, user_id)
+        db.commit()
+        lots_total, lots_ms = timed(lambda: assetly.calculate_total_value(user_id))
+        fixed_assets, fixed_json_ms = timed(lambda: assetly.aggregate_assets(user_id))
+        assert fixed_assets == replay_assets, 'stored lot state diverged from replay'
+
+        # خروجی JSON باید رشته به رشته با محاسبه Decimal قبلی یکسان باشد؛ فقط در
+        # دارایی‌های بیش‌فروش بهای تمام‌شده عمداً متفاوت است (قبلاً منفی می‌شد)
+        fields = ('current_price', 'total_quantity', 'cost_basis', 'break_even_price', 'current_value',
+                  'profit_loss', 'return_pct', 'transactions')
+        cost_fields = ('cost_basis', 'break_even_price', 'profit_loss', 'return_pct')
+        oversold = {asset['symbol'] for asset in fixed_assets if asset['oversold_quantity'] != '0'}
+        mismatches = [
+            (legacy['symbol'], field, legacy[field], fixed[field])
+            for legacy, fixed in zip(legacy_assets, fixed_assets)
+            for field in fields
+            if legacy[field] != fixed[field] and not (legacy['symbol'] in oversold and field in cost_fields)
+        ]
+        assert [asset['symbol'] for asset in legacy_assets] == [asset['symbol'] for asset in fixed_assets]
+
+        # بیش‌فروش: مازاد گزارش می‌شود و بهای تمام‌شده منفی نمی‌شود
+        for asset in fixed_assets:
+            if asset['symbol'] in oversold:
+                assert decimal.Decimal(asset['cost_basis']) >= 0, asset
+
+        # تراکنش‌های بعد از آخرین sync (pending) از مکان‌نمای ذخیره شده ادامه می‌یابند
+        rows = [(str(uuid.uuid4()), asset['id'], user_id, 'buy', 0.5, 1234.5678, '2025-06-01')
+                for asset in db.execute('SELECT id FROM assets WHERE user_id = ? AND symbol != ?',
+                                        (user_id, assetly.RIAL_WALLET_SYMBOL))]
+        db.executemany('''
+            INSERT INTO transactions (transaction_id, asset_id, user_id, type, quantity, price_per_unit, date)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+        db.commit()
+        pending_assets = assetly.aggregate_assets(user_id)
+        mismatches += [
+            (legacy['symbol'], field, legacy[field], fixed[field])
+            for legacy, fixed in zip(_legacy_aggregate(db, user_id), pending_assets)
+            for field in fields
+            if legacy[field] != fixed[field] and not (legacy['symbol'] in oversold and field in cost_fields)
+        ]
+        assetly.sync_user_lots(db, user_id)
+        assert assetly.aggregate_assets(user_id) == pending_assets, 'pending transactions diverged from sync'
+
+        # دقت ذخیره شده مقدار حفظ می‌شود (بدون گرد کردن به رقم اعشار نوع دارایی)
+        symbol = legacy_assets[0]['symbol']
+        db.execute('DELETE FROM transactions WHERE user_id = ?', (user_id,))
+        db.execute('''
+            INSERT INTO transactions (transaction_id, asset_id, user_id, type, quantity, price_per_unit, date)
+            SELECT ?, id, user_id, 'buy', 0.12345, 1000, '2025-01-01' FROM assets WHERE user_id = ? AND symbol = ?
+        ''', (str(uuid.uuid4()), user_id, symbol))
+        db.commit()
+        precise = {asset['symbol']: asset for asset in assetly.aggregate_assets(user_id)}[symbol]
+        assert precise['total_quantity'] == '0.12345', precise['total_quantity']
+        expected = decimal.Decimal('0.12345') * decimal.Decimal(str(assetly.get_symbol_price(symbol)))
+        valuation = {item.symbol: item for item in assetly.valuate_assets(db, user_id)}[symbol]
+        assert assetly.fixed_to_str(valuation.quantity, valuation.decimals) == '0.12345'
+        assert abs(decimal.Decimal(valuation.value).scaleb(-assetly.MONEY_DECIMALS) - expected) < decimal.Decimal('1e-6')
+    _reset_user_transactions(user_id)
+
+    print(f"portfolio:      {asset_count} assets, {tx_count} transactions")
+    print(f"total value:    decimal {legacy_ms:7.2f} ms   fixed-point {fixed_ms:7.2f} ms   "
+          f"(x{legacy_ms / fixed_ms:.1f})")
+    print(f"  open lots:    {lots_ms:7.2f} ms (x{legacy_ms / lots_ms:.1f})")
+    print(f"/api/assets:    decimal {legacy_json_ms:7.2f} ms   stored lots {fixed_json_ms:7.2f} ms   "
+          f"(x{legacy_json_ms / fixed_json_ms:.1f})")
+    print(f"total diff:     {abs(legacy_total - fixed_total):.6f} toman of {fixed_total:,.0f}")
+    print(f"json fields:    {len(mismatches)} mismatch(es) vs Decimal output "
+          f"({len(oversold)} oversold asset(s) report oversold_quantity)")
+    for mismatch in mismatches[:5]:
+        print(f"  {mismatch}")
+
+    assert not mismatches, 'JSON strings diverged from Decimal output'
+    assert fixed_json_ms <= legacy_json_ms, '/api/assets is slower than the Decimal path'
+    assert abs(legacy_total - fixed_total) < 1, 'fixed-point total diverged'
+    assert abs(fixed_total - lots_total) < 1e-6, 'persisted lots diverged from replay'
+
+
+def bench_performance(days=1095, repeat=20):
+    """
+    محاسبه شاخص‌های عملکرد روی سه سال ارزش روزانه و پاسخ کش شده /api/performance
+    """
+    user_id = 1
+    _reset_user_transactions(user_id)
+    rng = random.Random(49)
+    with assetly.app.test_request_context():
+        db = assetly.get_db()
+        db.execute('DELETE FROM assets WHERE user_id = ?', (user_id,))
+        db.execute('DELETE FROM chart_data WHERE user_id = ?', (user_id,))
+        wallet_id = str(uuid.uuid4())
+        db.execute('INSERT INTO assets (id, user_id, symbol, title) VALUES (?, ?, ?, ?)',
+                   (wallet_id, user_id, assetly.RIAL_WALLET_SYMBOL, assetly.RIAL_WALLET_SYMBOL))
+
+        # ارزش روزانه با بازده تصادفی و واریز ماهانه (واریزها در کیف پول هم ثبت می‌شوند)
+        start = assetly.date.today().toordinal() - days
+        value = 0
+        for offset in range(days):
+            day = assetly.date.fromordinal(start + offset).isoformat()
+            value *= 1 + rng.gauss(0.0005, 0.02)
+            if offset % 30 == 0:
+                deposit = 1e9 if offset == 0 else 1e8
+                value += deposit
+                db.execute('''
+                    INSERT INTO transactions (transaction_id, asset_id, user_id, type, quantity, date)
+                    VALUES (?, ?, ?, 'deposit', ?, ?)
+                ''', (str(uuid.uuid4()), wallet_id, user_id, deposit, day))
+            db.execute('INSERT INTO chart_data (user_id, date, total_value) VALUES (?, ?, ?)',
+                       (user_id, day, value))
+        db.commit()
+
+        best = float('inf')
+        for _ in range(repeat):
+            started = time.perf_counter()
+            result = assetly.compute_performance(db, user_id)
+            best = min(best, time.perf_counter() - started)
+
+    client = assetly.app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = user_id
+    assetly.performance_cache.discard(user_id)
+    started = time.perf_counter()
+    client.get('/api/performance')
+    cold_ms = (time.perf_counter() - started) * 1000
+    started = time.perf_counter()
+    for _ in range(repeat):
+        assert client.get('/api/performance').status_code == 200
+    cached_ms = (time.perf_counter() - started) / repeat * 1000
+
+    # تاریخ پرت (سال شمسی ذخیره شده به‌جای میلادی) نباید NPV را سرریز کند یا XIRR را تغییر دهد
+    with assetly.app.test_request_context():
+        db = assetly.get_db()
+        for day in ('1404-02-01T12:00:00.000Z', '9999-12-31'):
+            db.execute('''
+                INSERT INTO transactions (transaction_id, asset_id, user_id, type, quantity, date)
+                VALUES (?, ?, ?, 'deposit', 1e8, ?)
+            ''', (str(uuid.uuid4()), wallet_id, user_id, day))
+        db.commit()
+        outlier = assetly.compute_performance(db, user_id)
+        assert outlier['xirr'] is not None, 'outlier dates broke xirr'
+        assert outlier['start'] == result['start'], 'outlier dates moved the series window'
+    assert client.get('/api/performance').status_code == 200, 'outlier dates broke /api/performance'
+    for flows in ([(1, -1e9), (assetly.day_number('2026-01-01'), 1e12)],
+                  [(1, -1e9), (2, 1e12), (assetly.day_number('2026-01-01'), -1e12)]):
+        assetly.xirr(flows)
+
+    # نوشتن از اتصال دیگر (پروسس دیگر) باید کش این پروسس را باطل کند
+    with assetly.app.app_context():
+        key = (assetly.current_prices.version, assetly.user_data_version(assetly.get_db(), user_id))
+        assert assetly.performance_cache.get(user_id, key) is not None
+    other = assetly.sqlite3.connect(assetly.DATABASE)
+    other.execute('DELETE FROM chart_data WHERE user_id = ? AND date = (SELECT MAX(date) FROM chart_data WHERE user_id = ?)',
+                  (user_id, user_id))
+    other.commit()
+    other.close()
+    with assetly.app.app_context():
+        key = (assetly.current_prices.version, assetly.user_data_version(assetly.get_db(), user_id))
+        assert assetly.performance_cache.get(user_id, key) is None, "cache not invalidated by another connection"
+    _reset_user_transactions(user_id)
+
+    print(f"series:         {result['periods']} periods, {result['days']} days")
+    print(f"compute:        {best * 1000:7.2f} ms")
+    print(f"/api/performance: cold {cold_ms:7.2f} ms   cached {cached_ms:7.2f} ms")
+    print(f"twr {result['time_weighted_return']}%  xirr {result['xirr']}%  "
+          f"max drawdown {result['max_drawdown']}%  volatility {result['volatility']}%")
+
+
+BENCHMARKS = {
+    'memory': bench_memory,
+    'snapshot': bench_snapshot,
+    'shared': bench_shared,
+    'tsetmc': bench_tsetmc,
+    'stream': bench_stream,
+    'pipeline': bench_pipeline,
+    'concurrency': bench_concurrency,
+    'valuation': bench_valuation,
+    'performance': bench_performance,
+}
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print(f"===== {name} =====")
+        started = time.perf_counter()
+        BENCHMARKS[name]()
+        print(f"({time.perf_counter() - started:.2f}s)")
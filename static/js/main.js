@@ -576,7 +576,7 @@ const fetchChartData = async () => {
         const headers = {};
         if (authToken) headers['Authorization'] = `Bearer ${authToken}`;
 
-        const response = await fetch('/api/chart-data', { headers });
+        const response = await fetch('/api/chart-data?max_points=365', { headers });
         if (!response.ok) throw new Error('Failed to fetch chart data');
         const data = await response.json();
         renderChart(data);
@@ -1362,6 +1362,7 @@ const renderAssetsDashboard = (assets) => {
         const currentValue = parseFloat(asset.current_value);
         const profitLoss = parseFloat(asset.profit_loss);
         const returnPct = parseFloat(asset.return_pct);
+        const realizedProfit = parseFloat(asset.realized_profit || 0);
 
         // کیف پول ریالی رو فقط توی مجموع حساب می‌کنیم - توی جدول نمایش نمی‌دیم
         if (asset.symbol === 'RIAL_WALLET') {
@@ -1392,6 +1393,7 @@ const renderAssetsDashboard = (assets) => {
                     <td class="px-2 py-2 sm:px-3 sm:py-3 text-xs sm:text-sm ${statusClass} font-semibold">
                         ${formatToman(profitLoss)}
                         <span class="text-xs">(${formatPercent(returnPct)})</span>
+                        ${realizedProfit ? `<span class="block text-gray-400 text-xs font-normal">محقق شده: ${formatToman(realizedProfit)}</span>` : ''}
                     </td>
                     <td class="px-2 py-2 sm:px-3 sm:py-3 text-center">
                         <button onclick="openHistoryModal('${asset.title}', '${asset.id}')"
@@ -1675,12 +1677,12 @@ const openValueAnalysisModal = async () => {
         }
 
         // لود تاریخچه
-        const historyRes = await fetch('/api/comparison-data', { headers });
+        const historyRes = await fetch('/api/comparison-data?order=desc&limit=7', { headers });
         const history = await historyRes.json();
         const tableBody = document.getElementById('value-analysis-table-body');
         tableBody.innerHTML = '';
 
-        history.slice(-7).reverse().forEach(entry => {
+        history.forEach(entry => {
             const date = new Date(entry.date).toLocaleDateString('fa-IR');
             tableBody.innerHTML += `
                 <tr class="hover:bg-gray-800">
@@ -1709,11 +1711,11 @@ const showDailyHistory = async () => {
         const headers = {};
         if (authToken) headers['Authorization'] = `Bearer ${authToken}`;
 
-        const response = await fetch('/api/daily-profit', { headers });
+        const response = await fetch('/api/daily-profit?order=desc&limit=10', { headers });
         const data = await response.json();
 
         let html = '<div class="space-y-3">';
-        data.slice(-10).reverse().forEach(entry => {
+        data.forEach(entry => {
             const date = new Date(entry.date).toLocaleDateString('fa-IR');
             const isPositive = entry.daily_change >= 0;
             const changeColor = isPositive ? 'text-green-400' : 'text-red-400';
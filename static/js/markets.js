@@ -8,13 +8,21 @@
 // ============================================================
 
 // ---------- داده‌های بازار ----------
-let allMarkets = [];
+// هر دسته فقط وقتی تب آن باز شود دریافت می‌شود (category -> آرایه بازارها)
+let marketsByCategory = {};
+let categoryLoadedAt = {};
+
+// نمادهای دیده‌بان (فقط همین نمادها از سرور گرفته می‌شوند)
+let watchlistMarkets = [];
 
 // ---------- لیست علاقه‌مندی‌ها ----------
 let favoriteMarkets = new Set(
     JSON.parse(localStorage.getItem('favoriteMarkets') || '[]')
 );
 
+// ---------- خلاصه بازار (از /api/markets/summary) ----------
+let marketSummary = {};
+
 // ---------- وضعیت فعلی صفحه ----------
 let currentTab = 'watchlist';
 let searchQuery = '';
@@ -32,6 +40,15 @@ const categoryNames = {
     'stock': '📈 بورس'
 };
 
+// ---------- فیلدهای مورد نیاز کارت‌ها (projection در /api/prices) ----------
+const MARKET_FIELDS = 'symbol,title,name,price,toman_price,usd_price,change_value,change_percent,last_update';
+
+// ---------- حداکثر نماد در هر درخواست (برابر PRICE_QUERY_MAX_LIMIT سرور) ----------
+const MARKETS_PAGE_LIMIT = 1000;
+
+// ---------- فاصله بروزرسانی تب فعال (میلی‌ثانیه) ----------
+const REFRESH_INTERVAL = 120000;
+
 // ---------- رنگ هر دسته‌بندی ----------
 const categoryColors = {
     'gold_coin': 'bg-yellow-600/20 text-yellow-400 border-yellow-600',
@@ -151,46 +168,101 @@ const formatDateTime = (dateStr) => {
 //  بخش ۴: دریافت داده‌ها از سرور
 // ============================================================
 
-const fetchAllPrices = async () => {
-    // دریافت قیمت‌های لحظه‌ای از API و تبدیل به آرایه یکپارچه
-    try {
-        const response = await fetch('/api/prices');
-        if (!response.ok) throw new Error('Failed to fetch prices');
+const toMarketItems = (data) => {
+    // تبدیل پاسخ /api/prices به آرایه یکپارچه کارت‌ها
+    // (دسته‌بندی شده، یا لیست items با دسته هر ردیف وقتی sort ارسال شده باشد)
+    const markets = [];
+
+    const addItem = (category, item) => {
+        const marketItem = {
+            ...item,
+            category: category,
+            displayPrice: item.toman_price || item.price,
+            displayName: item.title || item.name || item.symbol
+        };
+
+        // برای بورس، عنوان رو از name یا title می‌گیریم
+        if (category === 'stock') {
+            marketItem.displayName = item.name || item.title || item.symbol;
+            marketItem.change_percent = item.change_percent || 0;
+            marketItem.change_value = item.change_value || 0;
+        }
 
-        const data = await response.json();
+        markets.push(marketItem);
+    };
 
-        // تبدیل داده‌های دسته‌بندی شده به آرایه یکپارچه
-        const markets = [];
-
-        Object.keys(data).forEach(category => {
-            // رد کردن فیلدهای غیر دیتا
-            if (category === 'last_updated' || category === 'api_error') return;
-
-            const items = data[category];
-            if (Array.isArray(items)) {
-                items.forEach(item => {
-                    const marketItem = {
-                        ...item,
-                        category: category,
-                        displayPrice: item.toman_price || item.price,
-                        displayName: item.title || item.name || item.symbol
-                    };
-
-                    // برای بورس، عنوان رو از name یا title می‌گیریم
-                    if (category === 'stock') {
-                        marketItem.displayName = item.name || item.title || item.symbol;
-                        marketItem.change_percent = item.change_percent || 0;
-                        marketItem.change_value = item.change_value || 0;
-                    }
-
-                    markets.push(marketItem);
-                });
-            }
+    if (Array.isArray(data.items)) {
+        data.items.forEach(item => addItem(item.category, item));
+        return markets;
+    }
+
+    Object.keys(data).forEach(category => {
+        // رد کردن فیلدهای غیر دیتا (last_updated, api_error, freshness, stale)
+        const items = data[category];
+        if (!Array.isArray(items)) return;
+
+        items.forEach(item => addItem(category, item));
+    });
+
+    return markets;
+};
+
+const fetchPrices = async (params) => {
+    // دریافت ردیف‌های انتخاب شده از /api/prices (صفحه به صفحه تا X-Total-Count)
+    const markets = [];
+    let offset = 0;
+
+    while (true) {
+        const query = new URLSearchParams({
+            ...params,
+            fields: MARKET_FIELDS,
+            limit: MARKETS_PAGE_LIMIT,
+            offset: offset
         });
+        const response = await fetch(`/api/prices?${query}`);
+        if (!response.ok) throw new Error('Failed to fetch prices');
+
+        const page = toMarketItems(await response.json());
+        markets.push(...page);
+        offset += MARKETS_PAGE_LIMIT;
+
+        const total = parseInt(response.headers.get('X-Total-Count'), 10);
+        if (!page.length || isNaN(total) || offset >= total) break;
+    }
+
+    return markets;
+};
+
+const fetchCategory = async (category) => {
+    // دریافت یک دسته بازار
+    marketsByCategory[category] = await fetchPrices({ category });
+    categoryLoadedAt[category] = Date.now();
+};
 
-        allMarkets = markets;
+const fetchWatchlistMarkets = async () => {
+    // دریافت فقط نمادهای دیده‌بان
+    watchlistMarkets = favoriteMarkets.size
+        ? await fetchPrices({ symbols: [...favoriteMarkets].join(',') })
+        : [];
+};
 
-        console.log(`✅ ${markets.length} بازار بارگذاری شد`);
+const loadTab = async (tabId, refresh = false) => {
+    // دریافت داده‌های لازم تب (دسته‌های تازه‌تر از REFRESH_INTERVAL فقط با refresh دوباره گرفته می‌شوند)
+    try {
+        if (tabId === 'watchlist') {
+            await fetchWatchlistMarkets();
+        } else {
+            const categories = tabId === 'all' ? Object.keys(categoryNames) : [tabId];
+            await Promise.all(
+                categories
+                    .filter(category => refresh || !categoryLoadedAt[category] ||
+                        Date.now() - categoryLoadedAt[category] >= REFRESH_INTERVAL)
+                    .map(fetchCategory)
+            );
+        }
+
+        // تب در حین دریافت عوض شده؛ رندر با تب جدید انجام می‌شود
+        if (tabId !== currentTab) return;
 
         // بروزرسانی زمان آخرین بروزرسانی
         const now = new Date();
@@ -207,6 +279,22 @@ const fetchAllPrices = async () => {
 };
 
 
+const fetchMarketSummary = async () => {
+    // دریافت خلاصه فشرده بازارها (محاسبه شده در سرور هنگام انتشار قیمت‌ها)
+    try {
+        const response = await fetch('/api/markets/summary?top=5');
+        if (!response.ok) throw new Error('Failed to fetch market summary');
+
+        const data = await response.json();
+        marketSummary = data.categories || {};
+        renderMarketSummary();
+
+    } catch (error) {
+        console.error('❌ خطا در دریافت خلاصه بازار:', error);
+    }
+};
+
+
 // ============================================================
 //  بخش ۵: مدیریت علاقه‌مندی‌ها (دیده‌بان)
 // ============================================================
@@ -256,13 +344,15 @@ const updateWatchlistCount = () => {
 
 const filterMarkets = () => {
     // فیلتر بازارها بر اساس تب فعال و متن جستجو
-    let filtered = [...allMarkets];
+    let filtered;
 
-    // فیلتر بر اساس تب
+    // داده‌های تب
     if (currentTab === 'watchlist') {
-        filtered = filtered.filter(m => favoriteMarkets.has(m.symbol));
-    } else if (currentTab !== 'all') {
-        filtered = filtered.filter(m => m.category === currentTab);
+        filtered = watchlistMarkets.filter(m => favoriteMarkets.has(m.symbol));
+    } else if (currentTab === 'all') {
+        filtered = Object.keys(categoryNames).flatMap(category => marketsByCategory[category] || []);
+    } else {
+        filtered = marketsByCategory[currentTab] || [];
     }
 
     // فیلتر بر اساس جستجو
@@ -405,6 +495,57 @@ const renderMarkets = () => {
 };
 
 
+const renderMarketSummary = () => {
+    // رندر خلاصه دسته فعال (در تب‌های دیده‌بان و همه، خلاصه بورس)
+    const box = document.getElementById('market-summary');
+    if (!box) return;
+
+    const category = categoryNames[currentTab] ? currentTab : 'stock';
+    const stats = marketSummary[category];
+
+    if (!stats || !stats.count) {
+        box.classList.add('hidden');
+        return;
+    }
+
+    const total = stats.advancing + stats.declining + stats.unchanged || 1;
+    const moverList = (items, color) => items.map(item => `
+        <li class="flex justify-between gap-2">
+            <span class="truncate">${item.title}</span>
+            <span class="${color} font-mono">${formatPercent(item.change_percent)}</span>
+        </li>
+    `).join('') || '<li class="text-gray-500">-</li>';
+
+    box.innerHTML = `
+        <div class="flex flex-wrap justify-between items-center gap-2 mb-3 text-sm">
+            <span class="text-gray-300">${categoryNames[category]}</span>
+            <span class="text-gray-400">
+                <span class="text-green-400">▲ ${stats.advancing.toLocaleString('fa-IR')}</span> ·
+                <span class="text-red-400">▼ ${stats.declining.toLocaleString('fa-IR')}</span> ·
+                <span>■ ${stats.unchanged.toLocaleString('fa-IR')}</span> ·
+                میانگین ${formatPercent(stats.average_change_percent)}
+            </span>
+        </div>
+        <div class="flex h-1.5 rounded overflow-hidden bg-gray-700 mb-3">
+            <div class="bg-green-500" style="width: ${stats.advancing / total * 100}%"></div>
+            <div class="bg-gray-500" style="width: ${stats.unchanged / total * 100}%"></div>
+            <div class="bg-red-500" style="width: ${stats.declining / total * 100}%"></div>
+        </div>
+        <div class="grid grid-cols-1 sm:grid-cols-2 gap-4 text-sm">
+            <div>
+                <p class="text-gray-400 mb-1">بیشترین رشد</p>
+                <ul class="space-y-1">${moverList(stats.top_gainers, 'text-green-400')}</ul>
+            </div>
+            <div>
+                <p class="text-gray-400 mb-1">بیشترین افت</p>
+                <ul class="space-y-1">${moverList(stats.top_losers, 'text-red-400')}</ul>
+            </div>
+        </div>
+    `;
+    box.classList.remove('hidden');
+};
+
+
 // ============================================================
 //  بخش ۸: مدیریت تب‌ها
 // ============================================================
@@ -421,6 +562,10 @@ const switchTab = (tabId) => {
     });
 
     renderMarkets();
+    renderMarketSummary();
+
+    // دسته‌های تب جدید در صورت نیاز دریافت می‌شوند؛ دیده‌بان همیشه تازه گرفته می‌شود
+    loadTab(tabId);
 };
 
 
@@ -430,8 +575,9 @@ const switchTab = (tabId) => {
 
 document.addEventListener('DOMContentLoaded', () => {
 
-    // لود اولیه قیمت‌ها
-    fetchAllPrices();
+    // لود اولیه تب فعال و خلاصه بازار
+    loadTab(currentTab);
+    fetchMarketSummary();
     updateWatchlistCount();
 
     // کلیک روی تب‌ها
@@ -453,8 +599,9 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     }
 
-    // بروزرسانی خودکار هر ۲ دقیقه
-    setInterval(fetchAllPrices, 120000);
+    // بروزرسانی خودکار هر ۲ دقیقه: فقط داده‌های تب فعال و خلاصه بازار
+    setInterval(() => loadTab(currentTab, true), REFRESH_INTERVAL);
+    setInterval(fetchMarketSummary, REFRESH_INTERVAL);
 });
 
 
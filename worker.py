@@ -0,0 +1,19 @@
+# ============================================================
+#  Assetly Worker - اجرای جاب‌های زمان‌بند جدا از وب‌سرور
+#
+#  استفاده:
+#    python worker.py
+#  و وب‌سرور با SCHEDULER_MODE=off و SHARED_PRICES_FILE مشترک اجرا شود.
+#  چند worker همزمان با lease پایگاه داده هماهنگ می‌شوند (فقط یکی فعال است).
+# ============================================================
+
+import os
+
+# worker همیشه از طریق lease مالک جاب‌ها می‌شود
+if os.getenv('SCHEDULER_MODE', 'off') in ('off', 'local'):
+    os.environ['SCHEDULER_MODE'] = 'leader'
+
+from app import run_worker
+
+if __name__ == '__main__':
+    run_worker()